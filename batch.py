@@ -0,0 +1,225 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+from compile_cache import CompileCache, DEFAULT_MAX_SIZE
+from grammar_compiler import load_parse_table
+from instrumentation import Profile
+from optimizer import PASSES
+from parser import compile_file
+
+
+class BatchException(Exception):
+    def __init__(self, message):
+        self.message = message
+        super(BatchException, self).__init__(message)
+
+
+SOURCE_EXTENSION = '.txt'
+CODE_SUFFIX = '.code'
+ERRORS_SUFFIX = '.errors'
+LAYOUT_SUFFIX = '.layout'
+SUMMARY_FILE = 'summary.txt'
+PROFILE_FILE = 'profile.json'
+
+# the parse table and compile cache of a worker process, set up once by
+# init_worker
+parse_table = None
+cache = None
+
+
+def expand_sources(patterns, extension=SOURCE_EXTENSION, exclude=None):
+    """Returns the sorted source files named by patterns.
+
+    A pattern is a file, a directory (searched recursively for files
+    ending in extension) or a glob. Files under exclude are skipped.
+    """
+    exclude = os.path.abspath(exclude) if exclude else None
+    sources = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, directories, files in os.walk(pattern):
+                directories[:] = [
+                    d for d in directories
+                    if os.path.abspath(os.path.join(root, d)) != exclude]
+                sources.update(os.path.join(root, name) for name in files
+                               if name.endswith(extension))
+        elif os.path.isfile(pattern):
+            sources.add(pattern)
+        else:
+            matches = [path for path in glob.glob(pattern, recursive=True)
+                       if os.path.isfile(path)]
+            if not matches:
+                raise BatchException("No sources match '%s'." % pattern)
+            sources.update(matches)
+    return sorted(os.path.normpath(source) for source in sources)
+
+
+def output_stems(sources, output_dir):
+    """Maps every source to its output path without suffix, mirroring the
+    tree below the directory the sources have in common."""
+    paths = [os.path.abspath(source) for source in sources]
+    if not paths:
+        return []
+    base = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return [os.path.join(output_dir,
+                         os.path.splitext(os.path.relpath(path, base))[0])
+            for path in paths]
+
+
+def init_worker(grammar_file, first_set_file, follow_set_file,
+                cache_dir=None, cache_size=DEFAULT_MAX_SIZE):
+    global parse_table, cache
+    parse_table = load_parse_table(grammar_file, first_set_file,
+                                   follow_set_file)
+    cache = CompileCache(cache_dir, cache_size) if cache_dir else None
+
+
+def compile_one(task):
+    """Compiles one source in a worker. Returns (source, number of errors,
+    number of instructions, seconds, failure message or None, Profile
+    counters or None)."""
+    source, stem, binary_output, optimization_passes, layout, profiled, \
+        max_errors = task
+    profile = Profile() if profiled else None
+    start = time.time()
+    try:
+        directory = os.path.dirname(stem)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        program_block, scanner_errors, parser_errors, semantic_errors, _ = \
+            compile_file(parse_table, source, stem + CODE_SUFFIX,
+                         stem + ERRORS_SUFFIX, binary_output,
+                         optimization_passes,
+                         stem + LAYOUT_SUFFIX if layout else None, cache,
+                         profile, max_errors)
+    except Exception as e:
+        # one broken source must not stop the rest of the batch
+        return source, 0, 0, time.time() - start, '%s: %s' % (
+            type(e).__name__, e), None
+    errors = sum(len(messages) for table in (scanner_errors, parser_errors,
+                                             semantic_errors)
+                 for messages in table.values())
+    return source, errors, len(program_block), time.time() - start, None, \
+        profile.as_dict() if profile is not None else None
+
+
+def compile_batch(sources, output_dir, grammar_file, first_set_file=None,
+                  follow_set_file=None, workers=None, binary_output=False,
+                  optimization_passes=None, layout=False, cache_dir=None,
+                  cache_size=DEFAULT_MAX_SIZE, chunk_size=4, profile=False,
+                  max_errors=None):
+    """Compiles sources across a pool of worker processes.
+
+    Every worker loads the parse table once. Results come back in the
+    order of sources whatever the number of workers. With a cache_dir the
+    workers share a CompileCache there. With profile every compile is
+    instrumented, bypassing the cache.
+    """
+    tasks = [(source, stem, binary_output, optimization_passes, layout,
+              profile, max_errors)
+             for source, stem in zip(sources, output_stems(sources,
+                                                           output_dir))]
+    initargs = (grammar_file, first_set_file, follow_set_file, cache_dir,
+                cache_size)
+    if workers == 1 or len(tasks) < 2:
+        init_worker(*initargs)
+        return [compile_one(task) for task in tasks]
+    pool = multiprocessing.Pool(workers, init_worker, initargs)
+    try:
+        return pool.map(compile_one, tasks, chunk_size)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def format_summary(results):
+    lines = []
+    failed = with_errors = instructions = 0
+    for source, errors, size, _, failure, _ in results:
+        if failure is not None:
+            failed += 1
+            lines.append('%s\tfailed\t%s\n' % (source, failure))
+            continue
+        if errors:
+            with_errors += 1
+        instructions += size
+        lines.append('%s\t%s\t%d\n' % (source, '%d errors' % errors
+                                       if errors else 'ok', size))
+    lines.append('%d files, %d with errors, %d failed, %d instructions\n' % (
+        len(results), with_errors, failed, instructions))
+    return ''.join(lines)
+
+
+def main(argv=None):
+    arguments = argparse.ArgumentParser(
+        description='Compiles many sources in parallel.')
+    arguments.add_argument('sources', nargs='+',
+                           help='source files, directories or globs')
+    arguments.add_argument('-o', '--output-dir', default='build')
+    arguments.add_argument('-j', '--workers', type=int, default=None,
+                           help='worker processes (default: one per CPU)')
+    arguments.add_argument('--extension', default=SOURCE_EXTENSION,
+                           help='suffix of the sources to take from '
+                                'directories')
+    arguments.add_argument('--grammar', default='grammar.txt')
+    arguments.add_argument('--first-set', default=None)
+    arguments.add_argument('--follow-set', default=None)
+    arguments.add_argument('--binary', action='store_true',
+                           help='write packed program blocks')
+    arguments.add_argument('--optimize', action='store_true',
+                           help='run all optimization passes')
+    arguments.add_argument('--layout', action='store_true',
+                           help='write the data layout of every program')
+    arguments.add_argument('--cache-dir', default=None,
+                           help='reuse results of unchanged sources from '
+                                'this directory')
+    arguments.add_argument('--cache-size', type=int,
+                           default=DEFAULT_MAX_SIZE >> 20,
+                           help='size bound of the cache in megabytes')
+    arguments.add_argument('--max-errors', type=int, default=None,
+                           help='stop compiling a file after this many '
+                                'errors')
+    arguments.add_argument('--profile', action='store_true',
+                           help='instrument the compiles and write the '
+                                'counters of all of them to %s' %
+                                PROFILE_FILE)
+    options = arguments.parse_args(argv)
+    if options.workers is not None and options.workers < 1:
+        arguments.error('the number of workers must be positive')
+
+    try:
+        sources = expand_sources(options.sources, options.extension,
+                                 options.output_dir)
+    except BatchException as e:
+        arguments.error(e.message)
+    start = time.time()
+    results = compile_batch(sources, options.output_dir, options.grammar,
+                            options.first_set, options.follow_set,
+                            options.workers, options.binary,
+                            PASSES if options.optimize else None,
+                            options.layout, options.cache_dir,
+                            options.cache_size << 20,
+                            profile=options.profile,
+                            max_errors=options.max_errors)
+    summary = format_summary(results)
+    os.makedirs(options.output_dir, exist_ok=True)
+    with open(os.path.join(options.output_dir, SUMMARY_FILE), 'w') as f:
+        f.write(summary)
+    if options.profile:
+        profile = Profile()
+        for result in results:
+            if result[5] is not None:
+                profile.merge(result[5])
+        with open(os.path.join(options.output_dir, PROFILE_FILE), 'w') as f:
+            f.write(profile.to_json())
+    sys.stdout.write(summary)
+    sys.stdout.write('%.2fs\n' % (time.time() - start))
+    return 1 if any(result[1] or result[4] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
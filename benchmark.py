@@ -0,0 +1,511 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from compiler import Compiler
+from intermediate_code_generator import JUMP_TABLE_MIN_CASES
+from optimizer import PASSES
+from parser import Diagram, Parser
+from scanner import TokenStream
+
+PHASES = ('scan', 'parse', 'codegen', 'finish')
+# default allowed slowdown (or growth of peak memory) against the baseline
+THRESHOLD = 0.2
+
+# name -> ProgramGenerator arguments
+SCENARIOS = {
+    'small': dict(functions=3, globals=2),
+    'medium': dict(functions=20, globals=10),
+    'large': dict(functions=80, globals=40),
+    'deep': dict(functions=4, depth=6, statements=2),
+    'long-expressions': dict(functions=10, expression_length=24),
+    'errors': dict(functions=20, globals=10, error_rate=0.2),
+    'switches': dict(functions=10, dense_switches=1.0),
+}
+
+
+class ProgramGenerator(object):
+    """Writes random programs in the grammar of grammar.txt.
+
+    functions and globals set the number of declarations, depth how deeply
+    while, if and switch statements nest, statements the length of every
+    block and expression_length the number of operators per expression.
+    dense_switches is the fraction of switches with enough cases close
+    together to dispatch through a jump table. With error_rate > 0 that
+    fraction of the statements gets a scanner, syntax or semantic error;
+    otherwise the programs compile cleanly and every loop terminates.
+    """
+
+    def __init__(self, seed=0, functions=10, globals=5, depth=2,
+                 statements=4, expression_length=4, error_rate=0.0,
+                 dense_switches=0.0):
+        self.random = random.Random(seed)
+        self.functions = functions
+        self.globals = globals
+        self.depth = depth
+        self.statements = statements
+        self.expression_length = expression_length
+        self.error_rate = error_rate
+        self.dense_switches = dense_switches
+        self.counter = 0
+        # counters of the loops being generated, never assigned in them
+        self.counters = []
+
+    def operand(self, names, arrays, callees):
+        r = self.random
+        choice = r.random()
+        if names and choice < 0.45:
+            return r.choice(names)
+        if arrays and choice < 0.55:
+            return '%s[%d]' % (r.choice(arrays), r.randrange(4))
+        if callees and choice < 0.6:
+            name, arity = r.choice(callees)
+            return '%s(%s)' % (name, ', '.join(
+                self.operand(names, arrays, ()) for _ in range(arity)))
+        if choice < 0.65:
+            return '(%s)' % self.expression(names, arrays, (), 2)
+        if choice < 0.7:
+            return '-%d' % r.randrange(10)
+        return str(r.randrange(100))
+
+    def expression(self, names, arrays, callees, length=None):
+        r = self.random
+        if length is None:
+            length = r.randint(0, self.expression_length)
+        parts = [self.operand(names, arrays, callees)]
+        for _ in range(length):
+            parts.append(r.choice('+-*'))
+            parts.append(self.operand(names, arrays, callees))
+        expression = ' '.join(parts)
+        if r.random() < 0.2:
+            expression = '%s %s %s' % (expression, r.choice(('<', '==')),
+                                       self.operand(names, arrays, ()))
+        return expression
+
+    def block(self, names, arrays, callees, depth, indent, loop):
+        lines = []
+        for _ in range(self.statements):
+            lines.extend(self.statement(names, arrays, callees, depth,
+                                        indent, loop))
+        return lines
+
+    def statement(self, names, arrays, callees, depth, indent, loop):
+        r = self.random
+        lines = self.plain_statement(names, arrays, callees, depth, indent,
+                                     loop)
+        if self.error_rate and r.random() < self.error_rate:
+            lines[-1] = self.break_line(lines[-1])
+        return lines
+
+    def plain_statement(self, names, arrays, callees, depth, indent, loop):
+        r = self.random
+        choice = r.random()
+        inner = indent + '    '
+        if depth >= self.depth or choice < 0.4:
+            if arrays and r.random() < 0.2:
+                target = '%s[%d]' % (r.choice(arrays), r.randrange(4))
+            else:
+                target = r.choice([name for name in names
+                                   if name not in self.counters])
+            return ['%s%s = %s;' % (indent, target,
+                                    self.expression(names, arrays, callees))]
+        if choice < 0.5:
+            return ['%soutput(%s);' % (indent, self.expression(
+                names, arrays, callees))]
+        if choice < 0.55 and loop:
+            return ['%sif (%s) break; else ;' % (indent, self.expression(
+                names, arrays, callees, 1))]
+        if choice < 0.7:
+            lines = ['%sif (%s) {' % (indent, self.expression(
+                names, arrays, callees))]
+            lines += self.block(names, arrays, callees, depth + 1, inner,
+                                loop)
+            lines.append('%s} else {' % indent)
+            lines += self.block(names, arrays, callees, depth + 1, inner,
+                                loop)
+            lines.append('%s}' % indent)
+            return lines
+        if choice < 0.85:
+            self.counter += 1
+            counter = 'i%d' % self.counter
+            lines = ['%s{' % indent, '%sint %s;' % (inner, counter),
+                     '%s%s = 0;' % (inner, counter),
+                     '%swhile (%s < %d) {' % (inner, counter,
+                                              r.randint(1, 4)),
+                     '%s    %s = %s + 1;' % (inner, counter, counter)]
+            self.counters.append(counter)
+            lines += self.block(names + [counter], arrays, callees,
+                                depth + 1, inner + '    ', True)
+            self.counters.pop()
+            lines += ['%s}' % inner, '%s}' % indent]
+            return lines
+        lines = ['%sswitch (%s) {' % (indent, self.expression(
+            names, arrays, callees, 1))]
+        if self.dense_switches and r.random() < self.dense_switches:
+            return lines + self.dense_cases(names, arrays, callees, inner,
+                                            loop) + ['%s}' % indent]
+        for case in r.sample(range(8), r.randint(1, 3)):
+            lines.append('%scase %d:' % (inner, case))
+            lines += self.block(names, arrays, callees, depth + 1,
+                                inner + '    ', loop)
+            lines.append('%s    break;' % inner)
+        lines.append('%sdefault:' % inner)
+        lines += self.block(names, arrays, callees, depth + 1, inner + '    ',
+                            loop)
+        lines.append('%s}' % indent)
+        return lines
+
+    def dense_cases(self, names, arrays, callees, indent, loop):
+        """Cases of a switch dense enough for a jump table, each with one
+        simple statement and falling through to the next now and then."""
+        r = self.random
+        count = r.randint(JUMP_TABLE_MIN_CASES, 3 * JUMP_TABLE_MIN_CASES)
+        lines = []
+        for case in sorted(r.sample(range(2 * count), count)):
+            lines.append('%scase %d:' % (indent, case))
+            lines += self.plain_statement(names, arrays, callees, self.depth,
+                                          indent + '    ', loop)
+            if r.random() < 0.7:
+                lines.append('%s    break;' % indent)
+        if r.random() < 0.5:
+            lines.append('%sdefault:' % indent)
+            lines += self.plain_statement(names, arrays, callees, self.depth,
+                                          indent + '    ', loop)
+        return lines
+
+    def break_line(self, line):
+        r = self.random
+        kind = r.randrange(4)
+        if kind == 0:
+            # scanner error, possibly in the middle of a token
+            position = r.randrange(len(line) + 1)
+            return line[:position] + r.choice('@$!?') + line[position:]
+        if kind == 1 and ';' in line:
+            # missing token
+            return line.replace(';', '', 1)
+        if kind == 2:
+            # unexpected token
+            return line + ' )'
+        # semantic error
+        return '%sundefined%d = 1;' % (line[:len(line) - len(line.lstrip())],
+                                       r.randrange(1000))
+
+    def generate(self):
+        r = self.random
+        lines = []
+        names = []
+        arrays = []
+        for i in range(self.globals):
+            if r.random() < 0.8:
+                names.append('g%d' % i)
+                lines.append('int g%d;' % i)
+            else:
+                arrays.append('ga%d' % i)
+                lines.append('int ga%d[4];' % i)
+        if not names:
+            names.append('g')
+            lines.append('int g;')
+
+        callees = []
+        for i in range(self.functions):
+            arity = r.randrange(3)
+            parameters = ['p%d' % k for k in range(arity)]
+            lines.append('int f%d(%s) {' % (i, ', '.join(
+                'int ' + p for p in parameters) or 'void'))
+            lines.append('    int l;')
+            lines.append('    l = 1;')
+            local = names + parameters + ['l']
+            lines += self.block(local, arrays, callees, 0, '    ', False)
+            lines.append('    return %s;' % self.expression(local, arrays,
+                                                             callees))
+            lines.append('}')
+            callees.append(('f%d' % i, arity))
+
+        lines.append('void main(void) {')
+        lines.append('    int x;')
+        lines.append('    int a[4];')
+        lines.append('    x = 0;')
+        lines += self.block(names + ['x'], arrays + ['a'], callees, 0,
+                            '    ', False)
+        lines.append('    output(x);')
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+
+def best_of(repeat, function):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def measure(compiler, source, repeat=3, optimization_passes=None,
+            memory=True):
+    """Times the phases of compiling source, each the best of repeat runs.
+
+    scan only runs the scanner; parse feeds the tokens to a parser with
+    code generation switched off and codegen is what turning it on adds;
+    finish is the optimizer and the data layout. peak_memory is the peak
+    of memory allocated during a full compile, in bytes, or None without
+    memory since tracing allocations slows the compile down severalfold.
+    """
+    scan, tokens = best_of(repeat, lambda: list(TokenStream(source)))
+    line = tokens[-1][0] if tokens else 0
+
+    def run_parser(generate):
+        diagram = Diagram(compiler.parse_table)
+        diagram.intermediate_code_generator.is_ok = generate
+        parser = Parser(diagram)
+        parser.feed(tokens)
+        parser.end(line)
+        return parser, diagram.intermediate_code_generator
+
+    parse, _ = best_of(repeat, lambda: run_parser(False))
+    full, (parser, _) = best_of(repeat, lambda: run_parser(True))
+
+    def finish():
+        icg = run_parser(True)[1]
+        start = time.perf_counter()
+        icg.finish(optimization_passes)
+        return time.perf_counter() - start
+
+    finish_time = min(finish() for _ in range(repeat))
+
+    peak_memory = None
+    if memory:
+        tracemalloc.start()
+        try:
+            compiler.compile(source, optimization_passes)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    count = sum(1 for token in tokens if token[1] not in ('W', 'COMMENT'))
+    return {
+        'scan': scan,
+        'parse': parse,
+        'codegen': max(full - parse, 0.0),
+        'finish': finish_time,
+        'tokens': count,
+        'tokens_per_second': count / (scan + full) if scan + full else 0.0,
+        'errors': sum(len(messages) for errors in (
+            parser.scanner_errors, parser.parser_errors,
+            parser.semantic_errors) for messages in errors.values()),
+        'peak_memory': peak_memory,
+    }
+
+
+def run_scenarios(names, scale=1.0, repeat=3, optimization_passes=None,
+                  seed=0, memory=True):
+    compiler = Compiler()
+    results = {}
+    for name in names:
+        arguments = dict(SCENARIOS[name])
+        arguments['functions'] = max(1, int(arguments['functions'] * scale))
+        source = ProgramGenerator(seed, **arguments).generate()
+        results[name] = measure(compiler, source, repeat,
+                                optimization_passes, memory)
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Returns the (scenario, metric, baseline, current) of every phase
+    time or peak memory more than threshold above the baseline."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in PHASES + ('peak_memory',):
+            old = baseline[name].get(metric)
+            if old and result[metric] is not None and \
+                    result[metric] > old * (1 + threshold):
+                regressions.append((name, metric, old, result[metric]))
+    return regressions
+
+
+def format_results(results):
+    lines = ['%-18s %8s %8s %8s %8s %8s %12s %10s' % (
+        'scenario', 'tokens', 'scan', 'parse', 'codegen', 'finish',
+        'tokens/s', 'peak KiB')]
+    for name, result in sorted(results.items()):
+        lines.append('%-18s %8d %8.4f %8.4f %8.4f %8.4f %12.0f %10d' % (
+            name, result['tokens'], result['scan'], result['parse'],
+            result['codegen'], result['finish'], result['tokens_per_second'],
+            -1 if result['peak_memory'] is None
+            else result['peak_memory'] // 1024))
+    return '\n'.join(lines) + '\n'
+
+
+# inputs that used to throw error recovery off, by the number of
+# repetitions of their pattern
+PATHOLOGICAL = {
+    'open-parens': lambda n: 'void main(void) { int x; x = ' + '(' * n,
+    'close-parens': lambda n: 'void main(void) { int x; x = 1' + ')' * n,
+    'open-braces': lambda n: 'void main(void) { ' + '{ ' * n,
+    'close-braces': lambda n: '} ' * n,
+    'open-statements': lambda n: 'void main(void) { ' +
+    'if (1) while (1) ' * n,
+    'open-switches': lambda n: 'void main(void) { ' +
+    'switch (1) { case 1: ' * n,
+    'missing-semicolons': lambda n: 'void main(void) { int x; ' + 'x = 1 ' * n,
+    'declarations': lambda n: 'int ' * n,
+    'after-the-end': lambda n: 'void main(void) { } ' + 'x = 1; ' * n,
+    'garbage': lambda n: ''.join(random.Random(n).choice('@$!?~`^|')
+                                 for _ in range(n)),
+    'token-soup': lambda n: ' '.join(random.Random(n).choice(
+        ('int', 'void', 'x', '1', '(', ')', '{', '}', '[', ']', ';', ',', '=',
+         '+', '<', '==', 'if', 'else', 'while', 'switch', 'case', 'default',
+         ':', 'return', 'break', 'continue')) for _ in range(n)),
+}
+# allowed growth of the compile time from n to 4n repetitions, against 4
+# for linear time
+MAX_GROWTH = 8.0
+
+
+def mutate(source, random, edits):
+    """Returns source with edits random deletions, duplications and
+    insertions of characters, cut off at a random point half the time."""
+    for _ in range(edits):
+        if not source:
+            break
+        position = random.randrange(len(source))
+        kind = random.randrange(3)
+        if kind == 0:
+            source = source[:position] + source[position + 1:]
+        elif kind == 1:
+            end = min(len(source), position + random.randint(1, 20))
+            source = source[:end] + source[position:]
+        else:
+            source = source[:position] + random.choice('(){}[];,=+-*<@$') + \
+                source[position:]
+    if random.random() < 0.5:
+        source = source[:random.randrange(len(source) + 1)]
+    return source
+
+
+def fuzz_corpus(count=50, seed=0, size=200):
+    """Yields (name, source) of the pathological inputs with size
+    repetitions and of count mutated random programs."""
+    for name, make in sorted(PATHOLOGICAL.items()):
+        yield name, make(size)
+    r = random.Random(seed)
+    for i in range(count):
+        source = ProgramGenerator(seed + i, functions=r.randint(1, 5),
+                                  error_rate=r.random() * 0.3,
+                                  dense_switches=0.3).generate()
+        yield 'mutated-%d' % i, mutate(source, r, r.randint(1, 30))
+
+
+def run_fuzz(compiler, count=50, seed=0, size=1000, repeat=3):
+    """Compiles the fuzz corpus and times every pathological input at size
+    and 4 * size repetitions. Returns the failures as (name, message):
+    compiles that raised and inputs whose compile time grew more than
+    MAX_GROWTH times."""
+    failures = []
+    for name, source in fuzz_corpus(count, seed):
+        try:
+            compiler.compile(source)
+        except Exception as e:
+            failures.append((name, '%s: %s' % (type(e).__name__, e)))
+    for name, make in sorted(PATHOLOGICAL.items()):
+        times = []
+        for n in (size, 4 * size):
+            source = make(n)
+            try:
+                times.append(best_of(repeat,
+                                     lambda: compiler.compile(source))[0])
+            except Exception as e:
+                failures.append((name, '%s: %s' % (type(e).__name__, e)))
+                break
+        else:
+            growth = times[1] / max(times[0], 1e-6)
+            if growth > MAX_GROWTH:
+                failures.append((name, 'compile time grew %.1f times from '
+                                       '%d to %d repetitions' % (
+                                           growth, size, 4 * size)))
+    return failures
+
+
+def main(argv=None):
+    arguments = argparse.ArgumentParser(
+        description='Times the compiler on generated programs.')
+    arguments.add_argument('-s', '--scenario', action='append',
+                           choices=sorted(SCENARIOS),
+                           help='scenarios to run (default: all)')
+    arguments.add_argument('--scale', type=float, default=1.0,
+                           help='multiplies the number of functions')
+    arguments.add_argument('--repeat', type=int, default=3)
+    arguments.add_argument('--seed', type=int, default=0)
+    arguments.add_argument('--optimize', action='store_true')
+    arguments.add_argument('--no-memory', action='store_true',
+                           help='skip the slow peak memory measurement')
+    arguments.add_argument('--save', metavar='FILE',
+                           help='store the results as a baseline')
+    arguments.add_argument('--baseline', metavar='FILE',
+                           help='fail on regressions against this baseline')
+    arguments.add_argument('--threshold', type=float, default=THRESHOLD)
+    arguments.add_argument('--write-program', metavar='FILE',
+                           help='write the program of the first scenario '
+                                'and exit')
+    arguments.add_argument('--fuzz', action='store_true',
+                           help='check that malformed inputs compile in '
+                                'linear time instead')
+    arguments.add_argument('--write-fuzz', metavar='DIR',
+                           help='write the fuzz corpus and exit')
+    options = arguments.parse_args(argv)
+    names = options.scenario or sorted(SCENARIOS)
+
+    if options.write_fuzz:
+        os.makedirs(options.write_fuzz, exist_ok=True)
+        for name, source in fuzz_corpus(seed=options.seed):
+            with open(os.path.join(options.write_fuzz, name + '.txt'),
+                      'w') as f:
+                f.write(source)
+        return 0
+
+    if options.fuzz:
+        failures = run_fuzz(Compiler(), seed=options.seed,
+                            repeat=options.repeat)
+        for name, message in failures:
+            sys.stdout.write('FAILED %s: %s\n' % (name, message))
+        sys.stdout.write('%d failures\n' % len(failures))
+        return 1 if failures else 0
+
+    if options.write_program:
+        arguments = dict(SCENARIOS[names[0]])
+        arguments['functions'] = max(
+            1, int(arguments['functions'] * options.scale))
+        with open(options.write_program, 'w') as f:
+            f.write(ProgramGenerator(options.seed, **arguments).generate())
+        return 0
+
+    results = run_scenarios(names, options.scale, options.repeat,
+                            PASSES if options.optimize else None,
+                            options.seed, not options.no_memory)
+    sys.stdout.write(format_results(results))
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.threshold)
+        for name, metric, old, new in regressions:
+            sys.stdout.write('REGRESSION %s %s: %g -> %g (+%.0f%%)\n' % (
+                name, metric, old, new, (new / old - 1) * 100))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
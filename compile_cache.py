@@ -0,0 +1,178 @@
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+from collections import defaultdict
+
+from grammar_compiler import cache_key
+
+# bump whenever the layout of a cache entry changes
+ENTRY_VERSION = 1
+ENTRY_MAGIC = b'CPCACHE'
+ENTRY_SUFFIX = '.entry'
+DEFAULT_MAX_SIZE = 256 << 20
+# eviction goes below the bound by this fraction so it is not run on
+# every store
+LOW_WATER = 0.8
+
+# the modules whose code decides what a compile produces
+COMPILER_MODULES = ('scanner', 'parser', 'grammar_compiler',
+                    'intermediate_code_generator', 'symbol_table',
+                    'program_block', 'optimizer', 'data_layout',
+                    'interprocedural')
+
+compiler_digest = None
+
+
+def compiler_version():
+    """Returns a digest of the compiler's own code, so entries written by
+    any other version of it are never used."""
+    global compiler_digest
+    if compiler_digest is None:
+        digest = hashlib.sha256()
+        for name in COMPILER_MODULES:
+            __import__(name)
+            with open(sys.modules[name].__file__, 'rb') as f:
+                digest.update(f.read())
+        compiler_digest = digest.hexdigest()
+    return compiler_digest
+
+
+def table_key(parse_table):
+    key = getattr(parse_table, 'source_key', None)
+    if key is None:
+        key = hashlib.sha256(pickle.dumps(
+            (parse_table.table, parse_table.start_rows,
+             parse_table.terminal_ids), pickle.HIGHEST_PROTOCOL)).hexdigest()
+    return key
+
+
+class CompileCache(object):
+    """Compile results on disk, addressed by a hash of everything that
+    decides them.
+
+    Every entry is a file written to a temporary name and renamed into
+    place, so any number of processes can share the directory: a reader
+    sees a whole entry or none. A hit refreshes the entry's modification
+    time and stores evict the least recently used entries once the
+    directory grows past max_size bytes.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        # bytes this process believes the cache holds, None until counted
+        self.size = None
+
+    def key(self, source, parse_table, optimization_passes=None,
+            max_errors=None):
+        return cache_key(str(ENTRY_VERSION), compiler_version(),
+                         table_key(parse_table),
+                         ' '.join(optimization_passes or ()),
+                         str(max_errors), source)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ENTRY_SUFFIX)
+
+    def load(self, key):
+        """Returns the (program_block, scanner_errors, parser_errors,
+        semantic_errors, layout) stored under key, or None."""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(ENTRY_MAGIC)) != ENTRY_MAGIC:
+                    return None
+                version, stored_key, program_block, errors, layout = \
+                    pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+                AttributeError, ImportError):
+            return None
+        if version != ENTRY_VERSION or stored_key != key:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        tables = []
+        for items in errors:
+            table = defaultdict(list)
+            for line_number, messages in items:
+                table[line_number] = messages
+            tables.append(table)
+        return (program_block,) + tuple(tables) + (layout,)
+
+    def store(self, key, program_block, scanner_errors, parser_errors,
+              semantic_errors, layout):
+        errors = [list(table.items()) for table in (scanner_errors,
+                                                    parser_errors,
+                                                    semantic_errors)]
+        data = ENTRY_MAGIC + pickle.dumps(
+            (ENTRY_VERSION, key, program_block, errors, layout),
+            pickle.HIGHEST_PROTOCOL)
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        temp_path = None
+        replaced = 0
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            try:
+                # an entry stored again under the same key replaces it
+                replaced = os.stat(path).st_size
+            except OSError:
+                pass
+            os.replace(temp_path, path)
+            temp_path = None
+        except OSError:
+            # the cache is only an optimization, compiling goes on without it
+            return
+        finally:
+            # entries() skips temporary files, so eviction never would
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        else:
+            self.size += len(data) - replaced
+        if self.size > self.max_size:
+            self.evict(int(self.max_size * LOW_WATER))
+
+    def entries(self):
+        """Returns (path, size, modification time) of every entry."""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(ENTRY_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, status.st_size, status.st_mtime))
+        return entries
+
+    def evict(self, target_size):
+        """Removes the least recently used entries until at most
+        target_size bytes are left."""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        for path, entry_size, _ in entries:
+            if size <= target_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # another process got there first
+                pass
+            size -= entry_size
+        self.size = size
+
+    def clear(self):
+        self.evict(0)
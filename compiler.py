@@ -0,0 +1,78 @@
+import io
+import os
+
+from grammar_compiler import load_parse_table
+from parse_tree import build_parse_tree
+from parser import Diagram, format_errors, parse_source
+
+GRAMMAR_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'grammar.txt')
+
+
+class CompileResult(object):
+    """The program and the errors of one compile.
+
+    The error tables map a line index to the messages reported on it, as
+    returned by Parser.parse.
+    """
+
+    def __init__(self, program_block, scanner_errors, parser_errors,
+                 semantic_errors, layout):
+        self.program_block = program_block
+        self.scanner_errors = scanner_errors
+        self.parser_errors = parser_errors
+        self.semantic_errors = semantic_errors
+        self.layout = layout
+
+    @property
+    def is_ok(self):
+        return not (self.scanner_errors or self.parser_errors or
+                    self.semantic_errors)
+
+    def errors(self):
+        """Returns the errors in the format of the error file."""
+        return format_errors(self.scanner_errors, self.parser_errors,
+                             self.semantic_errors)
+
+    def code(self):
+        """Returns the program in the format of the output file."""
+        f = io.StringIO()
+        self.program_block.write_text(f)
+        return f.getvalue()
+
+
+class Compiler(object):
+    """Compiles sources against grammar tables built once.
+
+    The parse table is loaded when the compiler is created and only read
+    afterwards. Every compile gets a session of its own (a Diagram with
+    the parser stack and the code generator), so one Compiler can be
+    shared by any number of threads.
+    """
+
+    def __init__(self, grammar_file=GRAMMAR_FILE, first_set_file=None,
+                 follow_set_file=None, parse_table=None, cache=None,
+                 max_errors=None):
+        if parse_table is None:
+            parse_table = load_parse_table(grammar_file, first_set_file,
+                                           follow_set_file)
+        self.parse_table = parse_table
+        self.cache = cache
+        self.max_errors = max_errors
+
+    def session(self):
+        """Returns fresh per-compile state for one source."""
+        return Diagram(self.parse_table)
+
+    def compile(self, source, optimization_passes=None, profile=None):
+        """Compiles source, a string or a text stream, into a CompileResult
+        without touching the filesystem (other than the cache, if any).
+        With an instrumentation.Profile the compile is counted in it."""
+        return CompileResult(*parse_source(self.parse_table, source,
+                                           optimization_passes, self.cache,
+                                           profile, self.max_errors))
+
+    def parse_tree(self, source):
+        """Returns the ParseTree of source and the Parser holding its
+        errors."""
+        return build_parse_tree(self.parse_table, source)
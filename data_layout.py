@@ -0,0 +1,255 @@
+import heapq
+from bisect import bisect_right
+
+from optimizer import load, find_leaders, READS, DESTINATIONS, TARGETS
+from program_block import OPCODES, DIRECT, INDIRECT, ADDRESS, LABEL
+
+
+class DataLayout(object):
+    """Where globals, function frames and temporaries were placed.
+
+    regions holds (kind, owner, start, end) tuples in address order, and
+    peak is the first address past everything the program uses.
+    """
+
+    def __init__(self, regions, temporaries):
+        self.regions = regions
+        self.temporaries = temporaries
+        self.peak = temporaries[1]
+
+    def report(self):
+        lines = []
+        for kind, owner, start, end in self.regions:
+            name = kind if owner is None else '%s %s' % (kind, owner)
+            lines.append('%s: %d-%d (%d words)' % (name, start, end - 1,
+                                                   end - start))
+        lines.append('peak: %d' % self.peak)
+        return '\n'.join(lines) + '\n'
+
+
+def temporary_operands(instruction):
+    """Returns the operands of instruction that use or define an address."""
+    uses = [instruction[i] for i in READS[instruction[0]]]
+    defines = []
+    destination = DESTINATIONS.get(instruction[0])
+    if destination:
+        mode, address = instruction[destination]
+        if mode == DIRECT:
+            defines.append(address)
+        else:
+            uses.append((DIRECT, address))
+    if instruction[0] == 'JP' and instruction[1][0] == INDIRECT:
+        uses.append((DIRECT, instruction[1][1]))
+    return [address for mode, address in uses
+            if mode in (DIRECT, INDIRECT)], defines
+
+
+def is_call(code, index):
+    """Whether the JP at index is a call, i.e. follows the store of its
+    return address."""
+    previous = code[index - 1] if index else None
+    return previous is not None and previous[0] == 'ASSIGN' and \
+        previous[1] == (LABEL, index + 1)
+
+
+def live_intervals(code, low, high):
+    """Returns {temporary: (first, last)} covering every point where the
+    temporary is live, with the use of instruction i at point 2i and its
+    definition at 2i + 1.
+
+    Liveness is solved over basic blocks of each function on its own: a
+    call continues at its return address and a return (an indirect jump)
+    leaves the function. Temporaries never outlive the function that
+    computes them, so this is exact as long as functions do not share
+    temporary addresses.
+    """
+    end = len(code)
+    leaders = sorted(leader for leader in find_leaders(code) if leader < end)
+    blocks = list(zip(leaders, leaders[1:] + [end]))
+    block_of = dict((start, b) for b, (start, _) in enumerate(blocks))
+
+    operands = []
+    gen = []
+    kill = []
+    successors = []
+    for start, stop in blocks:
+        block_gen = set()
+        block_kill = set()
+        for index in range(start, stop):
+            uses, defines = temporary_operands(code[index])
+            uses = [t for t in uses if low <= t < high]
+            defines = [t for t in defines if low <= t < high]
+            operands.append((uses, defines))
+            block_gen.update(t for t in uses if t not in block_kill)
+            block_kill.update(defines)
+        gen.append(block_gen)
+        kill.append(block_kill)
+
+        last = code[stop - 1]
+        target = TARGETS.get(last[0])
+        following = [block_of[stop]] if stop < end else []
+        if not target:
+            successors.append(following)
+            continue
+        mode, address = last[target]
+        if mode != DIRECT:
+            successors.append([])
+        elif is_call(code, stop - 1):
+            successors.append(following)
+        else:
+            jumps = [block_of[address]] if address < end else []
+            successors.append(jumps if last[0] == 'JP' else following + jumps)
+
+    predecessors = [[] for _ in blocks]
+    for b, targets in enumerate(successors):
+        for s in targets:
+            predecessors[s].append(b)
+
+    live_in = [set(block_gen) for block_gen in gen]
+    live_out = [set() for _ in blocks]
+    pending = list(range(len(blocks)))
+    queued = set(pending)
+    while pending:
+        b = pending.pop()
+        queued.discard(b)
+        out = set()
+        for s in successors[b]:
+            out |= live_in[s]
+        live_out[b] = out
+        new_in = gen[b] | (out - kill[b])
+        if new_in != live_in[b]:
+            live_in[b] = new_in
+            for p in predecessors[b]:
+                if p not in queued:
+                    queued.add(p)
+                    pending.append(p)
+
+    intervals = {}
+
+    def extend(temporary, point):
+        interval = intervals.get(temporary)
+        if interval is None:
+            intervals[temporary] = (point, point)
+        elif point < interval[0]:
+            intervals[temporary] = (point, interval[1])
+        elif point > interval[1]:
+            intervals[temporary] = (interval[0], point)
+
+    for b, (start, stop) in enumerate(blocks):
+        for temporary in live_in[b]:
+            extend(temporary, 2 * start)
+        for temporary in live_out[b]:
+            extend(temporary, 2 * stop - 1)
+        for index in range(start, stop):
+            uses, defines = operands[index]
+            for temporary in uses:
+                extend(temporary, 2 * index)
+            for temporary in defines:
+                extend(temporary, 2 * index + 1)
+    return intervals
+
+
+def assign_slots(intervals):
+    """Linear scan: gives temporaries whose intervals never overlap the
+    same slot. Returns ({temporary: slot}, number of slots)."""
+    slots = {}
+    active = []
+    free = []
+    count = 0
+    for temporary, (start, end) in sorted(intervals.items(),
+                                          key=lambda item: item[1]):
+        while active and active[0][0] < start:
+            heapq.heappush(free, heapq.heappop(active)[1])
+        if free:
+            slot = heapq.heappop(free)
+        else:
+            slot = count
+            count += 1
+        slots[temporary] = slot
+        heapq.heappush(active, (end, slot))
+    return slots, count
+
+
+def plan_layout(program_block, allocations, frames, data_base, temporaries,
+                temporary_frames=()):
+    """Moves data and temporaries of program_block into compact regions.
+
+    allocations lists the (start, size, frame) data blocks the generator
+    handed out in address order, frame being an index into frames or None
+    for globals, and temporary_frames the (first temporary, frame) runs the
+    temporaries were created in. Globals are placed first, then every
+    frame, then a pool of temporaries per frame; when program_block is
+    complete, temporaries of a frame that are never live at the same time
+    share an address. Rewrites program_block in place and returns the
+    DataLayout.
+    """
+    low, high = temporaries
+    owners = [None] + list(range(len(frames)))
+
+    groups = dict((frame, []) for frame in owners)
+    for allocation in allocations:
+        groups[allocation[2]].append(allocation)
+    order = []
+    for frame in owners:
+        order.extend(groups[frame])
+    moved = {}
+    regions = []
+    address = data_base
+    for start, size, frame in order:
+        moved[start] = address
+        kind, owner = ('globals', None) if frame is None else \
+            ('frame', frames[frame])
+        if regions and regions[-1][:2] == (kind, owner) and \
+                regions[-1][3] == address:
+            regions[-1] = (kind, owner, regions[-1][2], address + size)
+        else:
+            regions.append((kind, owner, address, address + size))
+        address += size
+    data_end = address
+    starts = [start for start, _, _ in allocations]
+    old_end = allocations[-1][0] + allocations[-1][1] if allocations \
+        else data_base
+
+    code = load(program_block)
+    if code is not None:
+        firsts = [first for first, _ in temporary_frames]
+        pools = dict((frame, {}) for frame in owners)
+        for temporary, interval in live_intervals(code, low, high).items():
+            run = bisect_right(firsts, temporary) - 1
+            frame = temporary_frames[run][1] if run >= 0 else None
+            pools[frame][temporary] = interval
+        slots = {}
+        address = data_end
+        for frame in owners:
+            pool, count = assign_slots(pools[frame])
+            for temporary, slot in pool.items():
+                slots[temporary] = address + slot
+            if count:
+                regions.append(('temporaries', None if frame is None
+                                else frames[frame], address, address + count))
+            address += count
+    else:
+        slots = dict((temporary, data_end + temporary - low)
+                     for temporary in range(low, high))
+        address = data_end + high - low
+        if high > low:
+            regions.append(('temporaries', None, data_end, address))
+
+    opcodes = program_block.opcodes
+    modes = program_block.modes
+    values = program_block.values
+    for index in range(len(opcodes)):
+        target = TARGETS.get(OPCODES[opcodes[index]])
+        for i in range(3):
+            position = index * 3 + i
+            mode = modes[position]
+            if mode not in (DIRECT, INDIRECT, ADDRESS) or \
+                    mode == DIRECT and target == i + 1:
+                continue
+            value = values[position]
+            if low <= value < high:
+                values[position] = slots[value]
+            elif data_base <= value < old_end:
+                start = starts[bisect_right(starts, value) - 1]
+                values[position] = moved[start] + value - start
+    return DataLayout(regions, (data_end, address))
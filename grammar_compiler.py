@@ -0,0 +1,318 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import defaultdict
+
+from intermediate_code_generator import ROUTINES, ROUTINE_IDS
+
+# bump whenever ParseTable changes shape so stale caches are rebuilt
+TABLE_VERSION = 2
+CACHE_MAGIC = b'CPTABLE'
+
+# kinds of entries in the action table
+POP, ROUTINE, MOVE, MATCH, MATCH_TOKEN, MATCH_NUMBER, PUSH, MISSING, \
+    UNEXPECTED = range(9)
+
+
+class GrammarException(Exception):
+    def __init__(self, message):
+        self.message = message
+        super(GrammarException, self).__init__(message)
+
+
+def parse_grammar(text):
+    grammar = defaultdict(list)
+    for rule in text.splitlines():
+        rule = rule.strip()
+        if not rule:
+            continue
+        lhs, rhs = rule.split(' -> ')
+        grammar[lhs] = [rr.split(' ') for rr in rhs.split(' | ')]
+    return grammar
+
+
+def parse_symbol_sets(text):
+    symbol_sets = defaultdict(list)
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        lhs, *rhs = line.split(' ')
+        symbol_sets[lhs] = rhs
+    return symbol_sets
+
+
+def is_action(part):
+    return part.startswith('#')
+
+
+def first_of_sequence(sequence, grammar, first_set):
+    result = set()
+    for part in sequence:
+        if is_action(part) or part == 'eps':
+            continue
+        if part not in grammar:
+            result.add(part)
+            return result
+        result.update(first_set[part])
+        if 'eps' not in first_set[part]:
+            result.discard('eps')
+            return result
+        result.discard('eps')
+    result.add('eps')
+    return result
+
+
+def compute_first_sets(grammar):
+    first_set = dict((non_terminal, set()) for non_terminal in grammar)
+    changed = True
+    while changed:
+        changed = False
+        for non_terminal, rules in grammar.items():
+            for rule in rules:
+                first = first_of_sequence(rule, grammar, first_set)
+                if not first <= first_set[non_terminal]:
+                    first_set[non_terminal] |= first
+                    changed = True
+    return first_set
+
+
+def compute_follow_sets(grammar, first_set):
+    follow_set = dict((non_terminal, set()) for non_terminal in grammar)
+    changed = True
+    while changed:
+        changed = False
+        for non_terminal, rules in grammar.items():
+            for rule in rules:
+                for i, part in enumerate(rule):
+                    if part not in grammar:
+                        continue
+                    follow = first_of_sequence(rule[i + 1:], grammar,
+                                               first_set)
+                    if 'eps' in follow:
+                        follow.discard('eps')
+                        follow |= follow_set[non_terminal]
+                    if not follow <= follow_set[part]:
+                        follow_set[part] |= follow
+                        changed = True
+    return follow_set
+
+
+class ParseTable(object):
+    """The grammar's transition graphs compiled into one LL(1) table.
+
+    Every (non-terminal, state) pair gets a row with one entry per terminal,
+    so a parser stack holds row offsets and a step is a single lookup at
+    table[row + terminal_id]. FIRST and FOLLOW are kept as bitsets over
+    the terminal ids.
+    """
+
+    def __init__(self, grammar, first_set, follow_set):
+        self.non_terminals = list(grammar.keys())
+        for rules in grammar.values():
+            for rule in rules:
+                for part in rule:
+                    if is_action(part) and part[1:] not in ROUTINE_IDS:
+                        raise GrammarException(
+                            "Unknown semantic routine '%s'." % part)
+
+        terminals = set(['$'])
+        for rules in grammar.values():
+            for rule in rules:
+                terminals.update(part for part in rule
+                                 if part not in grammar and part != 'eps' and
+                                 not is_action(part))
+        for sets in (first_set, follow_set):
+            for symbols in sets.values():
+                terminals.update(symbol for symbol in symbols
+                                 if symbol != 'eps')
+        self.terminals = sorted(terminals)
+        self.terminal_ids = dict((terminal, i)
+                                 for i, terminal in enumerate(self.terminals))
+        # column for tokens the grammar never mentions
+        self.other_terminal = len(self.terminals)
+        self.epsilon_bit = 1 << (len(self.terminals) + 1)
+
+        self.first_bits = dict((symbol, self.to_bits(symbols))
+                               for symbol, symbols in first_set.items())
+        self.follow_bits = dict((symbol, self.to_bits(symbols))
+                                for symbol, symbols in follow_set.items())
+
+        self.compile_table(grammar)
+
+    def to_bits(self, symbols):
+        bits = 0
+        for symbol in symbols:
+            if symbol == 'eps':
+                bits |= self.epsilon_bit
+            else:
+                bits |= 1 << self.terminal_ids[symbol]
+        return bits
+
+    @staticmethod
+    def create_graph(rules):
+        graph = defaultdict(dict)
+        current_state = 2
+        for rule in rules:
+            last_state = 0
+            for part in rule[:-1]:
+                graph[last_state].update({part: current_state})
+                last_state = current_state
+                current_state += 1
+            graph[last_state].update({rule[-1]: 1})
+        return graph, 1
+
+    def compile_table(self, grammar):
+        width = len(self.terminals) + 1
+        graphs = {}
+        self.start_rows = {}
+        number_of_rows = 0
+        for non_terminal in grammar.keys():
+            graph, accept_state = ParseTable.create_graph(
+                grammar[non_terminal])
+            number_of_states = max(max(graph.keys()), accept_state) + 1
+            graphs[non_terminal] = graph, accept_state, number_of_states
+            self.start_rows[non_terminal] = number_of_rows * width
+            number_of_rows += number_of_states
+
+        self.width = width
+        self.table = [None] * (number_of_rows * width)
+        entries = {}
+        for non_terminal, (graph, accept_state, number_of_states) in \
+                graphs.items():
+            base = self.start_rows[non_terminal]
+            for state in range(number_of_states):
+                for terminal_id in range(width):
+                    if state == accept_state:
+                        entry = (POP, None, None)
+                    else:
+                        entry = self.compile_action(
+                            non_terminal, graph[state], terminal_id)
+                        if entry[1] is not None:
+                            entry = (entry[0], base + entry[1] * width,
+                                     entry[2])
+                    entry = entries.setdefault(entry, entry)
+                    self.table[base + state * width + terminal_id] = entry
+
+    def compile_action(self, non_terminal, edges, terminal_id):
+        terminal_bit = 1 << terminal_id
+        for key, value in edges.items():
+            if is_action(key):
+                return ROUTINE, value, ROUTINE_IDS[key[1:]]
+
+            if key not in self.start_rows:
+                if key == 'eps' and \
+                        terminal_bit & self.follow_bits.get(non_terminal, 0):
+                    return MOVE, value, None
+
+                if key in self.terminal_ids and \
+                        terminal_id == self.terminal_ids[key]:
+                    if key in ('int', 'void', 'ID'):
+                        return MATCH_TOKEN, value, key
+                    if key == 'NUM':
+                        return MATCH_NUMBER, value, key
+                    return MATCH, value, key
+                continue
+
+            first = self.first_bits.get(key, 0)
+            if terminal_bit & first or \
+                    (first & self.epsilon_bit and
+                     terminal_bit & self.follow_bits.get(key, 0)):
+                return PUSH, value, key
+
+        key, value = list(edges.items())[0]
+        if key not in self.start_rows or \
+                terminal_bit & self.follow_bits.get(key, 0):
+            return MISSING, value, "Syntax Error! Missing #%s" % key
+        return UNEXPECTED, None, None
+
+
+def read_text(path):
+    with open(path) as f:
+        return f.read()
+
+
+def cache_key(*texts):
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(b'\0' if text is None else text.encode('utf-8') + b'\1')
+    return digest.hexdigest()
+
+
+def load_cached_table(path):
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return None
+            version, table = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+            AttributeError, ImportError):
+        return None
+    if version != TABLE_VERSION:
+        return None
+    return table
+
+
+def store_cached_table(path, table):
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(CACHE_MAGIC)
+            pickle.dump((TABLE_VERSION, table), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except OSError:
+        # the cache is only an optimization, a read-only tree still compiles
+        pass
+
+
+def build_parse_table(grammar_text, first_set_text=None, follow_set_text=None):
+    grammar = parse_grammar(grammar_text)
+    if first_set_text is None or follow_set_text is None:
+        first_set = compute_first_sets(grammar)
+        follow_set = compute_follow_sets(grammar, first_set)
+    if first_set_text is not None:
+        first_set = parse_symbol_sets(first_set_text)
+    if follow_set_text is not None:
+        follow_set = parse_symbol_sets(follow_set_text)
+    return ParseTable(grammar, first_set, follow_set)
+
+
+def load_parse_table(grammar_file, first_set_file=None, follow_set_file=None,
+                     cache_dir=None):
+    """Returns the ParseTable for grammar_file, using the on-disk cache.
+
+    FIRST and FOLLOW are derived from the grammar unless set files are
+    given. The compiled table is cached under cache_dir (by default a
+    .grammar_cache directory next to the grammar) keyed by the content of
+    all inputs; pass cache_dir=False to disable the cache.
+    """
+    grammar_text = read_text(grammar_file)
+    first_set_text = read_text(first_set_file) if first_set_file else None
+    follow_set_text = read_text(follow_set_file) if follow_set_file else None
+
+    if cache_dir is False:
+        table = build_parse_table(grammar_text, first_set_text,
+                                  follow_set_text)
+        table.source_key = cache_key(grammar_text, first_set_text,
+                                     follow_set_text)
+        return table
+
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.path.dirname(os.path.abspath(grammar_file)), '.grammar_cache')
+    path = os.path.join(cache_dir, '%s.table' % cache_key(
+        str(TABLE_VERSION), ' '.join(ROUTINES), grammar_text, first_set_text,
+        follow_set_text))
+
+    table = load_cached_table(path)
+    if table is None:
+        table = build_parse_table(grammar_text, first_set_text,
+                                  follow_set_text)
+        store_cached_table(path, table)
+    # identifies the inputs the table was built from, e.g. for compile caches
+    table.source_key = cache_key(grammar_text, first_set_text,
+                                 follow_set_text)
+    return table
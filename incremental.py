@@ -0,0 +1,419 @@
+from itertools import chain
+
+from compiler import CompileResult
+from grammar_compiler import ROUTINE, POP, PUSH
+from intermediate_code_generator import IntermediateCodeGenerator, \
+    SemanticException
+from optimizer import TARGETS
+from parser import Diagram, Parser
+from program_block import OPCODES, EMPTY, DIRECT, INDIRECT, RAW, LABEL, \
+    ADDRESS
+from scanner import TokenStream, match
+from symbol_table import SymbolTable, shape
+
+# terminals that may follow a declaration without changing how the parser
+# finishes it: the start of the next declaration or the end of the input
+SETTLE_TERMINALS = ('int', 'void', '$')
+SKIPPED = (None, 'W', 'COMMENT')
+
+
+class RecordingSymbolTable(SymbolTable):
+    """A SymbolTable that, while recording, notes the global declarations
+    made and the globals from before looked up."""
+
+    def __init__(self):
+        super(RecordingSymbolTable, self).__init__()
+        self.recording = False
+        self.declared = []
+        self.own = set()
+        self.imports = {}
+
+    def start(self):
+        self.recording = True
+        self.declared = []
+        self.own = set()
+        self.imports = {}
+
+    def stop(self):
+        self.recording = False
+
+    def note(self, name):
+        if name in self.own or name in self.imports:
+            return
+        bindings = self.bindings.get(name)
+        if bindings and bindings[-1][0] > 0:
+            # a local of the declaration being recorded
+            return
+        self.imports[name] = bindings[-1][1] if bindings else None
+
+    def declare(self, name, scope, entry):
+        if self.recording and scope == 0:
+            self.declared.append((name, entry))
+            self.own.add(name)
+        super(RecordingSymbolTable, self).declare(name, scope, entry)
+
+    def lookup(self, name):
+        if self.recording:
+            self.note(name)
+        return super(RecordingSymbolTable, self).lookup(name)
+
+    def __contains__(self, name):
+        if self.recording:
+            self.note(name)
+        return super(RecordingSymbolTable, self).__contains__(name)
+
+
+def terminal_of(token_type, token):
+    return token if token_type in ('SYMBOL', 'KEYWORD') else token_type
+
+
+class Piece(object):
+    """A top-level declaration (or the text after the last one) with the
+    comments and whitespace before it."""
+
+    def __init__(self, text, first_terminal):
+        self.text = text
+        self.first_terminal = first_terminal
+        self.lines = text.count('\n')
+
+
+def split_declarations(text, start, sync=()):
+    """Splits text from start into Pieces ending after a ';' or '}' at
+    brace depth 0.
+
+    Stops early at a piece boundary in sync. Returns (pieces, stop, tail)
+    where stop is that boundary, or None and tail is the Piece after the
+    last declaration.
+    """
+    pieces = []
+    depth = 0
+    pointer = piece_start = start
+    first = None
+    length = len(text)
+    while pointer < length:
+        token_type, end = match(text, pointer)
+        if token_type not in SKIPPED:
+            token = text[pointer:end]
+            if first is None:
+                first = terminal_of(token_type, token)
+            if token == '{':
+                depth += 1
+            elif token == '}' or token == ';':
+                if token == '}':
+                    depth -= 1
+                if depth <= 0:
+                    depth = 0
+                    pieces.append(Piece(text[piece_start:end], first))
+                    piece_start = end
+                    first = None
+                    if end in sync:
+                        return pieces, end, None
+        pointer = end
+    return pieces, None, Piece(text[piece_start:], first)
+
+
+class Fragment(object):
+    """The code, data and declarations generated for one top-level
+    declaration, in the addresses it was first compiled at."""
+
+    def __init__(self, icg, snapshot, stack):
+        program_block = icg.program_block
+        (self.code_start, raw_start, self.data_start, self.temporary_start,
+         self.frame_start, allocation_start, run_start,
+         function_start, table_start) = snapshot
+        code_end = len(program_block)
+        self.opcodes = program_block.opcodes[self.code_start:code_end]
+        self.modes = program_block.modes[self.code_start * 3:code_end * 3]
+        self.values = program_block.values[self.code_start * 3:code_end * 3]
+        self.raw_start = raw_start
+        self.raw = program_block.raw[raw_start:]
+        self.data_end = icg.data_ptr
+        self.temporary_end = icg.temporary_ptr
+        self.frames = icg.frames[self.frame_start:]
+        self.allocations = icg.allocations[allocation_start:]
+        self.temporary_frames = icg.temporary_frames[run_start:]
+        self.functions = icg.functions[function_start:]
+        self.jump_tables = icg.jump_tables[table_start:]
+        self.declared = icg.symbol_table.declared
+        self.imports = icg.symbol_table.imports
+        self.stack = stack
+
+    def relink(self, icg, diagram, prologue):
+        """Appends the fragment to the state of icg and diagram, moving its
+        addresses to where the code and data now end. Returns False, with
+        nothing changed, when the globals it uses changed shape."""
+        table = icg.symbol_table
+        code_map = {}
+        data_map = {}
+        for name, old in self.imports.items():
+            new = SymbolTable.lookup(table, name)
+            if shape(new) != shape(old):
+                return False
+            if old is None:
+                continue
+            if old[0] == 'func':
+                code_map[old[1]] = new[1]
+                for i in range(old[4] + 2):
+                    data_map[old[2] + i] = new[2] + i
+            else:
+                data_map[old[1]] = new[1]
+
+        program_block = icg.program_block
+        code_start = self.code_start
+        code_end = code_start + len(self.opcodes)
+        code_delta = len(program_block) - code_start
+        data_start = self.data_start
+        data_end = self.data_end
+        data_delta = icg.data_ptr - data_start
+        temporary_start = self.temporary_start
+        temporary_end = self.temporary_end
+        temporary_delta = icg.temporary_ptr - temporary_start
+        raw_delta = len(program_block.raw) - self.raw_start
+        prologue_code, prologue_data = prologue
+
+        modes = self.modes
+        values = self.values[:]
+        for index in range(len(self.opcodes)):
+            target = TARGETS.get(OPCODES[self.opcodes[index]])
+            for i in range(3):
+                position = index * 3 + i
+                mode = modes[position]
+                value = values[position]
+                if mode == LABEL or mode == DIRECT and target == i + 1:
+                    if code_start <= value <= code_end:
+                        value += code_delta
+                    elif value in code_map:
+                        value = code_map[value]
+                    elif value >= prologue_code:
+                        return False
+                elif mode in (DIRECT, INDIRECT, ADDRESS):
+                    if temporary_start <= value < temporary_end:
+                        value += temporary_delta
+                    elif data_start <= value < data_end:
+                        value += data_delta
+                    elif value in data_map:
+                        value = data_map[value]
+                    elif value >= prologue_data:
+                        return False
+                elif mode == RAW:
+                    value += raw_delta
+                else:
+                    continue
+                values[position] = value
+
+        program_block.opcodes.extend(self.opcodes)
+        program_block.modes.extend(modes)
+        program_block.values.extend(values)
+        program_block.raw.extend(self.raw)
+
+        frame_delta = len(icg.frames) - self.frame_start
+        icg.frames.extend(self.frames)
+        icg.allocations.extend(
+            (start + data_delta, size,
+             None if frame is None else frame + frame_delta)
+            for start, size, frame in self.allocations)
+        for first, frame in self.temporary_frames:
+            if frame is not None:
+                frame += frame_delta
+            if not icg.temporary_frames or \
+                    icg.temporary_frames[-1][1] != frame:
+                icg.temporary_frames.append((first + temporary_delta, frame))
+        icg.functions.extend(
+            (start + code_delta, end + code_delta, return_slot + data_delta,
+             frame + frame_delta)
+            for start, end, return_slot, frame in self.functions)
+        icg.jump_tables.extend(
+            (start + data_delta, [entry + code_delta for entry in entries])
+            for start, entries in self.jump_tables)
+        icg.data_ptr += data_end - data_start
+        icg.temporary_ptr += temporary_end - temporary_start
+
+        for name, entry in self.declared:
+            if entry[0] == 'func':
+                entry = (entry[0], entry[1] + code_delta,
+                         entry[2] + data_delta, entry[3], entry[4])
+            else:
+                entry = (entry[0], entry[1] + data_delta)
+            table.declare(name, 0, entry)
+        diagram.stack[-1:] = self.stack
+        return True
+
+
+class IncrementalCompiler(object):
+    """Recompiles a changing source, regenerating only the top-level
+    declarations whose text changed.
+
+    Every declaration compiled without errors is kept as a Fragment, keyed
+    by its text. The next compile splits the source again (rescanning only
+    the text around the edit), relinks the fragments of unchanged
+    declarations at their new code and data addresses, and runs the parser
+    over the others. A fragment is reused only while the globals it uses
+    keep their shape, and from the first declaration with an error on
+    everything is parsed as in a full compile, so the result always
+    matches Compiler.compile.
+    """
+
+    def __init__(self, compiler):
+        self.parse_table = compiler.parse_table
+        self.max_errors = compiler.max_errors
+        self.declaration_list = self.parse_table.start_rows[
+            'Declaration_list']
+        self.pieces = []
+        self.tail = Piece('', None)
+        self.fragments = {}
+
+    def split(self, text):
+        """Returns the declaration Pieces of text and the Piece after them,
+        reusing the Pieces of the previous text outside the edit."""
+        old = self.pieces + [self.tail]
+        prefix = []
+        position = 0
+        for piece in self.pieces:
+            if not text.startswith(piece.text, position):
+                break
+            prefix.append(piece)
+            position += len(piece.text)
+
+        suffix = []
+        end = len(text)
+        for piece in reversed(old[len(prefix):]):
+            if end - len(piece.text) < position or \
+                    not text.endswith(piece.text, 0, end):
+                break
+            suffix.append(piece)
+            end -= len(piece.text)
+        suffix.reverse()
+
+        if suffix and end == position:
+            return prefix + suffix[:-1], suffix[-1]
+        sync = {}
+        offset = end
+        for i, piece in enumerate(suffix):
+            sync[offset] = i
+            offset += len(piece.text)
+        middle, stop, tail = split_declarations(text, position, sync)
+        if stop is None:
+            return prefix + middle, tail
+        rest = suffix[sync[stop]:]
+        return prefix + middle + rest[:-1], rest[-1]
+
+    def settle(self, diagram, terminal):
+        """Runs the steps the parser takes on terminal after a declaration
+        until it starts the next one. Returns whether it got there."""
+        table = diagram.table
+        column = diagram.terminal_ids.get(terminal, diagram.other_terminal)
+        icg = diagram.intermediate_code_generator
+        while True:
+            kind, _, key = table[diagram.stack[-1] + column]
+            if kind == PUSH and key == 'Declaration_list':
+                diagram.move_forward(terminal, terminal)
+                return diagram.stack[-1] == self.declaration_list and \
+                    icg.scope == 0 and not icg.semantic_stack and \
+                    not icg.control_stack
+            if kind not in (ROUTINE, POP):
+                return False
+            diagram.move_forward(terminal, terminal)
+
+    def compile(self, source, optimization_passes=None):
+        """Compiles source, a string or a text stream, into a CompileResult
+        equal to the one of a full compile."""
+        if not isinstance(source, str):
+            source = source.read()
+        pieces, tail = self.split(source)
+
+        symbol_table = RecordingSymbolTable()
+        icg = IntermediateCodeGenerator(symbol_table)
+        diagram = Diagram(self.parse_table, icg)
+        parser = Parser(diagram, self.max_errors)
+        prologue = (len(icg.program_block), icg.data_ptr)
+        terminals = [piece.first_terminal for piece in pieces]
+        terminals.append(tail.first_terminal or '$')
+
+        fragments = {}
+        pending = []
+        live = not self.settle(diagram, terminals[0])
+        line = 0
+        for index, piece in enumerate(pieces):
+            following = terminals[index + 1]
+            if not live and following in SETTLE_TERMINALS:
+                fragment = self.fragments.get(piece.text)
+                if fragment is not None and \
+                        fragment.relink(icg, diagram, prologue):
+                    fragments[piece.text] = fragment
+                    line += piece.lines
+                    continue
+
+            if live:
+                if self.feed(parser, piece.text, line, pending):
+                    pending = []
+            else:
+                stack_start = len(diagram.stack) - 1
+                snapshot = (len(icg.program_block),
+                            len(icg.program_block.raw), icg.data_ptr,
+                            icg.temporary_ptr, len(icg.frames),
+                            len(icg.allocations), len(icg.temporary_frames),
+                            len(icg.functions), len(icg.jump_tables))
+                symbol_table.start()
+                self.feed(parser, piece.text, line, pending)
+                settled = False
+                if not parser.has_errors() and icg.is_ok and \
+                        following in SETTLE_TERMINALS:
+                    try:
+                        settled = self.settle(diagram, following)
+                    except SemanticException as e:
+                        # reported on the token that ran the routine
+                        pending.append(e.message)
+                        icg.is_ok = False
+                symbol_table.stop()
+                if settled and EMPTY not in \
+                        icg.program_block.opcodes[snapshot[0]:]:
+                    fragments[piece.text] = Fragment(
+                        icg, snapshot, diagram.stack[stack_start:])
+                else:
+                    live = True
+            line += piece.lines
+
+        if self.feed(parser, tail.text, line, pending):
+            pending = []
+        line += tail.lines
+        if pending:
+            # the parser stops at the first semantic error at the end
+            for message in pending:
+                if parser.semantic_error(line, message):
+                    break
+        else:
+            parser.end(line)
+
+        self.pieces = pieces
+        self.tail = tail
+        self.fragments = fragments
+        if parser.has_errors():
+            optimization_passes = None
+        icg.finish(optimization_passes)
+        return CompileResult(icg.program_block, parser.scanner_errors,
+                             parser.parser_errors, parser.semantic_errors,
+                             icg.layout)
+
+    def feed(self, parser, text, line, pending):
+        """Feeds text starting on line to parser. Semantic errors in
+        pending are reported on the first token, where the parser would
+        have run the routines that raised them. Returns whether there was
+        such a token."""
+        tokens = TokenStream(text)
+        tokens.line = line
+        if not pending:
+            parser.feed(tokens)
+            return True
+        tokens = iter(tokens)
+        skipped = []
+        for token in tokens:
+            if token[1] not in SKIPPED:
+                parser.feed(skipped)
+                for message in pending:
+                    if parser.semantic_error(token[0], message):
+                        break
+                parser.feed(chain([token], tokens))
+                return True
+            skipped.append(token)
+        parser.feed(skipped)
+        return False
@@ -0,0 +1,212 @@
+import json
+import time
+from collections import Counter, defaultdict
+
+from intermediate_code_generator import IntermediateCodeGenerator, ROUTINES
+from parser import Diagram, Parser
+from symbol_table import SymbolTable
+
+
+class Profile(object):
+    """Counters collected over one or more compiles.
+
+    tokens counts the tokens of every type ('error' for scanner errors),
+    moves_per_token how many tokens took a given number of move_forward
+    steps, routine_calls and routine_time the calls and seconds spent in
+    every #routine. symbols, bindings and scopes are the most names,
+    bindings and open scopes the symbol table held at once and
+    semantic_stack the deepest the semantic stack got. phase_time has the
+    seconds spent parsing, feeding tokens to the parser (which scans,
+    parses and generates code as it goes) and running it to the end of the
+    input, and in finish.
+
+    A callback, if given, is called with as_dict() after every compile.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.compiles = 0
+        self.tokens = Counter()
+        self.moves = 0
+        self.moves_per_token = Counter()
+        self.routine_calls = Counter()
+        self.routine_time = defaultdict(float)
+        self.declarations = 0
+        self.symbols = 0
+        self.bindings = 0
+        self.scopes = 0
+        self.semantic_stack = 0
+        self.phase_time = defaultdict(float)
+
+    def session(self, parse_table):
+        """Returns a Parser over a fresh Diagram that reports to this
+        profile."""
+        symbol_table = ProfiledSymbolTable(self)
+        icg = ProfiledIntermediateCodeGenerator(self, symbol_table)
+        return ProfiledParser(self, ProfiledDiagram(self, parse_table, icg))
+
+    def count_tokens(self, tokens):
+        counts = self.tokens
+        moves_per_token = self.moves_per_token
+        for token in tokens:
+            token_type = token[1]
+            counts[token_type or 'error'] += 1
+            if token_type is None or token_type in ('W', 'COMMENT'):
+                yield token
+                continue
+            moves = self.moves
+            yield token
+            # the parser asks for the next token only once it is done
+            # with this one
+            moves_per_token[self.moves - moves] += 1
+
+    def done(self):
+        self.compiles += 1
+        if self.callback is not None:
+            self.callback(self.as_dict())
+
+    def as_dict(self):
+        return {
+            'compiles': self.compiles,
+            'tokens': dict(self.tokens),
+            'moves': self.moves,
+            'moves_per_token': dict((str(moves), count) for moves, count
+                                    in self.moves_per_token.items()),
+            'routines': dict(
+                (name, {'calls': calls, 'time': self.routine_time[name]})
+                for name, calls in self.routine_calls.items()),
+            'symbol_table': {'declarations': self.declarations,
+                             'symbols': self.symbols,
+                             'bindings': self.bindings,
+                             'scopes': self.scopes},
+            'semantic_stack': self.semantic_stack,
+            'phases': dict(self.phase_time),
+        }
+
+    def merge(self, data):
+        """Adds the counters of as_dict() of another profile, keeping the
+        larger high-water marks."""
+        self.compiles += data['compiles']
+        self.tokens.update(data['tokens'])
+        self.moves += data['moves']
+        self.moves_per_token.update(dict(
+            (int(moves), count)
+            for moves, count in data['moves_per_token'].items()))
+        for name, routine in data['routines'].items():
+            self.routine_calls[name] += routine['calls']
+            self.routine_time[name] += routine['time']
+        symbol_table = data['symbol_table']
+        self.declarations += symbol_table['declarations']
+        self.symbols = max(self.symbols, symbol_table['symbols'])
+        self.bindings = max(self.bindings, symbol_table['bindings'])
+        self.scopes = max(self.scopes, symbol_table['scopes'])
+        self.semantic_stack = max(self.semantic_stack,
+                                  data['semantic_stack'])
+        for phase, seconds in data['phases'].items():
+            self.phase_time[phase] += seconds
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def report(self, limit=10):
+        """Returns the hottest routines and the token counts as text."""
+        lines = ['%d compiles, %d tokens, %d moves' % (
+            self.compiles, sum(self.tokens.values()), self.moves)]
+        for name, seconds in sorted(self.routine_time.items(),
+                                    key=lambda item: -item[1])[:limit]:
+            lines.append('  #%-14s %8d calls %10.6fs' % (
+                name, self.routine_calls[name], seconds))
+        for token_type, count in self.tokens.most_common():
+            lines.append('  %-14s %8d' % (token_type, count))
+        return '\n'.join(lines) + '\n'
+
+
+# Compiles without a profile use the plain classes, so they pay nothing
+# for any of the ones below.
+
+class ProfiledSymbolTable(SymbolTable):
+    def __init__(self, profile):
+        super(ProfiledSymbolTable, self).__init__()
+        self.profile = profile
+        # bindings in all scopes, kept up to date instead of summed
+        self.binding_count = 0
+
+    def declare(self, name, scope, entry):
+        names = self.scopes.get(scope)
+        before = len(names) if names is not None else 0
+        super(ProfiledSymbolTable, self).declare(name, scope, entry)
+        self.binding_count += len(self.scopes.get(scope, ())) - before
+        profile = self.profile
+        profile.declarations += 1
+        profile.symbols = max(profile.symbols, len(self.bindings))
+        profile.bindings = max(profile.bindings, self.binding_count)
+        profile.scopes = max(profile.scopes, len(self.scopes))
+
+    def exit_scope(self, scope):
+        self.binding_count -= sum(len(names) for sc, names in
+                                  self.scopes.items() if sc >= scope)
+        super(ProfiledSymbolTable, self).exit_scope(scope)
+
+
+class ProfiledIntermediateCodeGenerator(IntermediateCodeGenerator):
+    def __init__(self, profile, symbol_table=None):
+        super(ProfiledIntermediateCodeGenerator, self).__init__(symbol_table)
+        self.profile = profile
+
+    def run_routine(self, routine):
+        if self.is_ok:
+            name = ROUTINES[routine]
+            start = time.perf_counter()
+            try:
+                super(ProfiledIntermediateCodeGenerator, self).run_routine(
+                    routine)
+            finally:
+                self.profile.routine_time[name] += \
+                    time.perf_counter() - start
+                self.profile.routine_calls[name] += 1
+
+    def finish(self, optimization_passes=None):
+        start = time.perf_counter()
+        try:
+            return super(ProfiledIntermediateCodeGenerator, self).finish(
+                optimization_passes)
+        finally:
+            self.profile.phase_time['finish'] += time.perf_counter() - start
+
+
+class ProfiledDiagram(Diagram):
+    def __init__(self, profile, parse_table, intermediate_code_generator=None):
+        super(ProfiledDiagram, self).__init__(parse_table,
+                                              intermediate_code_generator)
+        self.profile = profile
+
+    def move_forward(self, terminal, token):
+        profile = self.profile
+        profile.moves += 1
+        try:
+            return super(ProfiledDiagram, self).move_forward(terminal, token)
+        finally:
+            depth = len(self.intermediate_code_generator.semantic_stack)
+            if depth > profile.semantic_stack:
+                profile.semantic_stack = depth
+
+
+class ProfiledParser(Parser):
+    def __init__(self, profile, diagram):
+        super(ProfiledParser, self).__init__(diagram)
+        self.profile = profile
+
+    def feed(self, tokens):
+        start = time.perf_counter()
+        try:
+            super(ProfiledParser, self).feed(
+                self.profile.count_tokens(tokens))
+        finally:
+            self.profile.phase_time['parse'] += time.perf_counter() - start
+
+    def end(self, line_number):
+        start = time.perf_counter()
+        try:
+            super(ProfiledParser, self).end(line_number)
+        finally:
+            self.profile.phase_time['parse'] += time.perf_counter() - start
@@ -1,334 +1,547 @@
+from data_layout import plan_layout
+from interprocedural import optimize_program, code_references
+from optimizer import optimize
+from program_block import ProgramBlock, LABEL, ADDRESS
+from symbol_table import SymbolTable
+
+
 class SemanticException(Exception):
     def __init__(self, message):
         self.message = message
         super(SemanticException, self).__init__()
 
 
+# names of the #routines the grammar may use, indexed by routine id
+ROUTINES = ('int-dec', 'arr-dec', 'start-func-dec', 'func-int-dec',
+            'func-arr-dec', 'end-func-dec', 'start-scope', 'end-scope',
+            'get-arr', 'get-int', 'assign', 'negate', 'multiply', 'sub-char',
+            'check-negate', 'addop', 'start-call', 'add-call-arg', 'end-call',
+            'pop', 'return-value', 'return-call', 'end-func', 'end-program',
+            'save', 'lt-char', 'eq-char', 'relop', 'if-jump', 'else-jump',
+            'label', 'while-save', 'while', 'continue', 'start-switch',
+            'switch-save', 'case', 'add2', 'switch', 'break')
+ROUTINE_IDS = dict((name, i) for i, name in enumerate(ROUTINES))
+
+
+DATA_BASE = 200
+# temporaries get placeholder addresses past any data address until
+# finish() lays them out
+TEMPORARY_BASE = 1 << 40
+# a switch with at least this many cases dispatches through a table of
+# case entries when the table is at most JUMP_TABLE_SPREAD times as long
+# as the number of cases; the dispatch itself costs a few instructions
+JUMP_TABLE_MIN_CASES = 8
+JUMP_TABLE_SPREAD = 3
+WORD_MAX = (1 << 31) - 1
+
+
+def routine_method(name):
+    return 'routine_%s' % name.replace('-', '_')
+
+
+def jump_table(cases, default):
+    """Returns (lowest case, entries) for a switch with cases dense enough
+    to dispatch through a table, entries holding where to go for every
+    value from the lowest case on, or None."""
+    values = {}
+    for num, entry in cases:
+        try:
+            value = int(num[1:])
+        except ValueError:
+            return None
+        # a value matches the first of its cases
+        values.setdefault(value, entry)
+    if len(values) < JUMP_TABLE_MIN_CASES:
+        return None
+    low = min(values)
+    high = max(values)
+    if low < 0 or high >= WORD_MAX or \
+            high - low + 1 > JUMP_TABLE_SPREAD * len(values):
+        return None
+    entries = [values.get(value, default) for value in range(low, high + 1)]
+    return low, entries
+
+
 class IntermediateCodeGenerator(object):
-    def __init__(self):
+    def __init__(self, symbol_table=None):
         self.is_ok = True
+        # set after a syntax error, when the semantic stack may no longer
+        # match the input
+        self.recovering = False
         self.scope = 0
 
-        self.symbol_table = {('output', 0): ('func', 1, 200, 'void', 1)}
+        self.symbol_table = symbol_table if symbol_table is not None \
+            else SymbolTable()
+        self.symbol_table.declare('output', 0, ('func', 1, 200, 'void', 1))
         self.semantic_stack = []
-
-        self.program_block = [(), ('ASSIGN', '#0', 202, None),
-                              ('PRINT', 200, None, None),
-                              ('JP', '@201', None, None)]
+        # enclosing loops, switches and functions, innermost last, as
+        # (break label, continue label, return slot) with the fields a
+        # context does not set inherited from the one around it
+        self.control_stack = []
+        # the (value, entry) cases of the enclosing switches, innermost last
+        self.switch_cases = []
+
+        self.program_block = ProgramBlock()
+        for instruction in [(), ('ASSIGN', '#0', 202, None),
+                            ('PRINT', 200, None, None),
+                            ('JP', '@201', None, None)]:
+            self.program_block.append(instruction)
         self.data_ptr = 203
-        self.temporary_ptr = 500
+        self.temporary_base = self.temporary_ptr = TEMPORARY_BASE
+        # data handed out so far as (start, size, frame), frame indexing
+        # frames or None for globals
+        self.frames = ['output']
+        self.frame_stack = []
+        self.allocations = [(DATA_BASE, 3, 0)]
+        # runs of temporaries as (first temporary, frame)
+        self.temporary_frames = []
+        # the code of every function as (entry, end, return slot, frame)
+        self.functions = []
+        # the tables of the switches dispatching through one as (start,
+        # entries), filled before main runs
+        self.jump_tables = []
+        self.layout = None
+
+        self.routines = [getattr(self, routine_method(name))
+                         for name in ROUTINES]
 
     def get_temp(self):
+        return self.new_temporary(
+            self.frame_stack[-1] if self.frame_stack else None)
+
+    def new_temporary(self, frame):
         ptr = self.temporary_ptr
         self.temporary_ptr += 1
+        if not self.temporary_frames or self.temporary_frames[-1][1] != frame:
+            self.temporary_frames.append((ptr, frame))
         return ptr
 
-    def get_scope(self, name):
-        late_scope = -1
-        for key, sc in self.symbol_table.keys():
-            if key == name:
-                late_scope = max(late_scope, sc)
-        return late_scope
-
-    def run_routine(self, method):
+    def allocate(self, size):
+        address = self.data_ptr
+        self.data_ptr += size
+        if size:
+            frame = self.frame_stack[-1] if self.frame_stack else None
+            self.allocations.append((address, size, frame))
+        return address
+
+    def temporaries(self):
+        """Returns the range of addresses that only ever hold temporaries."""
+        if self.layout is not None:
+            return self.layout.temporaries
+        return self.temporary_base, self.temporary_ptr
+
+    def finish(self, optimization_passes=None):
+        """Optimizes the generated code with the given passes, then lays out
+        data and temporaries."""
+        if optimization_passes:
+            optimize_program(self, optimization_passes)
+            self.program_block = optimize(self.program_block,
+                                          self.temporaries(),
+                                          optimization_passes)
+        self.layout = plan_layout(self.program_block, self.allocations,
+                                  self.frames, DATA_BASE,
+                                  (self.temporary_base, self.temporary_ptr),
+                                  self.temporary_frames)
+        return self.layout
+
+    def lookup(self, name):
+        entry = self.symbol_table.lookup(name)
+        if entry is None:
+            raise SemanticException("'%s' is not defined." % name)
+        return entry
+
+    def enter_control(self, break_label=None, continue_label=None,
+                      return_slot=None):
+        outer = self.current_control()
+        if break_label is None:
+            break_label = outer[0]
+        if continue_label is None:
+            continue_label = outer[1]
+        if return_slot is None:
+            return_slot = outer[2]
+        self.control_stack.append((break_label, continue_label, return_slot))
+
+    def current_control(self):
+        if self.control_stack:
+            return self.control_stack[-1]
+        return None, None, -1
+
+    def run_routine(self, routine):
         if not self.is_ok:
             return
-
-        if method == 'int-dec':
-            name = self.semantic_stack.pop()
-            kind = self.semantic_stack.pop()
-            if kind == 'void':
-                raise SemanticException("Illegal type of void.")
-            self.symbol_table[(name, self.scope)] = (kind, self.data_ptr)
-            self.data_ptr += 1
-
-        if method == 'arr-dec':
-            cnt = int(self.semantic_stack.pop()[1:])
-            name = self.semantic_stack.pop()
-            kind = self.semantic_stack.pop()
-            if kind == 'void':
-                raise SemanticException("Illegal type of void.")
-            self.symbol_table[(name, self.scope)] = ('arr', self.data_ptr)
-            self.data_ptr += cnt
-
-        if method == 'start-func-dec':
-            name = self.semantic_stack.pop()
-            kind = self.semantic_stack.pop()
-            self.scope += 1
-            self.semantic_stack.append(len(self.program_block))
-            self.semantic_stack.append(kind)
-            self.semantic_stack.append(name)
-            self.program_block.append(())
-            self.semantic_stack.append(0)
-
-        if method == 'func-int-dec':
-            name = self.semantic_stack.pop()
-            kind = self.semantic_stack.pop()
-            self.semantic_stack[-1] += 1
-            if kind == 'void':
-                raise SemanticException("Illegal type of void.")
-            self.symbol_table[(name, self.scope)] = ('int', self.data_ptr)
-            self.data_ptr += 1
-
-        if method == 'func-arr-dec':
-            name = self.semantic_stack.pop()
-            kind = self.semantic_stack.pop()
-            self.semantic_stack[-1] += 1
-            if kind == 'void':
-                raise SemanticException("Illegal type of void.")
-            self.symbol_table[(name, self.scope)] = ('arr', self.data_ptr)
-            self.data_ptr += 1
-
-        if method == 'end-func-dec':
-            cnt = self.semantic_stack.pop()
-            if cnt == 'void':
-                self.semantic_stack.pop()
-                cnt = 0
-            name = self.semantic_stack.pop()
-            kind = self.semantic_stack.pop()
-
-            self.scope -= 1
-            self.symbol_table[(name, self.scope)] = \
-                ('func', len(self.program_block),
-                 self.data_ptr - cnt, kind, cnt)
-
-            self.semantic_stack.append('func')
-            self.semantic_stack.append(self.data_ptr)
-            self.program_block.append(('ASSIGN', '#0', self.data_ptr + 1, None))
-            self.data_ptr += 2
-
-        if method == 'start-scope':
-            self.scope += 1
-
-        if method == 'end-scope':
-            self.symbol_table = {(key, sc): self.symbol_table[(key, sc)]
-                                 for key, sc in self.symbol_table.keys()
-                                 if sc < self.scope}
-            self.scope -= 1
-
-        if method == 'get-arr':
-            idx = self.semantic_stack.pop()
-            name = self.semantic_stack.pop()
-            if name not in [key for key, sc in self.symbol_table.keys()]:
-                raise SemanticException("'%s' is not defined." % name)
-            if self.symbol_table[(name, self.get_scope(name))][0] != 'arr':
-                raise SemanticException("Type mismatch in operands.")
-            ptr = self.get_temp()
-            self.program_block.append(('ADD', idx, '#%s' % self.symbol_table[(name, self.get_scope(name))][1], ptr))
-            self.semantic_stack.append('@%s' % ptr)
-
-        if method == 'get-int':
-            name = self.semantic_stack.pop()
-            if name not in [key for key, sc in self.symbol_table.keys()]:
-                raise SemanticException("'%s' is not defined." % name)
-            if self.symbol_table[(name, self.get_scope(name))][0] not in ['int', 'arr']:
-                raise SemanticException("Type mismatch in operands.")
-            self.semantic_stack.append(self.symbol_table[(name, self.get_scope(name))][1])
-
-        if method == 'assign':
-            source = self.semantic_stack.pop()
-            dest = self.semantic_stack.pop()
-            self.program_block.append(('ASSIGN', source, dest, None))
-            self.semantic_stack.append(dest)
-
-        if method == 'negate':
-            source = self.semantic_stack.pop()
-            ptr = self.get_temp()
-            self.program_block.append(('SUB', '#0', source, ptr))
-            self.semantic_stack.append(ptr)
-
-        if method == 'multiply':
-            op1 = self.semantic_stack.pop()
-            op2 = self.semantic_stack.pop()
-            ptr = self.get_temp()
-            self.program_block.append(('MULT', op1, op2, ptr))
-            self.semantic_stack.append(ptr)
-
-        if method == 'sub-char':
-            self.semantic_stack.append('-')
-
-        if method == 'check-negate':
-            if len(self.semantic_stack) > 1 and self.semantic_stack[-2] == '-':
-                op1 = self.semantic_stack.pop()
-                self.semantic_stack.pop()
-                ptr = self.get_temp()
-                self.program_block.append(('SUB', '#0', op1, ptr))
-                self.semantic_stack.append(ptr)
-
-        if method == 'addop':
-            op1 = self.semantic_stack.pop()
-            op2 = self.semantic_stack.pop()
-            ptr = self.get_temp()
-
-            self.program_block.append(('ADD', op2, op1, ptr))
-            self.semantic_stack.append(ptr)
-
-        if method == 'start-call':
-            name = self.semantic_stack.pop()
-            if name not in [key for key, sc in self.symbol_table.keys()]:
-                raise SemanticException("'%s' is not defined." % name)
-            self.semantic_stack.append(name)
-            self.semantic_stack.append(self.symbol_table[(name, self.get_scope(name))][2])
-            self.semantic_stack.append(self.symbol_table[(name, self.get_scope(name))][4])
-
-        if method == 'add-call-arg':
-            exp = self.semantic_stack.pop()
-            cnt = self.semantic_stack.pop()
-            if cnt == 0:
-                self.semantic_stack.pop()
-                name = self.semantic_stack.pop()
-                raise SemanticException("Mismatch in numbers of arguments of '%s'." % name)
-
-            idx = self.semantic_stack.pop()
-            self.program_block.append(('ASSIGN', exp, idx, None))
-            self.semantic_stack.append(idx + 1)
-            self.semantic_stack.append(cnt - 1)
-
-        if method == 'end-call':
-            cnt = self.semantic_stack.pop()
-            idx = self.semantic_stack.pop()
-            name = self.semantic_stack.pop()
-            if cnt:
-                raise SemanticException("Mismatch in numbers of arguments of '%s'." % name)
-
-            ptr = self.get_temp()
-            self.program_block.append(('ASSIGN', "#%d" % (len(self.program_block) + 2), idx, None))
-            self.program_block.append(('JP', self.symbol_table[(name, self.get_scope(name))][1], None, None))
-            self.program_block.append(('ASSIGN', idx + 1, ptr, None))
-            self.semantic_stack.append(ptr)
-
-        if method == 'pop':
-            self.semantic_stack.pop()
-
-        if method == 'return-value':
-            exp = self.semantic_stack.pop()
-            idx = -1
-            for i in range(len(self.semantic_stack)-1, -1, -1):
-                if self.semantic_stack[i] == 'func':
-                    idx = self.semantic_stack[i+1]
-            self.program_block.append(('ASSIGN', exp, idx + 1, None))
-
-        if method == 'return-call':
-            idx = -1
-            for i in range(len(self.semantic_stack)-1, -1, -1):
-                if self.semantic_stack[i] == 'func':
-                    idx = self.semantic_stack[i+1]
-            self.program_block.append(('JP', '@%s' % idx, None, None))
-
-        if method == 'end-func':
-            idx = self.semantic_stack.pop()
-            if 'main' not in [key for key, sc in self.symbol_table.keys()]:
-                self.program_block.append(('JP', '@%s' % idx, None, None))
-
+        if not self.recovering:
+            self.routines[routine]()
+            return
+        try:
+            self.routines[routine]()
+        except SemanticException:
+            raise
+        except Exception:
+            # the routine does not fit what recovery left on the stack
+            self.is_ok = False
+
+    def routine_int_dec(self):
+        name = self.semantic_stack.pop()
+        kind = self.semantic_stack.pop()
+        if kind == 'void':
+            raise SemanticException("Illegal type of void.")
+        self.symbol_table.declare(name, self.scope, (kind, self.allocate(1)))
+
+    def routine_arr_dec(self):
+        cnt = int(self.semantic_stack.pop()[1:])
+        name = self.semantic_stack.pop()
+        kind = self.semantic_stack.pop()
+        if kind == 'void':
+            raise SemanticException("Illegal type of void.")
+        self.symbol_table.declare(name, self.scope,
+                                  ('arr', self.allocate(cnt)))
+
+    def routine_start_func_dec(self):
+        name = self.semantic_stack.pop()
+        kind = self.semantic_stack.pop()
+        self.scope += 1
+        self.frames.append(name)
+        self.frame_stack.append(len(self.frames) - 1)
+        self.semantic_stack.append(self.program_block.reserve())
+        self.semantic_stack.append(kind)
+        self.semantic_stack.append(name)
+        self.semantic_stack.append(0)
+
+    def routine_func_int_dec(self):
+        name = self.semantic_stack.pop()
+        kind = self.semantic_stack.pop()
+        self.semantic_stack[-1] += 1
+        if kind == 'void':
+            raise SemanticException("Illegal type of void.")
+        self.symbol_table.declare(name, self.scope, ('int', self.allocate(1)))
+
+    def routine_func_arr_dec(self):
+        name = self.semantic_stack.pop()
+        kind = self.semantic_stack.pop()
+        self.semantic_stack[-1] += 1
+        if kind == 'void':
+            raise SemanticException("Illegal type of void.")
+        self.symbol_table.declare(name, self.scope, ('arr', self.allocate(1)))
+
+    def routine_end_func_dec(self):
+        cnt = self.semantic_stack.pop()
+        if cnt == 'void':
             self.semantic_stack.pop()
-            idx = self.semantic_stack.pop()
-            self.program_block[idx] = ('JP', len(self.program_block), None, None)
-
-        if method == 'end-program':
-            if 'main' not in [key for key, sc in self.symbol_table.keys()]:
-                raise SemanticException('main function not found!')
-
-            self.program_block[0] = ('JP', self.symbol_table[('main', self.get_scope('main'))][1], None, None)
-
-        if method == 'save':
-            self.semantic_stack.append(len(self.program_block))
-            self.program_block.append(())
-
-        if method == 'lt-char':
-            self.semantic_stack.append('<')
-
-        if method == 'eq-char':
-            self.semantic_stack.append('==')
-
-        if method == 'relop':
-            op2 = self.semantic_stack.pop()
-            operation = 'LT' if self.semantic_stack.pop() == '<' else 'EQ'
+            cnt = 0
+        name = self.semantic_stack.pop()
+        kind = self.semantic_stack.pop()
+
+        self.scope -= 1
+        self.symbol_table.declare(name, self.scope,
+                                  ('func', len(self.program_block),
+                                   self.data_ptr - cnt, kind, cnt))
+
+        return_slot = self.allocate(2)
+        self.enter_control(return_slot=return_slot)
+        self.program_block.append(('ASSIGN', '#0', return_slot + 1, None))
+
+    def routine_start_scope(self):
+        self.scope += 1
+
+    def routine_end_scope(self):
+        self.symbol_table.exit_scope(self.scope)
+        self.scope -= 1
+
+    def routine_get_arr(self):
+        idx = self.semantic_stack.pop()
+        name = self.semantic_stack.pop()
+        entry = self.lookup(name)
+        if entry[0] != 'arr':
+            raise SemanticException("Type mismatch in operands.")
+        ptr = self.get_temp()
+        self.program_block.append(('ADD', idx, (ADDRESS, entry[1]), ptr))
+        self.semantic_stack.append('@%s' % ptr)
+
+    def routine_get_int(self):
+        name = self.semantic_stack.pop()
+        entry = self.lookup(name)
+        if entry[0] not in ['int', 'arr']:
+            raise SemanticException("Type mismatch in operands.")
+        self.semantic_stack.append(entry[1])
+
+    def routine_assign(self):
+        source = self.semantic_stack.pop()
+        dest = self.semantic_stack.pop()
+        self.program_block.append(('ASSIGN', source, dest, None))
+        self.semantic_stack.append(dest)
+
+    def routine_negate(self):
+        source = self.semantic_stack.pop()
+        ptr = self.get_temp()
+        self.program_block.append(('SUB', '#0', source, ptr))
+        self.semantic_stack.append(ptr)
+
+    def routine_multiply(self):
+        op1 = self.semantic_stack.pop()
+        op2 = self.semantic_stack.pop()
+        ptr = self.get_temp()
+        self.program_block.append(('MULT', op1, op2, ptr))
+        self.semantic_stack.append(ptr)
+
+    def routine_sub_char(self):
+        self.semantic_stack.append('-')
+
+    def routine_check_negate(self):
+        if len(self.semantic_stack) > 1 and self.semantic_stack[-2] == '-':
             op1 = self.semantic_stack.pop()
-
-            ptr = self.get_temp()
-            self.program_block.append((operation, op1, op2, ptr))
-            self.semantic_stack.append(ptr)
-
-        if method == 'if-jump':
-            idx = self.semantic_stack.pop()
-            exp = self.semantic_stack.pop()
-
-            self.program_block[idx] = ('JPF', exp, len(self.program_block) + 1, None)
-            self.semantic_stack.append(len(self.program_block))
-            self.program_block.append(())
-
-        if method == 'else-jump':
-            idx = self.semantic_stack.pop()
-            self.program_block[idx] = ('JP', len(self.program_block), None, None)
-
-        if method == 'label':
-            self.program_block.append(('JP', len(self.program_block) + 2, None, None))
-            self.program_block.append(())
-            self.semantic_stack.append(len(self.program_block))
-
-        if method == 'while-save':
-            self.semantic_stack.append('while')
-            self.semantic_stack.append(len(self.program_block))
-            self.program_block.append(())
-
-        if method == 'while':
-            idx = self.semantic_stack.pop()
             self.semantic_stack.pop()
-            exp = self.semantic_stack.pop()
-            label = self.semantic_stack.pop()
-
-            self.program_block[idx] = ('JPF', exp, len(self.program_block) + 1, None)
-            self.program_block.append(('JP', label, None, None))
-            self.program_block[label-1] = ('JP', len(self.program_block), None, None)
-
-        if method == 'continue':
-            if 'while' not in self.semantic_stack:
-                raise SemanticException("No 'while' found for 'continue'.")
-
-            idx = len(self.semantic_stack) - self.semantic_stack[::-1].index('while') - 3
-            self.program_block.append(('JP', self.semantic_stack[idx], None, None))
-
-        if method == 'start-switch':
-            self.semantic_stack.append('switch')
-
-        if method == 'switch-save':
-            num = self.semantic_stack.pop()
-            self.semantic_stack.pop()  # switch
-            exp = self.semantic_stack.pop()
             ptr = self.get_temp()
-            self.program_block.append(('EQ', exp, num, ptr))
-
-            self.semantic_stack.append(exp)
-            self.semantic_stack.append('switch')
+            self.program_block.append(('SUB', '#0', op1, ptr))
             self.semantic_stack.append(ptr)
-            self.semantic_stack.append(len(self.program_block))
-            self.program_block.append(())
-
-        if method == 'case':
-            idx = self.semantic_stack.pop()
-            ptr = self.semantic_stack.pop()
-
-            self.program_block[idx] = ('JPF', ptr, len(self.program_block) + 1, None)
-            self.program_block.append(('JP', len(self.program_block) + 3, None, None))
-
-        if method == 'add2':
-            self.program_block.append(('JP', len(self.program_block) + 1, None, None))
-            self.program_block.append(('JP', len(self.program_block) + 1, None, None))
-
-        if method == 'switch':
-            self.semantic_stack.pop()  # switch
-            self.semantic_stack.pop()  # exp
-            label = self.semantic_stack.pop()
-
-            self.program_block[label-1] = ('JP', len(self.program_block), None, None)
-
-        if method == 'break':
-            if 'switch' not in self.semantic_stack and 'while' not in self.semantic_stack:
-                raise SemanticException("No 'while' or 'switch' found for 'break'.")
-
-            for i in range(len(self.semantic_stack)-1, -1, -1):
-                if self.semantic_stack[i] in ('while', 'switch'):
-                    label = self.semantic_stack[i - 2]
-                    self.program_block.append(('JP', label-1, None, None))
-
 
+    def routine_addop(self):
+        op1 = self.semantic_stack.pop()
+        op2 = self.semantic_stack.pop()
+        ptr = self.get_temp()
+
+        self.program_block.append(('ADD', op2, op1, ptr))
+        self.semantic_stack.append(ptr)
+
+    def routine_start_call(self):
+        name = self.semantic_stack.pop()
+        entry = self.lookup(name)
+        if entry[0] != 'func':
+            raise SemanticException("'%s' is not a function." % name)
+        self.semantic_stack.append(name)
+        self.semantic_stack.append(entry[2])
+        self.semantic_stack.append(entry[4])
+
+    def routine_add_call_arg(self):
+        exp = self.semantic_stack.pop()
+        cnt = self.semantic_stack.pop()
+        if cnt == 0:
+            self.semantic_stack.pop()
+            name = self.semantic_stack.pop()
+            raise SemanticException("Mismatch in numbers of arguments of '%s'." % name)
+
+        idx = self.semantic_stack.pop()
+        self.program_block.append(('ASSIGN', exp, idx, None))
+        self.semantic_stack.append(idx + 1)
+        self.semantic_stack.append(cnt - 1)
+
+    def routine_end_call(self):
+        cnt = self.semantic_stack.pop()
+        idx = self.semantic_stack.pop()
+        name = self.semantic_stack.pop()
+        if cnt:
+            raise SemanticException("Mismatch in numbers of arguments of '%s'." % name)
+
+        ptr = self.get_temp()
+        self.program_block.append(('ASSIGN', (LABEL, len(self.program_block) + 2), idx, None))
+        self.program_block.append(('JP', self.symbol_table.lookup(name)[1], None, None))
+        self.program_block.append(('ASSIGN', idx + 1, ptr, None))
+        self.semantic_stack.append(ptr)
+
+    def routine_pop(self):
+        self.semantic_stack.pop()
+
+    def routine_return_value(self):
+        exp = self.semantic_stack.pop()
+        idx = self.current_control()[2]
+        self.program_block.append(('ASSIGN', exp, idx + 1, None))
+
+    def routine_return_call(self):
+        idx = self.current_control()[2]
+        self.program_block.append(('JP', '@%s' % idx, None, None))
+
+    def routine_end_func(self):
+        return_slot = self.control_stack.pop()[2]
+        if 'main' not in self.symbol_table:
+            self.program_block.append(('JP', '@%s' % return_slot, None, None))
+
+        idx = self.semantic_stack.pop()
+        self.program_block[idx] = ('JP', len(self.program_block), None, None)
+        self.functions.append((idx + 1, len(self.program_block), return_slot,
+                               self.frame_stack.pop()))
+
+    def routine_end_program(self):
+        if 'main' not in self.symbol_table:
+            raise SemanticException('main function not found!')
+
+        self.start_program(self.symbol_table.lookup('main')[1])
+
+    def start_program(self, main):
+        """Jumps to main at the start of the program. The jump tables are
+        filled on the way, by code put at the end of the program that the
+        code running off the end jumps over."""
+        entry = main
+        if self.jump_tables:
+            skip = self.program_block.reserve()
+            entry = len(self.program_block)
+            for start, entries in self.jump_tables:
+                for i, address in enumerate(entries):
+                    self.program_block.append(('ASSIGN', (LABEL, address),
+                                               start + i, None))
+            self.program_block.append(('JP', main, None, None))
+            self.program_block[skip] = ('JP', len(self.program_block), None,
+                                        None)
+        self.program_block[0] = ('JP', entry, None, None)
+
+    def routine_save(self):
+        self.semantic_stack.append(self.program_block.reserve())
+
+    def routine_lt_char(self):
+        self.semantic_stack.append('<')
+
+    def routine_eq_char(self):
+        self.semantic_stack.append('==')
+
+    def routine_relop(self):
+        op2 = self.semantic_stack.pop()
+        operation = 'LT' if self.semantic_stack.pop() == '<' else 'EQ'
+        op1 = self.semantic_stack.pop()
+
+        ptr = self.get_temp()
+        self.program_block.append((operation, op1, op2, ptr))
+        self.semantic_stack.append(ptr)
+
+    def routine_if_jump(self):
+        idx = self.semantic_stack.pop()
+        exp = self.semantic_stack.pop()
+
+        self.program_block[idx] = ('JPF', exp, len(self.program_block) + 1, None)
+        self.semantic_stack.append(self.program_block.reserve())
+
+    def routine_else_jump(self):
+        idx = self.semantic_stack.pop()
+        self.program_block[idx] = ('JP', len(self.program_block), None, None)
+
+    def routine_label(self):
+        self.program_block.append(('JP', len(self.program_block) + 2, None, None))
+        self.program_block.reserve()
+        self.semantic_stack.append(len(self.program_block))
+
+    def routine_while_save(self):
+        label = self.semantic_stack[-2]
+        self.enter_control(break_label=label, continue_label=label)
+        self.semantic_stack.append(self.program_block.reserve())
+
+    def routine_while(self):
+        idx = self.semantic_stack.pop()
+        exp = self.semantic_stack.pop()
+        label = self.semantic_stack.pop()
+        self.control_stack.pop()
+
+        self.program_block[idx] = ('JPF', exp, len(self.program_block) + 1, None)
+        self.program_block.append(('JP', label, None, None))
+        self.program_block[label-1] = ('JP', len(self.program_block), None, None)
+
+    def routine_continue(self):
+        label = self.current_control()[1]
+        if label is None:
+            raise SemanticException("No 'while' found for 'continue'.")
+
+        self.program_block.append(('JP', label, None, None))
+
+    def routine_start_switch(self):
+        self.enter_control(break_label=self.semantic_stack[-2])
+        self.switch_cases.append([])
+
+    def routine_switch_save(self):
+        num = self.semantic_stack.pop()
+        exp = self.semantic_stack.pop()
+        ptr = self.get_temp()
+        self.program_block.append(('EQ', exp, num, ptr))
+
+        self.semantic_stack.append(exp)
+        self.semantic_stack.append(ptr)
+        self.semantic_stack.append(self.program_block.reserve())
+        self.switch_cases[-1].append((num, len(self.program_block)))
+
+    def routine_case(self):
+        idx = self.semantic_stack.pop()
+        ptr = self.semantic_stack.pop()
+
+        self.program_block[idx] = ('JPF', ptr, len(self.program_block) + 1, None)
+        self.program_block.append(('JP', len(self.program_block) + 3, None, None))
+
+    def routine_add2(self):
+        self.program_block.append(('JP', len(self.program_block) + 1, None, None))
+        self.program_block.append(('JP', len(self.program_block) + 1, None, None))
+        self.semantic_stack.append(len(self.program_block))
+
+    def routine_switch(self):
+        default = self.semantic_stack.pop()
+        exp = self.semantic_stack.pop()
+        label = self.semantic_stack.pop()
+        self.control_stack.pop()
+
+        cases = self.switch_cases.pop()
+        table = jump_table(cases, default)
+        # the code of functions declared in the cases stays where it is
+        if table is not None and not any(function[0] > cases[0][1]
+                                         for function in self.functions):
+            self.dispatch(exp, cases, default, *table)
+        self.program_block[label-1] = ('JP', len(self.program_block), None, None)
+
+    def dispatch(self, exp, cases, default, low, entries):
+        """Replaces the compare chain of a switch by a jump through a table
+        of case entries. The compares and the jumps over them are dropped,
+        so every case runs into the next, and the code of the switch moves
+        up to make room for the range check."""
+        program_block = self.program_block
+        first = cases[0][1] - 2
+        end = len(program_block)
+        dropped = set((default - 3, default - 2, default - 1))
+        for _, body in cases:
+            dropped.update((body - 3, body - 2, body - 1))
+        # what runs before the switch
+        dropped.discard(first - 1)
+
+        below, above, entry, target = [self.get_temp() for _ in range(4)]
+        check = [('LT', '#%d' % (low - 1), exp, below),
+                 ('JPF', below, default, None),
+                 ('LT', exp, '#%d' % (low + len(entries)), above),
+                 ('JPF', above, default, None)]
+        index = exp
+        if low:
+            index = self.get_temp()
+            check.append(('SUB', exp, '#%d' % low, index))
+        start = self.allocate(len(entries))
+        check.extend([('ADD', index, (ADDRESS, start), entry),
+                      ('ASSIGN', '@%s' % entry, target, None),
+                      ('JP', '@%s' % target, None, None)])
+
+        new_index = {}
+        position = first + len(check)
+        for old in range(first, end):
+            new_index[old] = position
+            if old not in dropped:
+                position += 1
+        new_index[end] = position
+
+        def relocate(address):
+            return new_index.get(address, address)
+
+        code = [program_block.encoded(old) for old in range(first, end)
+                if old not in dropped]
+        program_block.truncate(first)
+        for instruction in check:
+            if instruction[0] == 'JPF':
+                instruction = ('JPF', instruction[1], relocate(default), None)
+            program_block.append(instruction)
+        for instruction in code:
+            instruction = list(instruction)
+            for i in code_references(instruction):
+                mode, address = instruction[i]
+                instruction[i] = (mode, relocate(address))
+            program_block.append(tuple(instruction))
+
+        # the tables of the switches inside moved along
+        self.jump_tables = [(table, [relocate(address) for address in
+                                     addresses])
+                            for table, addresses in self.jump_tables]
+        self.jump_tables.append((start, [relocate(address)
+                                         for address in entries]))
+
+    def routine_break(self):
+        label = self.current_control()[0]
+        if label is None:
+            raise SemanticException("No 'while' or 'switch' found for 'break'.")
+
+        self.program_block.append(('JP', label-1, None, None))
@@ -0,0 +1,321 @@
+from optimizer import load, store, compact, TARGETS, DESTINATIONS, \
+    NO_OPERAND
+from program_block import DIRECT, INDIRECT, LABEL, ADDRESS
+
+INTERPROCEDURAL_PASSES = ('inlining', 'unreachable-functions')
+# the most instructions a function may have, its entry and its return
+# included, to be inlined
+INLINE_LIMIT = 24
+
+
+def code_references(instruction):
+    """Yields the positions of the operands of instruction holding a code
+    address."""
+    target = TARGETS.get(instruction[0])
+    for i in range(1, 4):
+        mode = instruction[i][0]
+        if mode == LABEL or i == target and mode == DIRECT:
+            yield i
+
+
+def data_operands(instruction):
+    """Yields the positions of the operands of instruction holding a data
+    address."""
+    target = TARGETS.get(instruction[0])
+    for i in range(1, 4):
+        mode = instruction[i][0]
+        if mode in (INDIRECT, ADDRESS) or mode == DIRECT and i != target:
+            yield i
+
+
+def owners(code, functions):
+    """Returns the innermost function every instruction of code belongs
+    to, or None for the code outside functions. Functions may be declared
+    inside others."""
+    result = [None] * (len(code) + 1)
+    for function in sorted(functions):
+        start, end = function[:2]
+        result[start:end] = [function] * (end - start)
+    return result
+
+
+def main_entry(code, starts):
+    """Returns where main starts. The program starts with a jump to it,
+    or to the code filling the jump tables, which then jumps to main."""
+    if not code or code[0][0] != 'JP' or code[0][1][0] != DIRECT:
+        return None
+    index = code[0][1][1]
+    if index in starts:
+        return index
+    while index < len(code) and code[index][0] == 'ASSIGN':
+        index += 1
+    if index < len(code) and code[index][0] == 'JP' and \
+            code[index][1][0] == DIRECT:
+        return code[index][1][1]
+    return None
+
+
+def is_leaf(code, function, starts):
+    """Whether function can be inlined: it is small, calls nothing but
+    built-ins and only uses its return slot to return."""
+    start, end, return_slot, _ = function
+    returns = ['JP', (INDIRECT, return_slot), NO_OPERAND, NO_OPERAND]
+    if end - start > INLINE_LIMIT or code[end - 1] != returns:
+        return False
+    for index in range(start, end):
+        instruction = code[index]
+        if instruction == returns:
+            continue
+        for i in code_references(instruction):
+            address = instruction[i][1]
+            if start <= address <= end:
+                continue
+            # only calls of built-ins may leave the function
+            if instruction[i][0] == LABEL or address in starts or \
+                    index == 0 or code[index - 1][:2] != [
+                        'ASSIGN', (LABEL, index + 1)]:
+                return False
+        destination = DESTINATIONS.get(instruction[0])
+        for i in data_operands(instruction):
+            mode, address = instruction[i]
+            if address == return_slot or instruction[0] == 'JP' or \
+                    address == return_slot + 1 and \
+                    (i != destination or mode != DIRECT):
+                return False
+    return True
+
+
+def find_call(code, index, functions, temporaries):
+    """Returns the function called by the three instructions at index, or
+    None when they are not a call whose result goes to a temporary."""
+    if index + 2 >= len(code):
+        return None
+    store_return, jump, copy_result = code[index:index + 3]
+    if store_return[0] != 'ASSIGN' or \
+            store_return[1] != (LABEL, index + 2) or \
+            jump[0] != 'JP' or jump[1][0] != DIRECT:
+        return None
+    function = functions.get(jump[1][1])
+    if function is None:
+        return None
+    return_slot = function[2]
+    low, high = temporaries
+    if store_return[2] != (DIRECT, return_slot) or \
+            copy_result[0] != 'ASSIGN' or \
+            copy_result[1] != (DIRECT, return_slot + 1) or \
+            copy_result[2][0] != DIRECT or \
+            not low <= copy_result[2][1] < high:
+        return None
+    return function
+
+
+def inline_leaves(icg, code, functions):
+    """Replaces the calls of small leaf functions by a copy of their body
+    once. Returns (code, functions), both unchanged when no call was
+    inlined."""
+    starts = dict((function[0], function) for function in functions)
+    owner = owners(code, functions)
+    # functions declaring others are not copied
+    outer = set(owner[start - 1] for start in starts)
+    main = main_entry(code, starts)
+    leaves = dict((start, function) for start, function in starts.items()
+                  if start != main and function not in outer and
+                  is_leaf(code, function, starts))
+    if not leaves:
+        return code, functions
+    low, high = icg.temporaries()
+
+    targeted = set()
+    for index, instruction in enumerate(code):
+        for i in code_references(instruction):
+            if instruction[i][0] != LABEL or instruction[i][1] != index + 2:
+                targeted.add(instruction[i][1])
+    sites = {}
+    index = 0
+    while index < len(code):
+        function = find_call(code, index, leaves, (low, high))
+        if function is not None and index + 1 not in targeted and \
+                index + 2 not in targeted:
+            sites[index] = function
+            index += 3
+        else:
+            index += 1
+    if not sites:
+        return code, functions
+
+    new_index = []
+    position = 0
+    index = 0
+    while index < len(code):
+        function = sites.get(index)
+        if function is None:
+            new_index.append(position)
+            position += 1
+            index += 1
+            continue
+        size = function[1] - function[0]
+        new_index.extend((position, position, position + size))
+        position += size
+        index += 3
+    new_index.append(position)
+
+    result = []
+    index = 0
+    while index < len(code):
+        function = sites.get(index)
+        if function is None:
+            instruction = list(code[index])
+            for i in code_references(instruction):
+                instruction[i] = (instruction[i][0],
+                                  new_index[instruction[i][1]])
+            result.append(instruction)
+            index += 1
+            continue
+        caller = owner[index]
+        frame = caller[3] if caller is not None else None
+        result.extend(copy_body(icg, code, function, new_index[index],
+                                code[index + 2][2], frame, new_index))
+        index += 3
+
+    functions = [(new_index[start], new_index[end], return_slot, frame)
+                 for start, end, return_slot, frame in functions]
+    return result, functions
+
+
+def copy_body(icg, code, function, base, result, frame, new_index):
+    """Returns a copy of the body of function placed at base that leaves
+    its value in result and goes on after itself instead of returning.
+    The copy gets temporaries of its own in frame."""
+    start, end, return_slot, _ = function
+    returns = ['JP', (INDIRECT, return_slot), NO_OPERAND, NO_OPERAND]
+    low, high = icg.temporary_base, icg.temporary_ptr
+    temporaries = {}
+    body = []
+    for index in range(start, end):
+        instruction = list(code[index])
+        if instruction == returns:
+            body.append(['JP', (DIRECT, base + end - start), NO_OPERAND,
+                         NO_OPERAND])
+            continue
+        for i in code_references(instruction):
+            mode, address = instruction[i]
+            if start <= address <= end:
+                address += base - start
+            else:
+                address = new_index[address]
+            instruction[i] = (mode, address)
+        for i in data_operands(instruction):
+            mode, address = instruction[i]
+            if address == return_slot + 1:
+                instruction[i] = result
+            elif low <= address < high:
+                if address not in temporaries:
+                    temporaries[address] = icg.new_temporary(frame)
+                instruction[i] = (mode, temporaries[address])
+        body.append(instruction)
+    return body
+
+
+def remove_unreachable(icg, code, functions):
+    """Drops the functions main never calls, with their data when nothing
+    else uses it. Returns (code, functions)."""
+    starts = dict((function[0], function) for function in functions)
+    main = main_entry(code, starts)
+    if main not in starts:
+        return code, functions
+    owner = owners(code, functions)
+
+    # code outside functions runs anyway, main is called from it; the code
+    # addresses it stores are those of jump tables, which go with the
+    # functions holding the switches
+    entries = [function and function[0] for function in owner]
+    references = {}
+    for index, instruction in enumerate(code):
+        for i in code_references(instruction):
+            if entries[index] is None and instruction[i][0] == LABEL:
+                continue
+            references.setdefault(entries[index], set()).add(
+                entries[instruction[i][1]])
+    reachable = set()
+    pending = [None]
+    while pending:
+        function = pending.pop()
+        for callee in references.get(function, ()):
+            if callee not in reachable and callee is not None:
+                reachable.add(callee)
+                pending.append(callee)
+
+    removed = []
+    for function in functions:
+        start, end = function[:2]
+        if function[0] in reachable or start == 0 or \
+                code[start - 1] != ['JP', (DIRECT, end), NO_OPERAND,
+                                    NO_OPERAND]:
+            continue
+        removed.append(function)
+        for index in range(start - 1, end):
+            code[index] = None
+    if not removed:
+        return code, functions
+    for index, instruction in enumerate(code):
+        if instruction is not None and entries[index] is None and \
+                instruction[1][0] == LABEL and \
+                code[instruction[1][1]] is None:
+            code[index] = None
+
+    new_index = []
+    kept = 0
+    for instruction in code:
+        new_index.append(kept)
+        if instruction is not None:
+            kept += 1
+    new_index.append(kept)
+    code = compact(code)
+    dropped = set(function[0] for function in removed)
+    functions = [(new_index[start], new_index[end], return_slot, frame)
+                 for start, end, return_slot, frame in functions
+                 if start not in dropped]
+
+    used = set()
+    for instruction in code:
+        for i in data_operands(instruction):
+            used.add(instruction[i][1])
+    frames = set(function[3] for function in removed)
+    icg.allocations = [
+        allocation for allocation in icg.allocations
+        if allocation[2] not in frames or
+        any(address in used for address in range(allocation[0],
+                                                   allocation[0] +
+                                                   allocation[1]))]
+    return code, functions
+
+
+def optimize_program(icg, passes):
+    """Runs the whole-program passes among passes over the code of icg,
+    before the passes working on the code alone.
+
+    'inlining' replaces every call of a small function that calls nothing
+    but built-ins by a copy of its body writing the value straight to the
+    temporary of the call, so neither a return address nor the return
+    value are copied. Inlining is repeated, so callers that end up with
+    no calls left are inlined in turn; a function calling itself never
+    is. 'unreachable-functions' drops the functions main does not reach,
+    those left without a call by inlining included.
+    """
+    if not icg.functions or \
+            not any(name in passes for name in INTERPROCEDURAL_PASSES):
+        return
+    code = load(icg.program_block)
+    if code is None:
+        return
+    functions = icg.functions
+    if 'inlining' in passes:
+        while True:
+            code, inlined = inline_leaves(icg, code, functions)
+            if inlined is functions:
+                break
+            functions = inlined
+    if 'unreachable-functions' in passes:
+        code, functions = remove_unreachable(icg, code, functions)
+    icg.program_block = store(code)
+    icg.functions = functions
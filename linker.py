@@ -0,0 +1,429 @@
+import argparse
+import os
+import pickle
+import sys
+
+from compiler import CompileResult
+from grammar_compiler import load_parse_table
+from intermediate_code_generator import IntermediateCodeGenerator
+from optimizer import PASSES, TARGETS
+from parser import Diagram, Parser
+from program_block import OPCODES, DIRECT, INDIRECT, RAW, LABEL, ADDRESS
+from scanner import TokenStream
+from symbol_table import shape
+
+
+class LinkerException(Exception):
+    def __init__(self, message):
+        self.message = message
+        super(LinkerException, self).__init__(message)
+
+
+OBJECT_VERSION = 3
+OBJECT_MAGIC = b'CPOBJECT'
+OBJECT_SUFFIX = '.o'
+
+# what a relocation adds to the value it points at: the address the
+# object's code, data, temporaries or raw operands start at, or that of
+# an imported function's code or data
+CODE, DATA, TEMPORARY, RAW_OPERAND, IMPORT_CODE, IMPORT_DATA = range(6)
+
+# imported symbols get placeholder addresses past any temporary until the
+# linker resolves them
+IMPORT_BASE = 1 << 50
+
+
+class ObjectCodeGenerator(IntermediateCodeGenerator):
+    """An IntermediateCodeGenerator for one unit of a program.
+
+    The (name, entry) symbols in imports are declared up front at
+    placeholder addresses, and the end of the program neither requires
+    main nor jumps to it, which is left to the linker.
+    """
+
+    def __init__(self, imports=()):
+        super(ObjectCodeGenerator, self).__init__()
+        self.prologue = (len(self.program_block),
+                         len(self.program_block.raw), self.data_ptr,
+                         len(self.frames), len(self.allocations))
+        # placeholder address -> (name, offset), and the entry of every
+        # imported name
+        self.placeholders = {}
+        self.imported = {}
+        address = IMPORT_BASE
+        for name, entry in imports:
+            if entry[0] == 'func':
+                size = entry[4] + 2
+                placeholder = ('func', address, address, entry[3], entry[4])
+            else:
+                size = 1
+                placeholder = (entry[0], address)
+            self.symbol_table.declare(name, 0, placeholder)
+            self.imported[name] = placeholder
+            for offset in range(size):
+                self.placeholders[address + offset] = (name, offset)
+            address += size
+
+    def routine_end_program(self):
+        pass
+
+
+class ObjectFile(object):
+    """The relocatable code of one unit.
+
+    Code, raw operands, data, temporaries, frames, allocations and jump
+    tables are numbered from 0 within the object. relocations lists (position, kind,
+    name) for every operand, indexing values, that the linker has to move:
+    by where the object's code, data, temporaries or raw operands end up,
+    or, with name, by the address of that imported symbol. Operands naming
+    the built-in output function stay as they are.
+
+    declarations maps every global the unit declares to its entry and
+    exports the functions among them other units may call. imports maps
+    the symbols the unit uses from other units to their shape. Only
+    functions are exported, other globals stay private to their unit.
+    """
+
+    def __init__(self, name, icg):
+        self.name = name
+        program_block = icg.program_block
+        code_start, raw_start, data_start, frame_start, allocation_start = \
+            icg.prologue
+        code_end = len(program_block)
+        data_end = icg.data_ptr
+        temporary_start = icg.temporary_base
+        temporary_end = icg.temporary_ptr
+
+        self.opcodes = program_block.opcodes[code_start:]
+        self.modes = program_block.modes[code_start * 3:]
+        self.values = values = program_block.values[code_start * 3:]
+        self.raw = program_block.raw[raw_start:]
+        self.data_size = data_end - data_start
+        self.temporaries = temporary_end - temporary_start
+        self.frames = icg.frames[frame_start:]
+        self.allocations = [
+            (start - data_start, size,
+             None if frame is None else frame - frame_start)
+            for start, size, frame in icg.allocations[allocation_start:]]
+        self.temporary_frames = [
+            (first - temporary_start,
+             None if frame is None else frame - frame_start)
+            for first, frame in icg.temporary_frames]
+        self.functions = [
+            (start - code_start, end - code_start, return_slot - data_start,
+             frame - frame_start)
+            for start, end, return_slot, frame in icg.functions]
+        self.jump_tables = [
+            (start - data_start, [entry - code_start for entry in entries])
+            for start, entries in icg.jump_tables]
+
+        placeholders = icg.placeholders
+        used = set()
+        self.relocations = relocations = []
+        for index in range(len(self.opcodes)):
+            target = TARGETS.get(OPCODES[self.opcodes[index]])
+            for i in range(3):
+                position = index * 3 + i
+                mode = self.modes[position]
+                value = values[position]
+                if mode == LABEL or mode == DIRECT and target == i + 1:
+                    if code_start <= value <= code_end:
+                        relocations.append((position, CODE, None))
+                        values[position] = value - code_start
+                    elif value in placeholders:
+                        name, offset = placeholders[value]
+                        relocations.append((position, IMPORT_CODE, name))
+                        values[position] = offset
+                        used.add(name)
+                elif mode in (DIRECT, INDIRECT, ADDRESS):
+                    if temporary_start <= value < temporary_end:
+                        relocations.append((position, TEMPORARY, None))
+                        values[position] = value - temporary_start
+                    elif data_start <= value < data_end:
+                        relocations.append((position, DATA, None))
+                        values[position] = value - data_start
+                    elif value in placeholders:
+                        name, offset = placeholders[value]
+                        relocations.append((position, IMPORT_DATA, name))
+                        values[position] = offset
+                        used.add(name)
+                elif mode == RAW:
+                    relocations.append((position, RAW_OPERAND, None))
+                    values[position] = value - raw_start
+
+        self.imports = dict((name, shape(icg.imported[name]))
+                            for name in used)
+        self.declarations = {}
+        for name, bindings in icg.symbol_table.bindings.items():
+            scope, entry = bindings[0]
+            if scope != 0 or name in icg.imported and \
+                    entry is icg.imported[name]:
+                continue
+            if entry[0] == 'func':
+                if not code_start <= entry[1] < code_end:
+                    # the built-in output function
+                    continue
+                entry = ('func', entry[1] - code_start,
+                         entry[2] - data_start, entry[3], entry[4])
+            else:
+                entry = (entry[0], entry[1] - data_start)
+            self.declarations[name] = entry
+        self.exports = {}
+        main = self.declarations.get('main')
+        for name, entry in self.declarations.items():
+            # functions after main are compiled without a return
+            if entry[0] == 'func' and (main is None or main[0] != 'func' or
+                                       entry[1] <= main[1]):
+                self.exports[name] = entry
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(OBJECT_MAGIC)
+            pickle.dump((OBJECT_VERSION, self), f, pickle.HIGHEST_PROTOCOL)
+
+
+def load_object(path):
+    with open(path, 'rb') as f:
+        if f.read(len(OBJECT_MAGIC)) != OBJECT_MAGIC:
+            raise LinkerException("'%s' is not an object file." % path)
+        try:
+            version, unit = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError, ValueError,
+                AttributeError, ImportError):
+            raise LinkerException("'%s' is damaged." % path)
+    if version != OBJECT_VERSION:
+        raise LinkerException("'%s' was written by another version." % path)
+    return unit
+
+
+def compile_object(parse_table, source, imports=(), name=None,
+                   max_errors=None):
+    """Compiles source, a string or a text stream, into an ObjectFile that
+    may call the functions exported by the ObjectFiles in imports.
+
+    Returns (object, parser), object being None when the source has
+    errors, which the Parser holds.
+    """
+    symbols = [(symbol, entry) for unit in imports
+               for symbol, entry in unit.exports.items() if symbol != 'main']
+    return compile_unit(parse_table, source, symbols, name, max_errors)
+
+
+def compile_unit(parse_table, source, symbols=(), name=None,
+                 max_errors=None):
+    """Like compile_object, with the (name, entry) symbols the unit may use
+    given directly."""
+    icg = ObjectCodeGenerator(symbols)
+    parser = Parser(Diagram(parse_table, icg), max_errors)
+    tokens = TokenStream(source)
+    parser.feed(tokens)
+    parser.end(tokens.line)
+    if parser.has_errors() or not icg.is_ok:
+        return None, parser
+    return ObjectFile(name, icg), parser
+
+
+def link(objects, optimization_passes=None):
+    """Links ObjectFiles, in order, into one program starting at main.
+
+    Every import has to be exported by exactly one object with the same
+    kind and number of parameters. Returns a CompileResult.
+    """
+    icg = IntermediateCodeGenerator()
+    bases = place_objects(icg, objects)
+    symbols = {}
+    for unit, base in zip(objects, bases):
+        for name, entry in unit.exports.items():
+            if name in symbols:
+                raise LinkerException(
+                    "'%s' is defined in both '%s' and '%s'." % (
+                        name, symbols[name][0], unit.name))
+            symbols[name] = (unit.name, relocate_entry(entry, base))
+
+    for unit in objects:
+        for name, signature in sorted(unit.imports.items()):
+            if name not in symbols:
+                raise LinkerException("'%s' used in '%s' is not defined." %
+                                      (name, unit.name))
+            if shape(symbols[name][1]) != signature:
+                raise LinkerException(
+                    "'%s' used in '%s' does not match its definition in "
+                    "'%s'." % (name, unit.name, symbols[name][0]))
+    if 'main' not in symbols:
+        raise LinkerException('main function not found!')
+
+    resolved = dict((name, entry) for name, (_, entry) in symbols.items())
+    for unit, base in zip(objects, bases):
+        append_object(icg, unit, base, resolved)
+    return finish_program(icg, resolved['main'], optimization_passes)
+
+
+def place_objects(icg, objects):
+    """Returns where the code, raw operands, data, temporaries and frames
+    of every object start once appended to icg, in order."""
+    program_block = icg.program_block
+    code_base = len(program_block)
+    raw_base = len(program_block.raw)
+    data_base = icg.data_ptr
+    temporary_base = icg.temporary_ptr
+    frame_base = len(icg.frames)
+    bases = []
+    for unit in objects:
+        bases.append((code_base, raw_base, data_base, temporary_base,
+                      frame_base))
+        code_base += len(unit)
+        raw_base += len(unit.raw)
+        data_base += unit.data_size
+        temporary_base += unit.temporaries
+        frame_base += len(unit.frames)
+    return bases
+
+
+def relocate_entry(entry, base):
+    """Moves a symbol entry of an object to the base the object is
+    placed at."""
+    if entry[0] == 'func':
+        return ('func', entry[1] + base[0], entry[2] + base[2], entry[3],
+                entry[4])
+    return entry[0], entry[1] + base[2]
+
+
+def append_object(icg, unit, base, symbols):
+    """Appends unit to icg at base, resolving its imports in symbols, a
+    dict of placed entries."""
+    program_block = icg.program_block
+    code_base, raw_base, data_base, temporary_base, frame_base = base
+    offsets = {CODE: code_base, DATA: data_base,
+               TEMPORARY: temporary_base, RAW_OPERAND: raw_base}
+    values = unit.values[:]
+    for position, kind, name in unit.relocations:
+        if name is None:
+            values[position] += offsets[kind]
+        else:
+            entry = symbols[name]
+            values[position] += entry[1] if kind == IMPORT_CODE or \
+                entry[0] != 'func' else entry[2]
+    program_block.opcodes.extend(unit.opcodes)
+    program_block.modes.extend(unit.modes)
+    program_block.values.extend(values)
+    program_block.raw.extend(unit.raw)
+
+    icg.frames.extend(unit.frames)
+    icg.allocations.extend(
+        (start + data_base, size,
+         None if frame is None else frame + frame_base)
+        for start, size, frame in unit.allocations)
+    for first, frame in unit.temporary_frames:
+        if frame is not None:
+            frame += frame_base
+        if not icg.temporary_frames or \
+                icg.temporary_frames[-1][1] != frame:
+            icg.temporary_frames.append((first + temporary_base, frame))
+    icg.functions.extend(
+        (start + code_base, end + code_base, return_slot + data_base,
+         frame + frame_base)
+        for start, end, return_slot, frame in unit.functions)
+    icg.jump_tables.extend(
+        (start + data_base, [entry + code_base for entry in entries])
+        for start, entries in unit.jump_tables)
+    icg.data_ptr += unit.data_size
+    icg.temporary_ptr += unit.temporaries
+
+
+def finish_program(icg, main, optimization_passes=None):
+    """Jumps to main at the start of the program in icg, optimizes it
+    and lays it out. Returns a CompileResult."""
+    icg.start_program(main[1])
+    icg.finish(optimization_passes)
+    return CompileResult(icg.program_block, {}, {}, {}, icg.layout)
+
+
+def main(argv=None):
+    arguments = argparse.ArgumentParser(
+        description='Compiles sources to object files and links them.')
+    commands = arguments.add_subparsers(dest='command')
+    commands.required = True
+
+    compile_command = commands.add_parser(
+        'compile', help='compile a source to an object file')
+    compile_command.add_argument('source')
+    compile_command.add_argument('-o', '--output', default=None,
+                                 help='object file (default: the source '
+                                      'with a %s suffix)' % OBJECT_SUFFIX)
+    compile_command.add_argument('-i', '--import', dest='imports',
+                                 action='append', default=[],
+                                 metavar='OBJECT',
+                                 help='object whose functions the source '
+                                      'calls, may be repeated')
+    compile_command.add_argument('--errors', default=None,
+                                 help='error file (default: standard '
+                                      'error)')
+    compile_command.add_argument('--max-errors', type=int, default=None)
+    compile_command.add_argument('--grammar', default='grammar.txt')
+    compile_command.add_argument('--first-set', default=None)
+    compile_command.add_argument('--follow-set', default=None)
+
+    link_command = commands.add_parser(
+        'link', help='link object files into a program')
+    link_command.add_argument('objects', nargs='+')
+    link_command.add_argument('-o', '--output', default='output.txt')
+    link_command.add_argument('--binary', action='store_true')
+    link_command.add_argument('--layout', default=None,
+                              help='write the data layout to this file')
+    link_command.add_argument('-O', '--optimize', action='store_true',
+                              help='run every optimizer pass')
+    options = arguments.parse_args(argv)
+
+    try:
+        if options.command == 'compile':
+            return compile_command_main(options)
+        return link_command_main(options)
+    except LinkerException as e:
+        sys.stderr.write(e.message + '\n')
+        return 1
+
+
+def compile_command_main(options):
+    imports = [load_object(path) for path in options.imports]
+    parse_table = load_parse_table(options.grammar, options.first_set,
+                                   options.follow_set)
+    with open(options.source) as f:
+        unit, parser = compile_object(parse_table, f, imports,
+                                      os.path.basename(options.source),
+                                      options.max_errors)
+    errors = CompileResult(None, parser.scanner_errors,
+                           parser.parser_errors,
+                           parser.semantic_errors, None).errors()
+    if options.errors:
+        with open(options.errors, 'w') as f:
+            f.write(errors)
+    else:
+        sys.stderr.write(errors)
+    if unit is None:
+        return 1
+    output = options.output or \
+        os.path.splitext(options.source)[0] + OBJECT_SUFFIX
+    unit.save(output)
+    return 0
+
+
+def link_command_main(options):
+    objects = [load_object(path) for path in options.objects]
+    result = link(objects, PASSES if options.optimize else None)
+    if options.binary:
+        with open(options.output, 'wb') as f:
+            result.program_block.write_binary(f)
+    else:
+        with open(options.output, 'w') as f:
+            result.program_block.write_text(f)
+    if options.layout:
+        with open(options.layout, 'w') as f:
+            f.write(result.layout.report())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,343 @@
+from program_block import ProgramBlock, OPCODES, EMPTY, NONE, DIRECT, \
+    INDIRECT, IMMEDIATE, RAW, LABEL, ADDRESS
+
+# inlining and unreachable-functions work on the whole program, see
+# interprocedural.optimize_program
+PASSES = ('inlining', 'unreachable-functions', 'constant-folding',
+          'copy-propagation', 'dead-temporaries', 'jump-threading',
+          'jump-to-next')
+
+NO_OPERAND = (NONE, 0)
+CONSTANTS = (IMMEDIATE, ADDRESS)
+
+# positions (in [op, a, b, c]) of the operands an instruction reads, writes
+# and jumps to
+READS = {'ADD': (1, 2), 'SUB': (1, 2), 'MULT': (1, 2), 'LT': (1, 2),
+         'EQ': (1, 2), 'ASSIGN': (1,), 'JPF': (1,), 'PRINT': (1,), 'JP': ()}
+DESTINATIONS = {'ADD': 3, 'SUB': 3, 'MULT': 3, 'LT': 3, 'EQ': 3, 'ASSIGN': 2}
+TARGETS = {'JP': 1, 'JPF': 2}
+
+
+def to_word(value):
+    return (value + 0x80000000 & 0xFFFFFFFF) - 0x80000000
+
+
+FOLDS = {
+    'ADD': lambda x, y: to_word(x + y),
+    'SUB': lambda x, y: to_word(x - y),
+    'MULT': lambda x, y: to_word(x * y),
+    'LT': lambda x, y: 1 if x < y else 0,
+    'EQ': lambda x, y: 1 if x == y else 0,
+}
+
+
+def load(program_block):
+    """Returns the block as a list of [op, a, b, c] with (mode, value)
+    operands, or None when it is not a complete program."""
+    code = []
+    end = len(program_block)
+    for index in range(end):
+        opcode = program_block.opcodes[index]
+        if opcode == EMPTY:
+            return None
+        base = index * 3
+        instruction = [OPCODES[opcode]]
+        for i in range(base, base + 3):
+            mode = program_block.modes[i]
+            if mode == RAW:
+                return None
+            instruction.append((mode, program_block.values[i]))
+        target = TARGETS.get(instruction[0])
+        if target and instruction[target][0] == DIRECT and \
+                not 0 <= instruction[target][1] <= end:
+            return None
+        code.append(instruction)
+    for instruction in code:
+        for mode, value in instruction[1:]:
+            if mode == LABEL and not 0 <= value <= end:
+                return None
+    return code
+
+
+def store(code):
+    program_block = ProgramBlock()
+    for instruction in code:
+        program_block.append(tuple(instruction))
+    return program_block
+
+
+def labels(code):
+    return set(value for instruction in code
+               for mode, value in instruction[1:] if mode == LABEL)
+
+
+def find_leaders(code):
+    """Returns the indices that start a basic block."""
+    leaders = set([0]) | labels(code)
+    for index, instruction in enumerate(code):
+        target = TARGETS.get(instruction[0])
+        if target:
+            if instruction[target][0] == DIRECT:
+                leaders.add(instruction[target][1])
+            leaders.add(index + 1)
+    return leaders
+
+
+def basic_blocks(code):
+    """Splits code into (start, end) ranges of basic blocks."""
+    leaders = sorted(leader for leader in find_leaders(code)
+                     if leader < len(code))
+    return list(zip(leaders, leaders[1:] + [len(code)]))
+
+
+def compact(code):
+    """Drops the instructions replaced by None and renumbers code addresses.
+
+    A jump to a dropped instruction goes to the next instruction kept.
+    """
+    new_index = []
+    kept = 0
+    for instruction in code:
+        new_index.append(kept)
+        if instruction is not None:
+            kept += 1
+    new_index.append(kept)
+
+    result = []
+    for instruction in code:
+        if instruction is None:
+            continue
+        target = TARGETS.get(instruction[0])
+        for i in range(1, 4):
+            mode, value = instruction[i]
+            if mode == LABEL or (i == target and mode == DIRECT):
+                instruction[i] = (mode, new_index[value])
+        result.append(instruction)
+    return result
+
+
+def fold_constants(name, x, y):
+    """Returns the constant operand name computes from x and y, or None.
+
+    A data address stays one when a constant is added to or subtracted
+    from it, so it can still be relocated; nothing else is folded with it.
+    """
+    if x[0] not in CONSTANTS or y[0] not in CONSTANTS:
+        return None
+    if x[0] == IMMEDIATE == y[0]:
+        return IMMEDIATE, FOLDS[name](x[1], y[1])
+    if name == 'ADD' and IMMEDIATE in (x[0], y[0]) or \
+            name == 'SUB' and y[0] == IMMEDIATE:
+        return ADDRESS, FOLDS[name](x[1], y[1])
+    return None
+
+
+class Propagation(object):
+    """Constants and copies known to be held by direct addresses."""
+
+    def __init__(self):
+        self.values = {}
+        self.copies = {}
+
+    def substitute(self, operand):
+        mode, value = operand
+        known = self.values.get(value)
+        if known is None or mode not in (DIRECT, INDIRECT):
+            return operand
+        if mode == DIRECT:
+            return known
+        if known[0] in CONSTANTS:
+            return (DIRECT, known[1]) if known[1] >= 0 else operand
+        return INDIRECT, known[1]
+
+    def kill(self, address):
+        known = self.values.pop(address, None)
+        if known is not None and known[0] == DIRECT:
+            self.copies[known[1]].discard(address)
+        for copy in self.copies.pop(address, ()):
+            del self.values[copy]
+
+    def record(self, address, operand):
+        self.values[address] = operand
+        if operand[0] == DIRECT:
+            self.copies.setdefault(operand[1], set()).add(address)
+
+    def clear(self):
+        self.values.clear()
+        self.copies.clear()
+
+
+def propagate(code, fold=True, copy=True):
+    """Constant folding and copy propagation inside basic blocks."""
+    for start, end in basic_blocks(code):
+        known = Propagation()
+        for index in range(start, end):
+            instruction = code[index]
+            name = instruction[0]
+            for i in READS[name]:
+                instruction[i] = known.substitute(instruction[i])
+            destination = DESTINATIONS.get(name)
+            if destination and instruction[destination][0] == INDIRECT:
+                instruction[destination] = known.substitute(
+                    instruction[destination])
+
+            folded = fold and name in FOLDS and \
+                fold_constants(name, instruction[1], instruction[2])
+            if folded:
+                instruction = code[index] = ['ASSIGN', folded,
+                                             instruction[3], NO_OPERAND]
+                name = 'ASSIGN'
+                destination = 2
+            elif fold and name == 'JPF' and instruction[1][0] == IMMEDIATE:
+                if instruction[1][1] == 0:
+                    code[index] = ['JP', instruction[2], NO_OPERAND,
+                                   NO_OPERAND]
+                else:
+                    code[index] = None
+                continue
+
+            if not destination:
+                continue
+            mode, address = instruction[destination]
+            if mode != DIRECT:
+                known.clear()
+                continue
+            if name == 'ASSIGN' and instruction[1] == instruction[2]:
+                code[index] = None
+                continue
+            known.kill(address)
+            if name == 'ASSIGN':
+                source = instruction[1]
+                if fold and source[0] in CONSTANTS or \
+                        copy and source[0] == DIRECT:
+                    known.record(address, source)
+    return compact(code)
+
+
+def remove_dead_temporaries(code, temporaries):
+    """Drops writes to temporaries nobody reads and stores a temporary
+    that is only copied elsewhere straight to its final place."""
+    low, high = temporaries
+    changed = True
+    while changed:
+        changed = False
+        reads = {}
+        writes = {}
+        for instruction in code:
+            name = instruction[0]
+            operands = [instruction[i] for i in READS[name]]
+            destination = DESTINATIONS.get(name)
+            if destination:
+                mode, address = instruction[destination]
+                if mode == DIRECT:
+                    writes[address] = writes.get(address, 0) + 1
+                else:
+                    operands.append((DIRECT, address))
+            if name == 'JP' and instruction[1][0] == INDIRECT:
+                operands.append((DIRECT, instruction[1][1]))
+            for mode, address in operands:
+                if mode in (DIRECT, INDIRECT):
+                    reads[address] = reads.get(address, 0) + 1
+
+        leaders = find_leaders(code)
+        for index, instruction in enumerate(code):
+            if instruction is None:
+                continue
+            destination = DESTINATIONS.get(instruction[0])
+            if not destination:
+                continue
+            mode, address = instruction[destination]
+            if mode != DIRECT or not low <= address < high:
+                continue
+            if not reads.get(address):
+                code[index] = None
+                changed = True
+                continue
+
+            following = index + 1
+            if reads[address] == 1 and writes[address] == 1 and \
+                    following < len(code) and following not in leaders and \
+                    code[following] is not None and \
+                    code[following][0] == 'ASSIGN' and \
+                    code[following][1] == (DIRECT, address):
+                instruction[destination] = code[following][2]
+                code[following] = None
+                changed = True
+        code = compact(code)
+    return code
+
+
+def thread_jumps(code):
+    """Points jumps past chains of unconditional jumps and drops the code
+    no jump can reach any more."""
+    end = len(code)
+    for instruction in code:
+        target = TARGETS.get(instruction[0])
+        if not target or instruction[target][0] != DIRECT:
+            continue
+        address = instruction[target][1]
+        seen = set()
+        while address < end and address not in seen and \
+                code[address][0] == 'JP' and code[address][1][0] == DIRECT:
+            seen.add(address)
+            address = code[address][1][1]
+        instruction[target] = (DIRECT, address)
+
+    indirect_targets = sorted(labels(code))
+    reachable = [False] * end
+    pending = [0]
+    while pending:
+        index = pending.pop()
+        while index < end and not reachable[index]:
+            reachable[index] = True
+            instruction = code[index]
+            target = TARGETS.get(instruction[0])
+            if target:
+                mode, address = instruction[target]
+                if mode == DIRECT:
+                    pending.append(address)
+                else:
+                    pending.extend(indirect_targets)
+                    indirect_targets = []
+                if instruction[0] == 'JP':
+                    break
+            index += 1
+    return compact([instruction if reachable[index] else None
+                    for index, instruction in enumerate(code)])
+
+
+def remove_jumps_to_next(code):
+    changed = True
+    while changed:
+        changed = False
+        for index, instruction in enumerate(code):
+            target = TARGETS.get(instruction[0])
+            if target and instruction[target] == (DIRECT, index + 1):
+                code[index] = None
+                changed = True
+        code = compact(code)
+    return code
+
+
+def optimize(program_block, temporaries=None, passes=PASSES):
+    """Returns an optimized copy of program_block.
+
+    passes names the passes to run, temporaries is the (low, high) range of
+    addresses holding nothing but temporaries and is needed to drop dead
+    ones. Incomplete programs (with empty slots) are returned unchanged.
+    """
+    code = load(program_block)
+    if code is None:
+        return program_block
+
+    fold = 'constant-folding' in passes
+    copy = 'copy-propagation' in passes
+    if fold or copy:
+        code = propagate(code, fold, copy)
+    if 'dead-temporaries' in passes and temporaries is not None:
+        code = remove_dead_temporaries(code, temporaries)
+    if 'jump-threading' in passes:
+        code = thread_jumps(code)
+    if 'jump-to-next' in passes:
+        code = remove_jumps_to_next(code)
+    return store(code)
@@ -0,0 +1,263 @@
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from compiler import CompileResult
+from grammar_compiler import load_parse_table
+from intermediate_code_generator import IntermediateCodeGenerator
+from linker import compile_unit, place_objects, relocate_entry, \
+    append_object, finish_program
+from optimizer import PASSES
+from parser import parse_source
+from scanner import match
+from symbol_table import shape
+
+# a ';' or '}' ends a top-level declaration unless it is in a comment,
+# the only tokens they can be part of
+DECLARATION_END = re.compile(r'//[^\n]*|/\*.*?\*/|[{};]', re.S)
+# sources shorter than this compile serially, a pool round trip costs more
+PARALLEL_MIN_SIZE = 1 << 16
+CHUNKS_PER_WORKER = 4
+
+# the parse table of a worker process, set up once by init_worker
+parse_table = None
+
+
+def declaration_ends(text):
+    """Returns the offsets just past every top-level declaration of
+    text."""
+    ends = []
+    depth = 0
+    for found in DECLARATION_END.finditer(text):
+        token = found.group()
+        if token == '{':
+            depth += 1
+        elif token == '}' or token == ';':
+            if token == '}':
+                depth -= 1
+            if depth <= 0:
+                depth = 0
+                ends.append(found.end())
+    return ends
+
+
+def declaration_signature(text, start, end):
+    """Returns (name, entry) for the declaration in text[start:end], the
+    entry without addresses, or None when its head does not read as a
+    variable, array or function declaration."""
+    tokens = []
+    pointer = start
+    while pointer < end:
+        token_type, pointer_end = match(text, pointer)
+        if token_type is None:
+            return None
+        if token_type not in ('W', 'COMMENT'):
+            token = text[pointer:pointer_end]
+            tokens.append(token)
+            if token in (';', '{', ')'):
+                break
+        pointer = pointer_end
+    if len(tokens) < 3 or tokens[0] not in ('int', 'void'):
+        return None
+    kind, name = tokens[0], tokens[1]
+    rest = tokens[2:]
+    if rest == [';'] and kind == 'int':
+        return name, ('int', None)
+    if len(rest) == 4 and rest[0] == '[' and rest[2:] == [']', ';'] and \
+            kind == 'int':
+        return name, ('arr', None)
+    if rest[0] == '(' and rest[-1] == ')':
+        parameters = rest[1:-1]
+        if parameters == ['void']:
+            return name, ('func', None, None, kind, 0)
+        if parameters:
+            return name, ('func', None, None, kind,
+                          parameters.count(',') + 1)
+    return None
+
+
+def split_chunks(text, ends, count):
+    """Splits text at declaration ends into at most count chunks of about
+    the same size. Returns [(start, end, number of declarations)]."""
+    chunks = []
+    target = len(text) / count
+    start = 0
+    declarations = 0
+    for end in ends:
+        declarations += 1
+        if end - start >= target:
+            chunks.append((start, end, declarations))
+            start = end
+            declarations = 0
+    if start < len(text) or declarations:
+        # the text after the last declaration goes with the last chunk
+        if chunks and not declarations:
+            last_start, _, last_declarations = chunks.pop()
+            chunks.append((last_start, len(text), last_declarations))
+        else:
+            chunks.append((start, len(text), declarations))
+    return chunks
+
+
+def init_worker(table):
+    global parse_table
+    parse_table = table
+
+
+def compile_chunk(task):
+    """Compiles one chunk in a worker. Returns an ObjectFile, or None when
+    it has errors."""
+    text, symbols = task
+    unit, _ = compile_unit(parse_table, text, symbols)
+    return unit
+
+
+class ParallelCompiler(object):
+    """Compiles a large source with its top-level declarations spread over
+    a pool of worker processes.
+
+    A pre-pass splits the source into declarations and reads the name and
+    signature of each from its head, which is all the code calling a
+    function or using a global depends on. The declarations are grouped
+    into chunks and every chunk is compiled as a linker object, with the
+    globals declared before it known at placeholder addresses. The
+    objects are then relocated back to back, in source order, so they get
+    the addresses a serial compile hands out and the program is the same.
+
+    Whenever the chunks do not line up with a serial compile, a chunk has
+    errors or the pre-pass could not read a declaration, the source is
+    compiled serially instead, so errors are always those of a serial
+    compile.
+    """
+
+    def __init__(self, parse_table, workers=None,
+                 min_size=PARALLEL_MIN_SIZE):
+        self.parse_table = parse_table
+        self.workers = workers or os.cpu_count() or 1
+        self.min_size = min_size
+        self.pool = None
+
+    def start(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers, init_worker,
+                                             (self.parse_table,))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def compile(self, source, optimization_passes=None):
+        """Compiles source, a string or a text stream, into a CompileResult
+        equal to the one of a serial compile."""
+        if not isinstance(source, str):
+            source = source.read()
+        result = None
+        if self.workers > 1 and len(source) >= self.min_size:
+            result = self.compile_chunks(source, optimization_passes)
+        if result is None:
+            result = CompileResult(*parse_source(self.parse_table, source,
+                                                 optimization_passes))
+        return result
+
+    def compile_chunks(self, text, optimization_passes=None):
+        """Returns the CompileResult of the parallel compile of text, or
+        None when it has to be compiled serially."""
+        ends = declaration_ends(text)
+        chunks = split_chunks(text, ends,
+                              self.workers * CHUNKS_PER_WORKER)
+        if len(chunks) < 2:
+            return None
+
+        tasks = []
+        expected = []
+        visible = {}
+        start = 0
+        declaration = 0
+        for chunk_start, chunk_end, declarations in chunks:
+            tasks.append((text[chunk_start:chunk_end],
+                          list(visible.items())))
+            declared = {}
+            for end in ends[declaration:declaration + declarations]:
+                signature = declaration_signature(text, start, end)
+                if signature is None:
+                    return None
+                declared[signature[0]] = signature[1]
+                start = end
+            declaration += declarations
+            visible.update(declared)
+            expected.append(declared)
+        main = visible.get('main')
+        if main is None or main[0] != 'func':
+            # the serial compile reports the missing main
+            return None
+
+        objects = self.start().map(compile_chunk, tasks, 1)
+        for unit, declared in zip(objects, expected):
+            if unit is None or len(unit.declarations) != len(declared):
+                return None
+            for name, entry in unit.declarations.items():
+                if name not in declared or \
+                        shape(entry) != shape(declared[name]):
+                    return None
+
+        icg = IntermediateCodeGenerator()
+        symbols = {}
+        for unit, base in zip(objects, place_objects(icg, objects)):
+            append_object(icg, unit, base, symbols)
+            for name, entry in unit.declarations.items():
+                symbols[name] = relocate_entry(entry, base)
+        return finish_program(icg, symbols['main'], optimization_passes)
+
+
+def main(argv=None):
+    arguments = argparse.ArgumentParser(
+        description='Compiles a large source on several cores.')
+    arguments.add_argument('source')
+    arguments.add_argument('-o', '--output', default='output.txt')
+    arguments.add_argument('-e', '--errors', default='errors.txt')
+    arguments.add_argument('-j', '--workers', type=int, default=None,
+                           help='worker processes (default: one per CPU)')
+    arguments.add_argument('--binary', action='store_true')
+    arguments.add_argument('--optimize', action='store_true',
+                           help='run all optimization passes')
+    arguments.add_argument('--grammar', default='grammar.txt')
+    arguments.add_argument('--first-set', default=None)
+    arguments.add_argument('--follow-set', default=None)
+    options = arguments.parse_args(argv)
+    if options.workers is not None and options.workers < 1:
+        arguments.error('the number of workers must be positive')
+
+    table = load_parse_table(options.grammar, options.first_set,
+                             options.follow_set)
+    start = time.time()
+    with ParallelCompiler(table, options.workers) as compiler:
+        with open(options.source) as f:
+            result = compiler.compile(f, PASSES if options.optimize
+                                      else None)
+    if options.binary:
+        with open(options.output, 'wb') as f:
+            result.program_block.write_binary(f)
+    else:
+        with open(options.output, 'w') as f:
+            result.program_block.write_text(f)
+    with open(options.errors, 'w') as f:
+        f.write(result.errors())
+    sys.stdout.write('%d instructions, %.2fs\n' % (
+        len(result.program_block), time.time() - start))
+    return 0 if result.is_ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
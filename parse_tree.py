@@ -0,0 +1,205 @@
+import argparse
+import json
+import sys
+from array import array
+
+from grammar_compiler import load_parse_table, POP, PUSH
+from parser import Diagram, Parser, MATCHED, STEPPED
+from scanner import TokenStream
+
+
+class ParseTree(object):
+    """A parse tree stored column-wise, one entry per node in preorder.
+
+    symbols holds the symbol id of every node, parents the index of its
+    parent (-1 for the root) and starts and ends the span of matched tokens
+    below it. A terminal node covers exactly its own token, whose text and
+    line are in tokens and token_lines.
+    """
+
+    def __init__(self, parse_table):
+        self.symbol_names = list(parse_table.non_terminals) + \
+            list(parse_table.terminals)
+        self.symbol_ids = dict((name, i)
+                               for i, name in enumerate(self.symbol_names))
+        # symbol ids below this one are non-terminals
+        self.terminal_base = len(parse_table.non_terminals)
+        self.symbols = array('H')
+        self.parents = array('i')
+        self.starts = array('i')
+        self.ends = array('i')
+        self.tokens = []
+        self.token_lines = array('i')
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def add(self, symbol, parent):
+        """Opens a node for the non-terminal symbol and returns its index."""
+        self.symbols.append(self.symbol_ids[symbol])
+        self.parents.append(parent)
+        self.starts.append(len(self.tokens))
+        self.ends.append(-1)
+        return len(self.symbols) - 1
+
+    def close(self, node):
+        self.ends[node] = len(self.tokens)
+
+    def add_token(self, symbol, parent, token, line):
+        start = len(self.tokens)
+        self.symbols.append(self.symbol_ids[symbol])
+        self.parents.append(parent)
+        self.starts.append(start)
+        self.ends.append(start + 1)
+        self.tokens.append(token)
+        self.token_lines.append(line)
+
+    def is_terminal(self, node):
+        return self.symbols[node] >= self.terminal_base
+
+    def depths(self):
+        """Yields (node, depth) in preorder."""
+        depths = []
+        parents = self.parents
+        for node in range(len(self.symbols)):
+            parent = parents[node]
+            depth = depths[parent] + 1 if parent >= 0 else 0
+            depths.append(depth)
+            yield node, depth
+
+    def write_text(self, f, indent='  ', buffer_size=1 << 12):
+        """Writes one node per line, indented by depth."""
+        names = self.symbol_names
+        lines = []
+        for node, depth in self.depths():
+            name = names[self.symbols[node]]
+            if self.is_terminal(node):
+                start = self.starts[node]
+                lines.append('%s%s %r (line %d)\n' % (
+                    indent * depth, name, self.tokens[start],
+                    self.token_lines[start] + 1))
+            else:
+                lines.append('%s%s [%d, %d)\n' % (
+                    indent * depth, name, self.starts[node], self.ends[node]))
+            if len(lines) == buffer_size:
+                f.write(''.join(lines))
+                lines = []
+        f.write(''.join(lines))
+
+    def write_json(self, f, buffer_size=1 << 12):
+        """Writes the tree as nested JSON objects without building them in
+        memory."""
+        names = self.symbol_names
+        parents = self.parents
+        parts = []
+        # the chain of non-terminals from the root to the last node written
+        path = []
+        for node in range(len(self.symbols)):
+            while path and path[-1] != parents[node]:
+                path.pop()
+                parts.append(']}')
+            if path and parts[-1] != '[':
+                parts.append(', ')
+            name = json.dumps(names[self.symbols[node]])
+            start = self.starts[node]
+            if self.is_terminal(node):
+                parts.append('{"symbol": %s, "token": %s, "line": %d}' % (
+                    name, json.dumps(self.tokens[start]),
+                    self.token_lines[start] + 1))
+            else:
+                parts.append('{"symbol": %s, "span": [%d, %d], '
+                             '"children": ' % (name, start, self.ends[node]))
+                parts.append('[')
+                path.append(node)
+            if len(parts) >= buffer_size:
+                # keep the last part, the check for a first child reads it
+                f.write(''.join(parts[:-1]))
+                del parts[:-1]
+        parts.append(']}' * len(path))
+        parts.append('\n')
+        f.write(''.join(parts))
+
+
+class TreeDiagram(Diagram):
+    """A Diagram that also builds a ParseTree. Plain Diagrams build none,
+    so a compile only pays for the tree when it asks for one."""
+
+    def __init__(self, parse_table, intermediate_code_generator=None):
+        super(TreeDiagram, self).__init__(parse_table,
+                                          intermediate_code_generator)
+        self.tree = ParseTree(parse_table)
+        # the open node of every entry of the stack
+        self.nodes = [self.tree.add('Program', -1)]
+        self.line = 0
+
+    def move_forward(self, terminal, token):
+        kind, _, key = self.table[self.stack[-1] + self.terminal_ids.get(
+            terminal, self.other_terminal)]
+        status = super(TreeDiagram, self).move_forward(terminal, token)
+        if status == MATCHED:
+            self.tree.add_token(key, self.nodes[-1], token, self.line)
+        elif status == STEPPED:
+            if kind == PUSH:
+                self.nodes.append(self.tree.add(key, self.nodes[-1]))
+            elif kind == POP:
+                self.tree.close(self.nodes.pop())
+        return status
+
+    def finish_tree(self):
+        """Closes the nodes still open at the end of the input."""
+        for node in self.nodes:
+            self.tree.close(node)
+        return self.tree
+
+
+class TreeParser(Parser):
+    def feed(self, tokens):
+        super(TreeParser, self).feed(self.track_lines(tokens))
+
+    def track_lines(self, tokens):
+        diagram = self.diagram
+        for token in tokens:
+            diagram.line = token[0]
+            yield token
+
+
+def build_parse_tree(parse_table, source):
+    """Parses source, a string or a text stream, and returns the
+    ParseTree and the Parser holding the errors."""
+    parser = TreeParser(TreeDiagram(parse_table))
+    tokens = TokenStream(source)
+    parser.feed(tokens)
+    parser.end(tokens.line)
+    return parser.diagram.finish_tree(), parser
+
+
+def main(argv=None):
+    arguments = argparse.ArgumentParser(
+        description='Writes the parse tree of a source.')
+    arguments.add_argument('source')
+    arguments.add_argument('-o', '--output', default=None,
+                           help='tree file (default: standard output)')
+    arguments.add_argument('--json', action='store_true')
+    arguments.add_argument('--grammar', default='grammar.txt')
+    arguments.add_argument('--first-set', default=None)
+    arguments.add_argument('--follow-set', default=None)
+    options = arguments.parse_args(argv)
+
+    parse_table = load_parse_table(options.grammar, options.first_set,
+                                   options.follow_set)
+    with open(options.source) as f:
+        tree, parser = build_parse_tree(parse_table, f)
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        if options.json:
+            tree.write_json(output)
+        else:
+            tree.write_text(output)
+    finally:
+        if options.output:
+            output.close()
+    return 1 if parser.has_errors() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
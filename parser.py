@@ -1,231 +1,296 @@
 from collections import defaultdict
 
+from grammar_compiler import load_parse_table, POP, ROUTINE, MOVE, MATCH_TOKEN, \
+    MATCH_NUMBER, PUSH, MISSING, UNEXPECTED
 from intermediate_code_generator import IntermediateCodeGenerator, SemanticException
-from scanner import tokenize, ScannerException
+from scanner import TokenStream
 
+# what Diagram.move_forward did with a token: took a step and wants the
+# same token again, matched it, reported it missing a symbol (the diagram
+# moved past the symbol and wants the token again) or reported it
+# unexpected (the token has to be skipped)
+STEPPED, MATCHED, MISSED, UNMATCHED = range(4)
 
-class ParserException(Exception):
-    def __init__(self, message):
-        self.message = message
-        super(ParserException, self).__init__()
 
+class Diagram(object):
+    def __init__(self, parse_table, intermediate_code_generator=None):
+        self.parse_table = parse_table
+        self.table = parse_table.table
+        self.start_rows = parse_table.start_rows
+        self.terminal_ids = parse_table.terminal_ids
+        self.other_terminal = parse_table.other_terminal
 
-class ParserExceptionWithoutSkip(Exception):
-    def __init__(self, message):
-        self.message = message
-        super(ParserExceptionWithoutSkip, self).__init__()
-
+        self.stack = [self.start_rows['Program']]
+        # message of the last MISSED or UNMATCHED step
+        self.error = None
 
-class Diagram(object):
-    def __init__(self, grammar, first_set, follow_set):
-        self.non_terminals = grammar.keys()
-
-        self.actions = {}
-        self.accept_states = {}
-        for non_terminal in grammar.keys():
-            graph, accept_state = Diagram.create_graph(grammar[non_terminal])
-            self.actions[non_terminal] = graph
-            self.accept_states[non_terminal] = accept_state
-
-        self.first_set = first_set
-        self.follow_set = follow_set
-        self.stack = [('Program', 0)]  # list of pair (non_terminal, state)
-        self.parse_tree = [('Program', 0)]
-
-        self.intermediate_code_generator = IntermediateCodeGenerator()
-
-    @staticmethod
-    def create_graph(rules):
-        graph = defaultdict(dict)
-        current_state = 2
-        for rule in rules:
-            last_state = 0
-            for part in rule[:-1]:
-                graph[last_state].update({part: current_state})
-                last_state = current_state
-                current_state += 1
-            graph[last_state].update({rule[-1]: 1})
-        return graph, 1
+        self.intermediate_code_generator = intermediate_code_generator \
+            if intermediate_code_generator is not None \
+            else IntermediateCodeGenerator()
 
     def move_forward(self, terminal, token):
-        last_non_terminal, last_state = self.stack[-1]
-        if last_state == self.accept_states[last_non_terminal]:
+        """Takes one step on terminal and returns what it did with it.
+
+        Errors are recovered from with what the parse table precomputed
+        from the FOLLOW sets: a terminal, or a non-terminal the token may
+        follow, that is missing is stepped over, any other token is
+        skipped until one the current state can go on with arrives. Every
+        step either matches, skips, pushes, pops or advances the top state
+        along its rule, so parsing takes time linear in the input.
+        """
+        row = self.stack[-1]
+        kind, target, key = self.table[
+            row + self.terminal_ids.get(terminal, self.other_terminal)]
+
+        if kind == PUSH:
+            self.stack[-1] = target
+            self.stack.append(self.start_rows[key])
+            return STEPPED
+
+        if kind == POP:
+            if len(self.stack) == 1:
+                # input after the end of the program
+                self.error = "Syntax Error! Unexpected #%s" % terminal
+                return UNMATCHED
             self.stack.pop()
-            return False
-
-        for key, value in self.actions[last_non_terminal][last_state].items():
-            if key.startswith('#'):
-                self.stack[-1] = (last_non_terminal, value)
-                self.intermediate_code_generator.run_routine(key[1:])
-                return False
-
-            if key not in self.non_terminals:
-                if key == 'eps' and terminal in \
-                        self.follow_set[last_non_terminal]:
-                    self.stack[-1] = (last_non_terminal, value)
-                    return False
-
-                if key == terminal:
-                    if key in ('int', 'void', 'ID'):
-                        self.intermediate_code_generator.semantic_stack.append(
-                            token)
-                    if key == 'NUM':
-                        self.intermediate_code_generator.semantic_stack.append(
-                            '#%s' % token
-                        )
-
-                    self.stack[-1] = (last_non_terminal, value)
-                    self.parse_tree.append((key, len(self.stack)))
-                    return True
-                continue
-
-            if terminal in self.first_set[key] or \
-                    ('eps' in self.first_set[key] and
-                     terminal in self.follow_set[key]):
-                self.stack[-1] = (last_non_terminal, value)
-                self.parse_tree.append((key, len(self.stack)))
-                self.stack.append((key, 0))
-                return False
-
-        key, value = list(self.actions[last_non_terminal]
-                          [last_state].items())[0]
-        if key not in self.non_terminals:
-            self.stack[-1] = (last_non_terminal, value)
-            raise ParserExceptionWithoutSkip(
-                message="Syntax Error! Missing #%s" % key)
-        else:
-            if terminal in self.follow_set[key]:
-                self.stack[-1] = (last_non_terminal, value)
-                raise ParserExceptionWithoutSkip(
-                    message="Syntax Error! Missing #%s" % key)
-
-            raise ParserException(message="Syntax Error! Unexpected #%s" %
-                                          terminal)
+            return STEPPED
+
+        if kind == ROUTINE:
+            self.stack[-1] = target
+            self.intermediate_code_generator.run_routine(key)
+            return STEPPED
+
+        if kind == MOVE:
+            self.stack[-1] = target
+            return STEPPED
+
+        if kind == MATCH_TOKEN:
+            self.intermediate_code_generator.semantic_stack.append(token)
+        elif kind == MATCH_NUMBER:
+            self.intermediate_code_generator.semantic_stack.append(
+                '#%s' % token)
+        elif kind == MISSING:
+            self.stack[-1] = target
+            self.error = key
+            return MISSED
+        elif kind == UNEXPECTED:
+            self.error = "Syntax Error! Unexpected #%s" % terminal
+            return UNMATCHED
+
+        self.stack[-1] = target
+        return MATCHED
 
 
 class Parser(object):
-    def __init__(self, diagram):
-        self.diagram = diagram
+    """Drives a Diagram over tokens and collects the errors.
 
-    def parse(self, input_str):
-        pointer = 0
-        scanner_errors = defaultdict(list)
-        parser_errors = defaultdict(list)
-        semantic_errors = defaultdict(list)
+    The routines keep running after a syntax error, so later semantic
+    errors are still reported; code generation stops when one of them
+    cannot run on the semantic stack left by recovery. With max_errors the
+    parser stops for good once that many errors were reported.
+    """
 
-        number_of_failure = 0
-        while pointer < len(input_str):
-            line_number = input_str[0:pointer].count('\n')
-            try:
-                token_type, token = tokenize(input_str, pointer)
-                if token_type in ['W', 'COMMENT']:
-                    pointer += len(token)
-                    continue
+    def __init__(self, diagram, max_errors=None):
+        self.diagram = diagram
+        self.scanner_errors = defaultdict(list)
+        self.parser_errors = defaultdict(list)
+        self.semantic_errors = defaultdict(list)
+        self.number_of_failure = 0
+        self.max_errors = max_errors
+        self.number_of_errors = 0
+        self.stopped = False
+
+    def count_error(self, line_number):
+        """Counts an error reported on line_number and returns whether the
+        parser has to stop."""
+        self.number_of_errors += 1
+        if self.max_errors is not None and \
+                self.number_of_errors >= self.max_errors:
+            self.parser_errors[line_number].append(
+                "Too many errors, compilation stopped.")
+            self.stopped = True
+        return self.stopped
+
+    def semantic_error(self, line_number, message):
+        """Reports a semantic error raised outside feed and end, counted
+        like the others. Returns whether the parser has to stop."""
+        if self.stopped:
+            return True
+        self.semantic_errors[line_number].append(message)
+        self.diagram.intermediate_code_generator.is_ok = False
+        return self.count_error(line_number)
+
+    def feed(self, tokens):
+        """Runs the diagram over tokens, (line_number, token_type, token)
+        tuples as a TokenStream yields them."""
+        if self.stopped:
+            return
+        scanner_errors = self.scanner_errors
+        parser_errors = self.parser_errors
+        semantic_errors = self.semantic_errors
+        move_forward = self.diagram.move_forward
+        icg = self.diagram.intermediate_code_generator
+
+        number_of_failure = self.number_of_failure
+        for line_number, token_type, token in tokens:
+            if token_type is None:
+                scanner_errors[line_number].append(token)
+                if self.count_error(line_number):
+                    break
+                continue
+            if token_type in ['W', 'COMMENT']:
+                continue
 
-                terminal = token if token_type in ['SYMBOL', 'KEYWORD'] \
-                    else token_type
+            terminal = token if token_type in ['SYMBOL', 'KEYWORD'] \
+                else token_type
 
+            while True:
                 try:
-                    while True:
-                        try:
-                            if self.diagram.move_forward(terminal, token):
-                                break
-                        except ParserExceptionWithoutSkip as e:
-                            parser_errors[line_number].append(e.message)
-                            number_of_failure = number_of_failure + 1
-                        except SemanticException as e:
-                            semantic_errors[line_number].append(e.message)
-                            self.diagram.intermediate_code_generator.is_ok = False
+                    status = move_forward(terminal, token)
+                except SemanticException as e:
+                    semantic_errors[line_number].append(e.message)
+                    icg.is_ok = False
+                    if self.count_error(line_number):
+                        break
+                    continue
+                if status == STEPPED:
+                    continue
+                if status == MATCHED:
                     number_of_failure = 0
-                except ParserException as e:
-                    parser_errors[line_number].append(e.message)
-                    number_of_failure = number_of_failure + 1
-
-            except ScannerException as e:
-                token = e.message
-                scanner_errors[line_number].append(token)
-            pointer += len(token)
-
-        try:
-            while not self.diagram.move_forward('$', '$'):
-                pass
-        except SemanticException as e:
-            line_number = input_str.count('\n')
-            semantic_errors[line_number].append(e.message)
-            self.diagram.intermediate_code_generator.is_ok = False
-        except ParserException:
-            line_number = input_str.count('\n')
-            if number_of_failure > 0:
-                parser_errors[line_number].append(
-                    "Syntax Error! Unexpected EndOfFile")
-            else:
-                parser_errors[line_number].append(
-                    "Syntax Error! Malformed Input")
-
-        return self.diagram.intermediate_code_generator.program_block, scanner_errors, parser_errors, semantic_errors
+                    break
+                parser_errors[line_number].append(self.diagram.error)
+                number_of_failure = number_of_failure + 1
+                icg.recovering = True
+                if self.count_error(line_number) or status == UNMATCHED:
+                    break
+            if self.stopped:
+                break
+        self.number_of_failure = number_of_failure
+
+    def end(self, line_number):
+        """Runs the diagram to the end of the input, on line_number."""
+        if self.stopped:
+            return
+        icg = self.diagram.intermediate_code_generator
+        while True:
+            try:
+                status = self.diagram.move_forward('$', '$')
+            except SemanticException as e:
+                self.semantic_error(line_number, e.message)
+                return
+            if status == MATCHED:
+                return
+            if status == MISSED:
+                self.parser_errors[line_number].append(self.diagram.error)
+                self.number_of_failure += 1
+                icg.recovering = True
+                if self.count_error(line_number):
+                    return
+            elif status == UNMATCHED:
+                if self.number_of_failure > 0:
+                    self.parser_errors[line_number].append(
+                        "Syntax Error! Unexpected EndOfFile")
+                else:
+                    self.parser_errors[line_number].append(
+                        "Syntax Error! Malformed Input")
+                self.count_error(line_number)
+                return
+
+    def has_errors(self):
+        return bool(self.scanner_errors or self.parser_errors or
+                    self.semantic_errors)
+
+    def parse(self, source, optimization_passes=None):
+        tokens = TokenStream(source)
+        self.feed(tokens)
+        self.end(tokens.line)
+
+        if self.has_errors():
+            optimization_passes = None
+        self.diagram.intermediate_code_generator.finish(optimization_passes)
+        return self.diagram.intermediate_code_generator.program_block, \
+            self.scanner_errors, self.parser_errors, self.semantic_errors
 
 
 def parse_file(input_file, grammar_file, first_set_file, follow_set_file,
-               output_file, error_file):
+               output_file, error_file, binary_output=False,
+               optimization_passes=None, layout_file=None, cache=None):
+    return compile_file(load_parse_table(grammar_file, first_set_file,
+                                         follow_set_file),
+                        input_file, output_file, error_file, binary_output,
+                        optimization_passes, layout_file, cache)
+
+
+def parse_source(parse_table, source, optimization_passes=None, cache=None,
+                 profile=None, max_errors=None):
+    """Compiles source, a string or a text stream, with a fresh Diagram,
+    stopping after max_errors errors if given.
+
+    With a CompileCache the result is looked up first and stored after a
+    miss. With an instrumentation.Profile the compile reports to it and
+    the cache is not used. Returns (program_block, scanner_errors,
+    parser_errors, semantic_errors, layout).
+    """
+    if profile is not None:
+        parser = profile.session(parse_table)
+        parser.max_errors = max_errors
+        result = parser.parse(source, optimization_passes) + \
+            (parser.diagram.intermediate_code_generator.layout,)
+        profile.done()
+        return result
+    if cache is not None:
+        if not isinstance(source, str):
+            source = source.read()
+        key = cache.key(source, parse_table, optimization_passes,
+                        max_errors)
+        result = cache.load(key)
+        if result is not None:
+            return result
+    diagram = Diagram(parse_table)
+    result = Parser(diagram, max_errors).parse(source,
+                                               optimization_passes) + \
+        (diagram.intermediate_code_generator.layout,)
+    if cache is not None:
+        cache.store(key, *result)
+    return result
+
+
+def compile_file(parse_table, input_file, output_file, error_file,
+                 binary_output=False, optimization_passes=None,
+                 layout_file=None, cache=None, profile=None,
+                 max_errors=None):
+    """Compiles input_file with an already loaded parse table and writes
+    the code and the errors. Returns what parse_source returned."""
     with open(input_file) as f:
-        input_str = f.read()
-
-    with open(grammar_file) as f:
-        rules = f.readlines()
-        grammar = defaultdict(list)
-        for rule in rules:
-            rule = rule.split('\n')[0].strip()
-            lhs, rhs = rule.split(' -> ')
-            grammar[lhs] = [rr.split(' ') for rr in rhs.split(' | ')]
-
-    with open(first_set_file) as f:
-        lines = f.readlines()
-        first_set = defaultdict(list)
-        for line in lines:
-            line = line.split('\n')[0].strip()
-            lhs, *rhs = line.split(' ')
-            first_set[lhs] = rhs
-
-    with open(follow_set_file) as f:
-        lines = f.readlines()
-        follow_set = defaultdict(list)
-        for line in lines:
-            line = line.split('\n')[0].strip()
-            lhs, *rhs = line.split(' ')
-            follow_set[lhs] = rhs
-
-    diagram = Diagram(grammar, first_set, follow_set)
-    parser = Parser(diagram)
-    program_block, scanner_errors, parser_errors, semantic_errors = parser.parse(input_str)
-
-    with open(output_file, 'w') as f:
-        def xstr(x):
-            if x is None:
-                return ''
-            return x
-        for i, inst in enumerate(program_block):
-            if len(inst) != 4:
-                inst = (None, None, None, None)
-            f.write('%s\t(%s,%s,%s,%s)\n' % (i, inst[0] or '', xstr(inst[1]), xstr(inst[2]), xstr(inst[3])))
+        result = parse_source(parse_table, f, optimization_passes, cache,
+                              profile, max_errors)
+    program_block, scanner_errors, parser_errors, semantic_errors, layout = \
+        result
+
+    if binary_output:
+        with open(output_file, 'wb') as f:
+            program_block.write_binary(f)
+    else:
+        with open(output_file, 'w') as f:
+            program_block.write_text(f)
+
+    if layout_file is not None:
+        with open(layout_file, 'w') as f:
+            f.write(layout.report())
 
     with open(error_file, 'w') as f:
-        if scanner_errors:
-            for i in scanner_errors.keys():
-                output = '%s.' % (i + 1)
-                for error in scanner_errors[i]:
-                    output += ' %s' % str(error)
-                f.write(output + '\n')
-
-        if parser_errors:
-            for i in parser_errors.keys():
-                output = '%s.' % (i + 1)
-                for error in parser_errors[i]:
-                    output += ' %s' % str(error)
-                f.write(output + '\n')
-
-        if semantic_errors:
-            for i in semantic_errors.keys():
-                output = '%s.' % (i + 1)
-                for error in semantic_errors[i]:
-                    output += ' %s' % str(error)
-                f.write(output + '\n')
+        f.write(format_errors(scanner_errors, parser_errors, semantic_errors))
+
+    return result
+
+
+def format_errors(scanner_errors, parser_errors, semantic_errors):
+    """Returns the errors as written to the error file."""
+    lines = []
+    for errors in (scanner_errors, parser_errors, semantic_errors):
+        for i in errors.keys():
+            output = '%s.' % (i + 1)
+            for error in errors[i]:
+                output += ' %s' % str(error)
+            lines.append(output + '\n')
+    return ''.join(lines)
@@ -0,0 +1,268 @@
+import struct
+import sys
+from array import array
+
+
+class ProgramBlockException(Exception):
+    def __init__(self, message):
+        self.message = message
+        super(ProgramBlockException, self).__init__(message)
+
+
+# opcode 0 is an empty slot reserved for backpatching
+OPCODES = (None, 'ADD', 'MULT', 'SUB', 'EQ', 'LT', 'ASSIGN', 'JPF', 'JP',
+           'PRINT')
+OPCODE_IDS = dict((name, i) for i, name in enumerate(OPCODES) if name)
+EMPTY = 0
+
+# addressing modes of an operand; RAW operands are kept verbatim in a side
+# table (e.g. '#007') so the text output never differs from what was emitted,
+# LABEL is an immediate holding a code address (e.g. a return address) and
+# ADDRESS one holding a data address (e.g. the base of an array)
+NONE, DIRECT, INDIRECT, IMMEDIATE, RAW, LABEL, ADDRESS = range(7)
+PREFIXES = {'@': INDIRECT, '#': IMMEDIATE}
+MODE_PREFIXES = ('', '', '@', '#', '', '#', '#')
+MAX_VALUE = (1 << 63) - 1
+
+BINARY_MAGIC = b'CPCODE'
+BINARY_VERSION = 1
+HEADER = struct.Struct('<6sHII')
+RAW_ENTRY = struct.Struct('<BI')
+
+
+class ProgramBlock(object):
+    """Three-address code stored column-wise in typed arrays.
+
+    Each instruction is an opcode id plus three operands, every operand
+    being an addressing mode and an integer value, so the block costs a
+    few bytes per instruction. Instructions are read and written as the
+    (op, a, b, c) tuples the code generator uses, with () for a slot that
+    is yet to be backpatched.
+    """
+
+    def __init__(self):
+        self.opcodes = array('B')
+        self.modes = array('B')
+        self.values = array('q')
+        self.raw = []
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def encode(self, operand, raw_index=None):
+        """Returns the (mode, value) of operand. A RAW operand is stored at
+        raw_index when given, so overwriting a slot reuses its entry."""
+        if operand is None:
+            return NONE, 0
+        if type(operand) is int:
+            if -MAX_VALUE <= operand <= MAX_VALUE:
+                return DIRECT, operand
+        elif type(operand) is tuple:
+            # already encoded as (mode, value)
+            return operand
+        elif isinstance(operand, str) and operand[:1] in PREFIXES:
+            negative = operand[1:2] == '-'
+            digits = operand[2:] if negative else operand[1:]
+            if digits.isascii() and digits.isdigit() and len(digits) < 19 \
+                    and (digits[0] != '0' or digits == '0' and not negative):
+                return PREFIXES[operand[0]], int(operand[1:])
+        if raw_index is not None:
+            self.raw[raw_index] = operand
+            return RAW, raw_index
+        self.raw.append(operand)
+        return RAW, len(self.raw) - 1
+
+    def decode(self, mode, value):
+        if mode == DIRECT:
+            return value
+        if mode == NONE:
+            return None
+        if mode == RAW:
+            return self.raw[value]
+        return '%s%d' % (MODE_PREFIXES[mode], value)
+
+    def append(self, instruction):
+        self.opcodes.append(EMPTY)
+        self.modes.extend((NONE, NONE, NONE))
+        self.values.extend((0, 0, 0))
+        self[len(self.opcodes) - 1] = instruction
+
+    def reserve(self):
+        """Appends an empty slot and returns its index for backpatching."""
+        self.opcodes.append(EMPTY)
+        self.modes.extend((NONE, NONE, NONE))
+        self.values.extend((0, 0, 0))
+        return len(self.opcodes) - 1
+
+    def __setitem__(self, index, instruction):
+        if index < 0:
+            index += len(self.opcodes)
+        if len(instruction) != 4:
+            self.opcodes[index] = EMPTY
+            instruction = (None, None, None, None)
+        else:
+            self.opcodes[index] = OPCODE_IDS[instruction[0]]
+        base = index * 3
+        for i in range(3):
+            position = base + i
+            raw_index = self.values[position] \
+                if self.modes[position] == RAW else None
+            mode, value = self.encode(instruction[i + 1], raw_index)
+            self.modes[position] = mode
+            self.values[position] = value
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.opcodes)
+        opcode = self.opcodes[index]
+        if opcode == EMPTY:
+            return ()
+        base = index * 3
+        return (OPCODES[opcode],
+                self.decode(self.modes[base], self.values[base]),
+                self.decode(self.modes[base + 1], self.values[base + 1]),
+                self.decode(self.modes[base + 2], self.values[base + 2]))
+
+    def encoded(self, index):
+        """Returns instruction index as (op, a, b, c) with (mode, value)
+        operands, which append and __setitem__ take back unchanged."""
+        base = index * 3
+        return (OPCODES[self.opcodes[index]],) + tuple(
+            (self.modes[i], self.values[i]) for i in range(base, base + 3))
+
+    def truncate(self, length):
+        """Drops the instructions from length on. Their raw operands keep
+        their entries."""
+        del self.opcodes[length:]
+        del self.modes[length * 3:]
+        del self.values[length * 3:]
+
+    def __iter__(self):
+        for i in range(len(self.opcodes)):
+            yield self[i]
+
+    def format_operand(self, mode, value):
+        if mode == NONE:
+            return ''
+        if mode == RAW:
+            return str(self.raw[value])
+        return '%s%d' % (MODE_PREFIXES[mode], value)
+
+    def write_text(self, f, buffer_size=1 << 16):
+        """Writes the block in the scanner.txt format, in large batches."""
+        opcodes = self.opcodes
+        modes = self.modes
+        values = self.values
+        fmt = self.format_operand
+        lines = []
+        pending = 0
+        for i in range(len(opcodes)):
+            opcode = opcodes[i]
+            if opcode == EMPTY:
+                lines.append('%d\t(,,,)\n' % i)
+            else:
+                base = i * 3
+                lines.append('%d\t(%s,%s,%s,%s)\n' % (
+                    i, OPCODES[opcode],
+                    fmt(modes[base], values[base]),
+                    fmt(modes[base + 1], values[base + 1]),
+                    fmt(modes[base + 2], values[base + 2])))
+            pending += 1
+            if pending == buffer_size:
+                f.write(''.join(lines))
+                lines = []
+                pending = 0
+        f.write(''.join(lines))
+
+    def write_binary(self, f):
+        """Writes the packed columns to the binary stream f."""
+        f.write(HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(self.opcodes),
+                            len(self.raw)))
+        values = self.values
+        if sys.byteorder == 'big':
+            values = array('q', values)
+            values.byteswap()
+        f.write(self.opcodes.tobytes())
+        f.write(self.modes.tobytes())
+        f.write(values.tobytes())
+        for operand in self.raw:
+            data = str(operand).encode('utf-8')
+            f.write(RAW_ENTRY.pack(1 if type(operand) is int else 0,
+                                   len(data)))
+            f.write(data)
+
+    @classmethod
+    def read_text(cls, f):
+        """Loads a block written by write_text."""
+        program_block = cls()
+        for line_number, line in enumerate(f):
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            index, _, instruction = line.partition('\t')
+            if not instruction.startswith('(') or \
+                    not instruction.endswith(')'):
+                raise ProgramBlockException(
+                    'Malformed instruction on line %d.' % (line_number + 1))
+            parts = instruction[1:-1].split(',')
+            if len(parts) != 4:
+                raise ProgramBlockException(
+                    'Malformed instruction on line %d.' % (line_number + 1))
+            if not parts[0]:
+                program_block.append(())
+                continue
+            if parts[0] not in OPCODE_IDS:
+                raise ProgramBlockException(
+                    "Unknown opcode '%s' on line %d." % (parts[0],
+                                                         line_number + 1))
+            program_block.append((parts[0],) + tuple(
+                parse_operand(part) for part in parts[1:]))
+        return program_block
+
+    @classmethod
+    def read_binary(cls, f):
+        program_block = cls()
+        header = f.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise ProgramBlockException('Truncated program block.')
+        magic, version, count, raw_count = HEADER.unpack(header)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ProgramBlockException('Not a packed program block.')
+
+        program_block.opcodes.frombytes(read_exactly(f, count))
+        program_block.modes.frombytes(read_exactly(f, count * 3))
+        program_block.values.frombytes(read_exactly(
+            f, count * 3 * program_block.values.itemsize))
+        if sys.byteorder == 'big':
+            program_block.values.byteswap()
+        for _ in range(raw_count):
+            is_int, size = RAW_ENTRY.unpack(read_exactly(f, RAW_ENTRY.size))
+            data = read_exactly(f, size).decode('utf-8')
+            program_block.raw.append(int(data) if is_int else data)
+        return program_block
+
+
+def load_program_block(path):
+    """Loads a block from path, written either as text or packed."""
+    with open(path, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+            f.seek(0)
+            return ProgramBlock.read_binary(f)
+    with open(path) as f:
+        return ProgramBlock.read_text(f)
+
+
+def parse_operand(text):
+    if not text:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+def read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ProgramBlockException('Truncated program block.')
+    return data
@@ -1,4 +1,10 @@
 import string
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class ScannerException(Exception):
@@ -7,8 +13,15 @@ class ScannerException(Exception):
         super(ScannerException, self).__init__()
 
 
-class DFAException(Exception):
-    pass
+KEYWORDS = frozenset(['if', 'else', 'void', 'int', 'while', 'break', 'continue',
+                      'switch', 'default', 'case', 'return'])
+
+# character classes
+(LETTER, DIGIT, SYMBOL, STAR, SLASH, EQUAL, NEWLINE, SPACE,
+ OTHER, VALID, INVALID) = range(11)
+NUMBER_OF_CLASSES = 11
+
+PRINTABLE = (LETTER, DIGIT, SYMBOL, STAR, SLASH, EQUAL, NEWLINE, SPACE, OTHER)
 
 
 def is_valid(char):
@@ -22,149 +35,406 @@ def is_valid(char):
                     '<', '+', '-', '\n', ' ', '\t', '\r', '\f', '\v']
 
 
-class DFA(object):
-    def __init__(self, start_state, transition_function, accept_states):
-        self.current_state = start_state
-        self.transition_function = transition_function
-        self.accept_states = accept_states
-
-    def next_state(self, char):
-        for key in self.transition_function.keys():
-            if self.current_state == key[0] and char in key[1]:
-                self.current_state = self.transition_function[key]
-                return True
-
-        if not is_valid(char):
-            raise DFAException()
-
-        return False
-
-    def is_accepted(self):
-        return self.current_state in self.accept_states
-
+def classify(char):
+    if char in string.ascii_letters:
+        return LETTER
+    if char in string.digits:
+        return DIGIT
+    if char in ';:,[](){}+-<':
+        return SYMBOL
+    if char == '*':
+        return STAR
+    if char == '/':
+        return SLASH
+    if char == '=':
+        return EQUAL
+    if char == '\n':
+        return NEWLINE
+    if char in ' \t\r\f\v':
+        return SPACE
+    if char in string.printable:
+        return OTHER
+    return VALID if is_valid(char) else INVALID
+
+
+ASCII_CLASSES = [classify(chr(code)) for code in range(128)]
+
+
+# states of the combined automaton, and the token type each one accepts
+(START, IDENTIFIER, NUMBER, WHITESPACE, SINGLE, ASSIGN, EQUALS, COMMENT_START,
+ LINE_COMMENT, LINE_COMMENT_END, BLOCK_COMMENT, BLOCK_COMMENT_STAR,
+ BLOCK_COMMENT_END) = range(13)
+NUMBER_OF_STATES = 13
+
+ACCEPT = {
+    IDENTIFIER: 'ID',
+    NUMBER: 'NUM',
+    WHITESPACE: 'W',
+    SINGLE: 'SYMBOL',
+    ASSIGN: 'SYMBOL',
+    EQUALS: 'SYMBOL',
+    LINE_COMMENT_END: 'COMMENT',
+    BLOCK_COMMENT_END: 'COMMENT',
+}
+
+
+def compile_transitions():
+    transitions = {
+        START: {LETTER: IDENTIFIER, DIGIT: NUMBER, NEWLINE: WHITESPACE,
+                SPACE: WHITESPACE, SYMBOL: SINGLE, STAR: SINGLE,
+                EQUAL: ASSIGN, SLASH: COMMENT_START},
+        IDENTIFIER: {LETTER: IDENTIFIER, DIGIT: IDENTIFIER},
+        NUMBER: {DIGIT: NUMBER},
+        WHITESPACE: {NEWLINE: WHITESPACE, SPACE: WHITESPACE},
+        ASSIGN: {EQUAL: EQUALS},
+        COMMENT_START: {SLASH: LINE_COMMENT, STAR: BLOCK_COMMENT},
+        LINE_COMMENT: dict((cls, LINE_COMMENT) for cls in PRINTABLE),
+        BLOCK_COMMENT: dict((cls, BLOCK_COMMENT) for cls in PRINTABLE),
+        BLOCK_COMMENT_STAR: dict((cls, BLOCK_COMMENT) for cls in PRINTABLE),
+    }
+    transitions[LINE_COMMENT][NEWLINE] = LINE_COMMENT_END
+    transitions[BLOCK_COMMENT][STAR] = BLOCK_COMMENT_STAR
+    del transitions[BLOCK_COMMENT][SLASH]
+    transitions[BLOCK_COMMENT_STAR][STAR] = BLOCK_COMMENT_STAR
+    transitions[BLOCK_COMMENT_STAR][SLASH] = BLOCK_COMMENT_END
+
+    # rows are addressed by their offset in the flat table, so a transition
+    # is a single index: table[row + char_class]
+    table = [-1] * (NUMBER_OF_STATES * NUMBER_OF_CLASSES)
+    for state, edges in transitions.items():
+        for cls, target in edges.items():
+            table[state * NUMBER_OF_CLASSES + cls] = \
+                target * NUMBER_OF_CLASSES
+    accept = [None] * (NUMBER_OF_STATES * NUMBER_OF_CLASSES)
+    for state, token_type in ACCEPT.items():
+        accept[state * NUMBER_OF_CLASSES] = token_type
+    return table, accept
+
+
+TRANSITIONS, ACCEPTED_TYPES = compile_transitions()
+WHITESPACE_ROW = WHITESPACE * NUMBER_OF_CLASSES
+
+
+def match(input_str, pointer):
+    """Runs the automaton from pointer, returns (token_type, end).
+
+    token_type is None when the characters up to end form a scanner error.
+    """
+    table = TRANSITIONS
+    classes = ASCII_CLASSES
+    length = len(input_str)
+    row = 0
+    end = pointer
+    cls = None
+    while end < length:
+        char = input_str[end]
+        code = ord(char)
+        cls = classes[code] if code < 128 else classify(char)
+        next_row = table[row + cls]
+        if next_row < 0:
+            break
+        row = next_row
+        end += 1
+    else:
+        cls = None
 
-def tokenize_pattern(token_type, input_str, pointer, dfa):
-    used_chars = 0
-    result = ''
+    if end == pointer:
+        return None, end + 1
 
-    while pointer + used_chars < len(input_str):
-        char = input_str[pointer + used_chars]
-        try:
-            done = dfa.next_state(char)
-            if not done:
-                break
+    if (cls == OTHER or cls == INVALID) and row != WHITESPACE_ROW:
+        return None, end + 1
 
-            used_chars += 1
-            result += char
-        except DFAException:
-            if token_type == 'W':
-                break
-            result += char
-            raise ScannerException(result)
+    token_type = ACCEPTED_TYPES[row]
+    if token_type is None:
+        return None, end + 1 if cls is not None else end
 
-    if dfa.is_accepted() or used_chars == 0:
-        return used_chars, result
-    else:
-        if pointer + used_chars < len(input_str):
-            result += input_str[pointer + used_chars]
-        raise ScannerException(result)
-
-
-def tokenize_comment(token_type, input_str, pointer):
-    dfa = DFA(
-        start_state=0,
-        transition_function={
-            (0, '/'): 1,
-            (1, '/'): 2,
-            (2, '\n'): 3,
-            (2, string.printable.replace('\n', '')): 2,
-            (1, '*'): 4,
-            (4, '*'): 5,
-            (5, '*'): 5,
-            (5, '/'): 6,
-            (4, string.printable.replace('/', '').replace('*', '')): 4,
-            (5, string.printable.replace('/', '')): 4
-        },
-        accept_states=[3, 6]
-    )
-    return tokenize_pattern(token_type, input_str, pointer, dfa)
-
-
-def tokenize_number(token_type, input_str, pointer):
-    dfa = DFA(
-        start_state=0,
-        transition_function={
-            (0, string.digits): 0
-        },
-        accept_states=[0]
-    )
-
-    return tokenize_pattern(token_type, input_str, pointer, dfa)
-
-
-def tokenize_identifier(token_type, input_str, pointer):
-    dfa = DFA(
-        start_state=0,
-        transition_function={
-            (0, string.ascii_letters): 1,
-            (1, string.ascii_letters + string.digits): 1
-        },
-        accept_states=[1]
-    )
-
-    return tokenize_pattern(token_type, input_str, pointer, dfa)
-
-
-def tokenize_keyword(token_type, input_str, pointer):
-    try:
-        used_chars, result = tokenize_identifier(token_type, input_str, pointer)
-    except ScannerException:
-        return 0, ''
-
-    keywords = ['if', 'else', 'void', 'int', 'while', 'break', 'continue',
-                'switch', 'default', 'case', 'return']
-    for keyword in keywords:
-        if result == keyword:
-            return used_chars, result
-    return 0, ''
-
-
-def tokenize_symbol(token_type, input_str, pointer):
-    dfa = DFA(
-        start_state=0,
-        transition_function={
-            (0, ';:,[](){}+-*<'): 1,
-            (0, '='): 2,
-            (2, '='): 1
-        },
-        accept_states=[1, 2]
-    )
-    return tokenize_pattern(token_type, input_str, pointer, dfa)
-
-
-def skip_whitespace(token_type, input_str, pointer):
-    dfa = DFA(
-        start_state=0,
-        transition_function={
-            (0, '\r\f\v\t\n '): 0
-        },
-        accept_states=[0]
-    )
-
-    return tokenize_pattern(token_type, input_str, pointer, dfa)
+    if token_type == 'ID' and input_str[pointer:end] in KEYWORDS:
+        return 'KEYWORD', end
+    return token_type, end
 
 
 def tokenize(input_str, pointer):
-    tokenizers = [(tokenize_keyword, 'KEYWORD'),
-                  (tokenize_comment, 'COMMENT'),
-                  (tokenize_identifier, 'ID'),
-                  (tokenize_number, 'NUM'),
-                  (skip_whitespace, 'W'),
-                  (tokenize_symbol, 'SYMBOL')]
-
-    for tokenizer, token_type in tokenizers:
-        used_chars, result = tokenizer(token_type, input_str, pointer)
-        if used_chars > 0:
-            return token_type, result
-
-    raise ScannerException(input_str[pointer])
+    token_type, end = match(input_str, pointer)
+    if token_type is None:
+        raise ScannerException(input_str[pointer:end])
+    return token_type, input_str[pointer:end]
+
+
+# inputs shorter than this are scanned character by character even with
+# NumPy, which costs more to set up than it saves on them
+VECTORIZE_MIN_SIZE = 1 << 12
+
+# segments of a BufferIndex that are whole tokens, by kind
+(IDENTIFIER_SEGMENT, NUMBER_SEGMENT, WHITESPACE_SEGMENT,
+ SYMBOL_SEGMENT) = range(1, 5)
+SEGMENT_TYPES = (None, 'ID', 'NUM', 'W', 'SYMBOL')
+
+if numpy is not None:
+    ASCII_CLASS_CODES = numpy.array(ASCII_CLASSES, dtype=numpy.uint8)
+
+
+def classify_buffer(text):
+    """Returns the class of every character of text as a NumPy array."""
+    codes = numpy.frombuffer(text.encode('utf-32-le'), dtype=numpy.uint32)
+    classes = numpy.empty(len(codes), dtype=numpy.uint8)
+    ascii_chars = codes < 128
+    classes[ascii_chars] = ASCII_CLASS_CODES[codes[ascii_chars]]
+    if not ascii_chars.all():
+        others = ~ascii_chars
+        unique, inverse = numpy.unique(codes[others], return_inverse=True)
+        classes[others] = numpy.array(
+            [classify(chr(code)) for code in unique.tolist()],
+            dtype=numpy.uint8)[inverse]
+    return classes
+
+
+class BufferIndex(object):
+    """Tokens of a buffer located with NumPy in bulk.
+
+    The buffer is cut into segments: runs of letters and digits, runs of
+    whitespace and single other characters. starts holds the offset of
+    every segment, then len(text). kinds tells the segments that are one
+    whole token by the token type in SEGMENT_TYPES, 0 for the ones
+    match_run has to look at. lines holds the number of newlines before
+    every offset in starts and irregular the offsets of the characters no
+    comment may hold.
+    """
+
+    def __init__(self, text):
+        length = len(text)
+        classes = classify_buffer(text)
+        letters = classes == LETTER
+        alphanumeric = letters | (classes == DIGIT)
+        newlines = classes == NEWLINE
+        spaces = newlines | (classes == SPACE)
+        runs = numpy.zeros(length, dtype=numpy.int8)
+        runs[alphanumeric] = 1
+        runs[spaces] = 2
+        boundaries = numpy.ones(length, dtype=bool)
+        boundaries[1:] = (runs[1:] != runs[:-1]) | (runs[1:] == 0)
+        starts = numpy.flatnonzero(boundaries)
+        ends = numpy.append(starts[1:], length)
+
+        first = classes[starts]
+        following = numpy.append(classes, SPACE)[ends]
+        # a token running into a character no token may start with makes
+        # a scanner error with it
+        clean = (following != OTHER) & (following != INVALID)
+        letter_counts = numpy.concatenate(([0], numpy.cumsum(letters)))
+        kinds = numpy.zeros(len(starts), dtype=numpy.int8)
+        kinds[(first == LETTER) & clean] = IDENTIFIER_SEGMENT
+        kinds[(first == DIGIT) & clean &
+              (letter_counts[ends] == letter_counts[starts])] = NUMBER_SEGMENT
+        kinds[(first == SPACE) | (first == NEWLINE)] = WHITESPACE_SEGMENT
+        kinds[((first == SYMBOL) | (first == STAR)) & clean] = SYMBOL_SEGMENT
+
+        newline_counts = numpy.concatenate(([0], numpy.cumsum(newlines)))
+        self.starts = starts.tolist()
+        self.starts.append(length)
+        self.kinds = kinds.tolist()
+        self.lines = newline_counts[starts].tolist()
+        self.lines.append(int(newline_counts[length]))
+        self.irregular = numpy.flatnonzero(classes >= VALID).tolist()
+
+
+def match_comment(text, pointer, irregular):
+    """Returns the end of the comment at pointer if it is well formed and
+    closed, otherwise None."""
+    if text.startswith('/*', pointer):
+        close = text.find('*/', pointer + 2)
+        # a block comment ends at the first / in it
+        if close < 0 or text.find('/', pointer + 2, close) >= 0:
+            return None
+        end = close + 2
+    elif text.startswith('//', pointer):
+        close = text.find('\n', pointer + 2)
+        if close < 0:
+            return None
+        end = close + 1
+    else:
+        return None
+    i = bisect_left(irregular, pointer)
+    if i < len(irregular) and irregular[i] < end:
+        return None
+    return end
+
+
+def match_run(text, pointer, run_end, irregular):
+    """match() for a pointer in the run of a BufferIndex ending at run_end,
+    taking runs and comments whole."""
+    char = text[pointer]
+    code = ord(char)
+    cls = ASCII_CLASSES[code] if code < 128 else classify(char)
+    if cls == LETTER:
+        end = run_end
+        token_type = 'KEYWORD' if text[pointer:end] in KEYWORDS else 'ID'
+    elif cls == DIGIT:
+        end = run_end
+        digits = text[pointer:end]
+        if not digits.isdigit():
+            # a number ends at the first letter, which is no error
+            return 'NUM', end - len(digits.lstrip(string.digits))
+        token_type = 'NUM'
+    elif cls == SPACE or cls == NEWLINE:
+        return 'W', run_end
+    elif cls == SYMBOL or cls == STAR:
+        end = pointer + 1
+        token_type = 'SYMBOL'
+    elif cls == EQUAL:
+        end = pointer + 2 if text.startswith('=', pointer + 1) \
+            else pointer + 1
+        token_type = 'SYMBOL'
+    else:
+        end = match_comment(text, pointer, irregular) \
+            if cls == SLASH else None
+        if end is None:
+            return match(text, pointer)
+        token_type = 'COMMENT'
+
+    # a token running into a character no token may start with makes a
+    # scanner error with it
+    if end < len(text):
+        char = text[end]
+        code = ord(char)
+        cls = ASCII_CLASSES[code] if code < 128 else classify(char)
+        if cls == OTHER or cls == INVALID:
+            return None, end + 1
+    return token_type, end
+
+
+class TokenStream(object):
+    """Pulls tokens from a string or a text stream read in chunks.
+
+    Iterating yields (line_number, token_type, token) where token_type is
+    None for scanner errors. line and column are kept up to date as tokens
+    are consumed, so after the stream is exhausted line is the number of
+    newlines in the whole input.
+    """
+
+    def __init__(self, source, chunk_size=1 << 16, vectorized=None):
+        if isinstance(source, str):
+            self.reader = None
+            self.buffer = source
+        else:
+            self.reader = source
+            self.buffer = ''
+        self.chunk_size = chunk_size
+        self.line = 0
+        self.column = 0
+        # None picks the NumPy pre-pass for streams and long strings
+        # whenever NumPy is installed
+        if vectorized is None:
+            vectorized = self.reader is not None or \
+                len(self.buffer) >= VECTORIZE_MIN_SIZE
+        self.vectorized = vectorized and numpy is not None
+
+    def fill(self, pointer, size):
+        chunk = self.reader.read(size)
+        if not chunk:
+            self.reader = None
+            return pointer
+        self.buffer = self.buffer[pointer:] + chunk
+        return 0
+
+    def __iter__(self):
+        if self.vectorized:
+            return self.scan_vectorized()
+        return self.scan()
+
+    def scan(self):
+        pointer = 0
+        read_size = self.chunk_size
+        while True:
+            if pointer >= len(self.buffer):
+                if self.reader is None:
+                    return
+                pointer = self.fill(pointer, read_size)
+                continue
+
+            token_type, end = match(self.buffer, pointer)
+            if end >= len(self.buffer) and self.reader is not None:
+                # the token may go on in the next chunk, so rescan it once
+                # more input is available; doubling keeps long comments linear
+                pointer = self.fill(pointer, read_size)
+                read_size *= 2
+                continue
+            read_size = self.chunk_size
+
+            token = self.buffer[pointer:end]
+            yield self.line, token_type, token
+            pointer = end
+
+            newlines = token.count('\n') \
+                if token_type in (None, 'W', 'COMMENT') else 0
+            if newlines:
+                self.line += newlines
+                self.column = len(token) - token.rindex('\n') - 1
+            else:
+                self.column += len(token)
+
+    def scan_vectorized(self):
+        """Like scan, taking the segments a BufferIndex found to be whole
+        tokens as they are."""
+        pointer = 0
+        read_size = self.chunk_size
+        while True:
+            if self.reader is not None:
+                pointer = self.fill(pointer, read_size)
+            if pointer:
+                self.buffer = self.buffer[pointer:]
+                pointer = 0
+            buffer = self.buffer
+            length = len(buffer)
+            index = BufferIndex(buffer)
+            starts = index.starts
+            kinds = index.kinds
+            lines = index.lines
+            irregular = index.irregular
+            # newlines before the buffer
+            base = self.line
+            read_size = self.chunk_size
+            k = 0
+            while pointer < length:
+                kind = kinds[k]
+                end = starts[k + 1]
+                if end >= length and self.reader is not None:
+                    # the token may go on in the next chunk
+                    read_size = max(read_size, 2 * (length - pointer))
+                    break
+                if kind and starts[k] == pointer:
+                    token = buffer[pointer:end]
+                    if kind == IDENTIFIER_SEGMENT:
+                        yield self.line, 'KEYWORD' \
+                            if token in KEYWORDS else 'ID', token
+                    else:
+                        yield self.line, SEGMENT_TYPES[kind], token
+                    k += 1
+                    if kind == WHITESPACE_SEGMENT and \
+                            base + lines[k] != self.line:
+                        self.line = base + lines[k]
+                        self.column = end - buffer.rindex('\n', pointer,
+                                                          end) - 1
+                    else:
+                        self.column += end - pointer
+                    pointer = end
+                    continue
+
+                token_type, end = match_run(buffer, pointer, end, irregular)
+                if end >= length and self.reader is not None:
+                    read_size = max(read_size, 2 * (length - pointer))
+                    break
+                token = buffer[pointer:end]
+                yield self.line, token_type, token
+                pointer = end
+                while pointer < length and starts[k + 1] <= pointer:
+                    k += 1
+
+                newlines = token.count('\n') \
+                    if token_type in (None, 'W', 'COMMENT') else 0
+                if newlines:
+                    self.line += newlines
+                    self.column = len(token) - token.rindex('\n') - 1
+                else:
+                    self.column += len(token)
+            if self.reader is None:
+                return
@@ -0,0 +1,551 @@
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from compile_cache import CompileCache, DEFAULT_MAX_SIZE
+from grammar_compiler import load_parse_table
+from optimizer import PASSES
+from parser import parse_source
+
+
+class ServiceException(Exception):
+    def __init__(self, message):
+        self.message = message
+        super(ServiceException, self).__init__(message)
+
+
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_TIMEOUT = 30.0
+# the longest request line accepted, sources included
+MAX_REQUEST_SIZE = 64 << 20
+# latencies kept for the percentiles of the metrics
+LATENCY_WINDOW = 1024
+# a request with a source this short goes to a worker in one message with
+# the other short ones waiting behind it, up to BATCH_SIZE of them
+BATCH_SOURCE_SIZE = 16 << 10
+BATCH_SIZE = 16
+ERROR_KINDS = ('scanner', 'parser', 'semantic')
+
+
+def format_result(result):
+    """Turns what parse_source returned into the fields of a response."""
+    program_block, scanner_errors, parser_errors, semantic_errors, _ = \
+        result
+    f = io.StringIO()
+    program_block.write_text(f)
+    errors = []
+    for kind, table in zip(ERROR_KINDS, (scanner_errors, parser_errors,
+                                         semantic_errors)):
+        for line_number in sorted(table):
+            for message in table[line_number]:
+                errors.append({'kind': kind, 'line': line_number + 1,
+                               'message': str(message)})
+    return {'status': 'errors' if errors else 'ok', 'code': f.getvalue(),
+            'instructions': len(program_block), 'errors': errors}
+
+
+def worker_main(connection, grammar_file, first_set_file, follow_set_file,
+                cache_dir, cache_size):
+    """Compiles the lists of (source, passes, max_errors) requests coming
+    over connection until it is closed, sending a response as each compile
+    is done."""
+    parse_table = load_parse_table(grammar_file, first_set_file,
+                                   follow_set_file)
+    cache = CompileCache(cache_dir, cache_size) if cache_dir else None
+    connection.send(None)
+    while True:
+        try:
+            requests = connection.recv()
+        except EOFError:
+            return
+        for source, passes, max_errors in requests:
+            try:
+                response = format_result(parse_source(
+                    parse_table, source, passes, cache,
+                    max_errors=max_errors))
+            except Exception as e:
+                response = {'status': 'failed',
+                            'message': '%s: %s' % (type(e).__name__, e)}
+            connection.send(response)
+
+
+class Worker(object):
+    """A compiler process with the grammar tables loaded, compiling the
+    requests sent to it in order. A request that has to be stopped kills
+    it."""
+
+    def __init__(self, service):
+        self.executor = service.executor
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=worker_main, args=(child,) + service.worker_args,
+            daemon=True)
+        self.process.start()
+        child.close()
+
+    async def start(self):
+        """Waits for the worker to load the tables."""
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.connection.recv)
+        return self
+
+    async def send(self, requests):
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.connection.send, requests)
+
+    async def receive(self):
+        """Waits for the response to the next request sent."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.connection.recv)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class Job(object):
+    def __init__(self, request_id, request, deadline, respond):
+        self.id = request_id
+        self.request = request
+        self.deadline = deadline
+        self.respond = respond
+        self.received = time.monotonic()
+        self.started = None
+        self.run = None
+        # answers "timeout" at the deadline while the job is not running
+        self.expiry = None
+        self.cancelled = False
+        self.done = asyncio.get_running_loop().create_future()
+
+
+class Metrics(object):
+    """Counters of the service.
+
+    latency is the time from a request arriving to its response,
+    queue_wait the part of it spent queued, both over the last
+    LATENCY_WINDOW requests run. batched counts the requests sent to a
+    worker together with others.
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.statuses = Counter()
+        self.max_queue_depth = 0
+        self.worker_restarts = 0
+        self.batched = 0
+        self.latency = deque(maxlen=LATENCY_WINDOW)
+        self.queue_wait = deque(maxlen=LATENCY_WINDOW)
+
+    def as_dict(self, service):
+        return {
+            'received': self.received,
+            'statuses': dict(self.statuses),
+            'queue_depth': service.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'queue_size': service.queue.maxsize,
+            'running': service.running,
+            'workers': service.workers,
+            'worker_restarts': self.worker_restarts,
+            'batched': self.batched,
+            'latency': summarize(self.latency),
+            'queue_wait': summarize(self.queue_wait),
+        }
+
+
+def summarize(samples):
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    last = len(ordered) - 1
+    return {'count': len(ordered),
+            'mean': sum(ordered) / len(ordered),
+            'p50': ordered[last // 2],
+            'p90': ordered[last * 9 // 10],
+            'p99': ordered[last * 99 // 100],
+            'max': ordered[-1]}
+
+
+class CompileService(object):
+    """Compiles sources sent as JSON lines on any number of connections.
+
+    A request is {"id": ..., "source": "..."} with optional "optimize"
+    (every pass), "passes", "max_errors" and "timeout" in seconds, counted
+    from its arrival. The response, sent as soon as it is done and so not
+    necessarily in request order, repeats the id and has a status: "ok"
+    or "errors" with the code and the errors, "timeout", "cancelled",
+    "failed" or "invalid". {"cancel": id} stops a request of the same
+    connection and {"metrics": true} returns the metrics.
+
+    Requests wait in a queue of queue_size entries for one of the worker
+    processes. While it is full a connection's requests are not read, so
+    clients are slowed down instead of the service growing without
+    bound. Short requests waiting together go to a worker in one message,
+    which answers each as it is compiled. A request times out at its
+    deadline wherever it is waiting; one that times out or is cancelled
+    while compiling kills its worker, which is replaced, and the requests
+    sent with it go to the new one.
+    """
+
+    def __init__(self, grammar_file='grammar.txt', first_set_file=None,
+                 follow_set_file=None, workers=None,
+                 queue_size=DEFAULT_QUEUE_SIZE, timeout=DEFAULT_TIMEOUT,
+                 cache_dir=None, cache_size=DEFAULT_MAX_SIZE):
+        # load the tables once here, so they are cached on disk for the
+        # workers and a broken grammar fails before serving
+        load_parse_table(grammar_file, first_set_file, follow_set_file)
+        self.worker_args = (grammar_file, first_set_file, follow_set_file,
+                            cache_dir, cache_size)
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.queue = asyncio.Queue(queue_size)
+        # a worker's pipe is read in a thread, killed workers included
+        self.executor = ThreadPoolExecutor(self.workers * 2)
+        self.metrics = Metrics()
+        self.running = 0
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.ensure_future(self.dispatch())
+                      for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+
+    async def dispatch(self):
+        worker = Worker(self)
+        following = None
+        try:
+            await worker.start()
+            while True:
+                job = following or await self.queue.get()
+                batch, following = self.take_batch(job)
+                while batch:
+                    worker, batch = await self.run_batch(worker, batch)
+        finally:
+            worker.kill()
+
+    def take_batch(self, job):
+        """Returns the batch starting with job, with the short requests
+        already queued behind a short one, and the job taken off the
+        queue that did not fit, if any."""
+        batch = [job]
+        if len(job.request[0]) > BATCH_SOURCE_SIZE:
+            return batch, None
+        while len(batch) < BATCH_SIZE and not self.queue.empty():
+            job = self.queue.get_nowait()
+            if job.done.done():
+                continue
+            if len(job.request[0]) > BATCH_SOURCE_SIZE:
+                return batch, job
+            batch.append(job)
+        return batch, None
+
+    async def run_batch(self, worker, batch):
+        """Compiles batch on worker. Returns the worker to go on with and
+        the jobs of batch left to send to it when it had to be
+        replaced."""
+        batch = [job for job in batch if not job.done.done()]
+        if not batch:
+            return worker, []
+        if len(batch) > 1:
+            self.metrics.batched += len(batch)
+        await worker.send([job.request for job in batch])
+        for i, job in enumerate(batch):
+            job.started = time.monotonic()
+            remaining = job.deadline - job.started
+            if job.done.done() or remaining <= 0:
+                # answered while it waited, but the worker compiles it
+                # anyway, so it is stopped
+                if not job.done.done():
+                    self.finish(job, {'status': 'timeout'})
+                worker = await self.replace(worker)
+                return worker, batch[i + 1:]
+            job.expiry.cancel()
+            self.running += 1
+            job.run = asyncio.ensure_future(worker.receive())
+            # whether the worker has to be replaced
+            stopped = True
+            try:
+                response = await asyncio.wait_for(job.run, remaining)
+                stopped = False
+            except asyncio.TimeoutError:
+                response = {'status': 'timeout'}
+            except asyncio.CancelledError:
+                if not job.cancelled:
+                    raise
+                # answered by stop()
+                response = None
+            except (EOFError, OSError) as e:
+                response = {'status': 'failed',
+                            'message': 'Worker died: %s' % e}
+            finally:
+                self.running -= 1
+                job.run = None
+            if response is not None:
+                self.finish(job, response)
+            if stopped:
+                worker = await self.replace(worker)
+                return worker, batch[i + 1:]
+        return worker, []
+
+    async def replace(self, worker):
+        worker.kill()
+        self.metrics.worker_restarts += 1
+        return await Worker(self).start()
+
+    def expire(self, job):
+        if job.run is None and not job.done.done():
+            self.finish(job, {'status': 'timeout'})
+
+    def finish(self, job, response):
+        if job.expiry is not None:
+            job.expiry.cancel()
+        now = time.monotonic()
+        metrics = self.metrics
+        metrics.statuses[response['status']] += 1
+        if job.started is not None:
+            metrics.latency.append(now - job.received)
+            metrics.queue_wait.append(job.started - job.received)
+        response['id'] = job.id
+        response['seconds'] = now - job.received
+        job.respond(response)
+        if not job.done.done():
+            job.done.set_result(None)
+
+    def parse_request(self, message):
+        """Returns (source, passes, max_errors) and the timeout of a compile
+        request."""
+        source = message.get('source')
+        if not isinstance(source, str):
+            raise ServiceException("'source' has to be a string.")
+        passes = message.get('passes')
+        if passes is None:
+            passes = PASSES if message.get('optimize') else None
+        elif not isinstance(passes, list) or \
+                any(name not in PASSES for name in passes):
+            raise ServiceException("'passes' has to be a list of %s." %
+                                   ', '.join(PASSES))
+        max_errors = message.get('max_errors')
+        if max_errors is not None and (not isinstance(max_errors, int) or
+                                       max_errors < 1):
+            raise ServiceException("'max_errors' has to be positive.")
+        timeout = message.get('timeout', self.timeout)
+        if not isinstance(timeout, (int, float)) or timeout <= 0:
+            raise ServiceException("'timeout' has to be positive.")
+        return (source, passes, max_errors), timeout
+
+    async def serve(self, reader, writer):
+        """Serves one connection until its input ends and every request
+        read from it is answered. Requests still open when the connection
+        breaks are stopped."""
+        jobs = {}
+
+        def send(response):
+            if not writer.is_closing():
+                writer.write(json.dumps(response).encode() + b'\n')
+
+        def respond(job):
+            def done(response):
+                jobs.pop(job.id, None)
+                send(response)
+            return done
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ConnectionError:
+                    return
+                except ValueError:
+                    send({'status': 'invalid',
+                          'message': 'Request longer than %d bytes.' %
+                                     MAX_REQUEST_SIZE})
+                    break
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                    if not isinstance(message, dict):
+                        raise ValueError
+                except ValueError:
+                    send({'status': 'invalid',
+                          'message': 'Requests are JSON objects.'})
+                    continue
+
+                if message.get('metrics'):
+                    send({'id': message.get('id'),
+                          'metrics': self.metrics.as_dict(self)})
+                elif 'cancel' in message:
+                    self.cancel(jobs, message['cancel'], send)
+                else:
+                    request_id = message.get('id')
+                    try:
+                        request, timeout = self.parse_request(message)
+                    except ServiceException as e:
+                        send({'id': request_id, 'status': 'invalid',
+                              'message': e.message})
+                        continue
+                    if request_id in jobs:
+                        send({'id': request_id, 'status': 'invalid',
+                              'message': 'Request id already in use.'})
+                        continue
+                    self.metrics.received += 1
+                    job = Job(request_id, request,
+                              time.monotonic() + timeout, None)
+                    job.respond = respond(job)
+                    job.expiry = asyncio.get_running_loop().call_later(
+                        timeout, self.expire, job)
+                    jobs[request_id] = job
+                    await self.queue.put(job)
+                    self.metrics.max_queue_depth = max(
+                        self.metrics.max_queue_depth, self.queue.qsize())
+                await writer.drain()
+            if jobs:
+                await asyncio.wait([job.done for job in jobs.values()])
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for job in list(jobs.values()):
+                # nobody is left to answer
+                job.respond = lambda response: None
+                self.stop(job)
+
+    def cancel(self, jobs, request_id, send):
+        job = jobs.get(request_id)
+        if job is None:
+            send({'id': request_id, 'status': 'unknown'})
+            return
+        self.stop(job)
+        if job.started is None:
+            self.finish(job, {'status': 'cancelled'})
+
+    def stop(self, job):
+        job.cancelled = True
+        if job.run is not None:
+            job.run.cancel()
+            self.finish(job, {'status': 'cancelled'})
+
+
+class FileWriter(object):
+    """The part of a StreamWriter serve uses, over a blocking binary file.
+    Writes run in order on a thread of their own, so a slow reader never
+    blocks the event loop."""
+
+    def __init__(self, f):
+        self.file = f
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = None
+        self.error = None
+
+    def write(self, data):
+        self.pending = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.send, data)
+
+    def send(self, data):
+        if self.error is not None:
+            return
+        try:
+            self.file.write(data)
+            self.file.flush()
+        except OSError as e:
+            self.error = e
+
+    def is_closing(self):
+        return self.error is not None
+
+    async def drain(self):
+        if self.pending is not None:
+            await self.pending
+        if self.error is not None:
+            raise ConnectionError(str(self.error))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+async def serve_stdio(service):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=MAX_REQUEST_SIZE)
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    writer = FileWriter(sys.stdout.buffer)
+    try:
+        await service.serve(reader, writer)
+    finally:
+        writer.close()
+
+
+async def run(options):
+    service = CompileService(options.grammar, options.first_set,
+                             options.follow_set, options.workers,
+                             options.queue_size, options.timeout,
+                             options.cache_dir, options.cache_size << 20)
+    service.start()
+    try:
+        if options.socket:
+            server = await asyncio.start_unix_server(
+                service.serve, options.socket, limit=MAX_REQUEST_SIZE)
+        elif options.port is not None:
+            server = await asyncio.start_server(
+                service.serve, options.host, options.port,
+                limit=MAX_REQUEST_SIZE)
+        else:
+            await serve_stdio(service)
+            return
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main(argv=None):
+    arguments = argparse.ArgumentParser(
+        description='Serves compiles as JSON lines over a local socket or '
+                    'standard input and output.')
+    arguments.add_argument('--socket', default=None,
+                           help='listen on this Unix socket')
+    arguments.add_argument('--port', type=int, default=None,
+                           help='listen on this TCP port')
+    arguments.add_argument('--host', default='127.0.0.1')
+    arguments.add_argument('-j', '--workers', type=int, default=None,
+                           help='worker processes (default: one per CPU)')
+    arguments.add_argument('--queue-size', type=int,
+                           default=DEFAULT_QUEUE_SIZE,
+                           help='requests waiting for a worker before '
+                                'clients are slowed down')
+    arguments.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                           help='seconds a request may take by default')
+    arguments.add_argument('--cache-dir', default=None)
+    arguments.add_argument('--cache-size', type=int,
+                           default=DEFAULT_MAX_SIZE >> 20,
+                           help='size bound of the cache in megabytes')
+    arguments.add_argument('--grammar', default='grammar.txt')
+    arguments.add_argument('--first-set', default=None)
+    arguments.add_argument('--follow-set', default=None)
+    options = arguments.parse_args(argv)
+    if options.workers is not None and options.workers < 1:
+        arguments.error('the number of workers must be positive')
+    if options.queue_size < 1:
+        arguments.error('the queue size must be positive')
+
+    try:
+        asyncio.run(run(options))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
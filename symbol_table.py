@@ -0,0 +1,52 @@
+class SymbolTable(object):
+    """Symbols visible at the current point of the program.
+
+    Every name maps to a stack of (scope, entry) bindings sorted by scope,
+    so the innermost declaration is always on top, and every scope keeps
+    the names declared in it so leaving the scope only touches those.
+    """
+
+    def __init__(self):
+        self.bindings = {}
+        self.scopes = {}
+
+    def declare(self, name, scope, entry):
+        bindings = self.bindings.setdefault(name, [])
+        i = len(bindings)
+        while i and bindings[i - 1][0] > scope:
+            i -= 1
+        if i and bindings[i - 1][0] == scope:
+            bindings[i - 1] = (scope, entry)
+            return
+        bindings.insert(i, (scope, entry))
+        self.scopes.setdefault(scope, []).append(name)
+
+    def lookup(self, name):
+        bindings = self.bindings.get(name)
+        if bindings:
+            return bindings[-1][1]
+        return None
+
+    def __contains__(self, name):
+        return name in self.bindings
+
+    def exit_scope(self, scope):
+        """Drops every binding declared in scope or in any deeper one."""
+        for sc in [sc for sc in self.scopes if sc >= scope]:
+            for name in self.scopes.pop(sc):
+                bindings = self.bindings[name]
+                i = len(bindings) - 1
+                while bindings[i][0] != sc:
+                    i -= 1
+                del bindings[i]
+                if not bindings:
+                    del self.bindings[name]
+
+
+def shape(entry):
+    """What code using a symbol depends on, apart from its addresses."""
+    if entry is None:
+        return None
+    if entry[0] == 'func':
+        return entry[0], entry[3], entry[4]
+    return entry[0]
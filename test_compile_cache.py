@@ -0,0 +1,43 @@
+from compile_cache import CompileCache
+from compiler import Compiler
+
+SOURCE = 'void main(void) { output(1); }'
+
+
+def cached_size(cache):
+    return sum(size for _, size, _ in cache.entries())
+
+
+def test_store_same_key_twice(tmp_path):
+    compiler = Compiler()
+    cache = CompileCache(str(tmp_path))
+    key = cache.key(SOURCE, compiler.parse_table)
+    result = compiler.compile(SOURCE)
+    fields = (result.program_block, result.scanner_errors,
+              result.parser_errors, result.semantic_errors, result.layout)
+
+    cache.store(key, *fields)
+    cache.store(key, *fields)
+    assert len(cache.entries()) == 1
+    assert cache.size == cached_size(cache)
+
+    cache.store(key, *fields)
+    assert cache.size == cached_size(cache)
+    assert cache.load(key) is not None
+
+
+def test_repeated_stores_do_not_evict(tmp_path):
+    compiler = Compiler()
+    cache = CompileCache(str(tmp_path))
+    key = cache.key(SOURCE, compiler.parse_table)
+    result = compiler.compile(SOURCE)
+    fields = (result.program_block, result.scanner_errors,
+              result.parser_errors, result.semantic_errors, result.layout)
+    cache.store(key, *fields)
+    cache.max_size = cached_size(cache) * 2
+
+    other = cache.key(SOURCE + ' ', compiler.parse_table)
+    cache.store(other, *fields)
+    for _ in range(5):
+        cache.store(key, *fields)
+    assert cache.load(other) is not None
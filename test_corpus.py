@@ -0,0 +1,163 @@
+import random
+
+import pytest
+
+from benchmark import PATHOLOGICAL, ProgramGenerator, fuzz_corpus, mutate
+from compiler import Compiler
+from incremental import IncrementalCompiler
+from optimizer import PASSES
+from parallel import ParallelCompiler
+from parser import Diagram, Parser
+from scanner import TokenStream
+from vm import VirtualMachine
+
+MAX_STEPS = 1000000
+SEEDS = range(12)
+FUZZ = list(fuzz_corpus(count=30, size=200))
+# the most steps the parser may take per token, recovery included
+STEPS_PER_TOKEN = 16
+# (name, source, error file), semantic errors after syntax errors included
+ERRORS = [
+    ('syntax-then-undefined', """void main(void) {
+    int a;
+    a = 1 + ;
+    b = 2;
+}
+""", """3. Syntax Error! Missing #Additive_expression
+4. 'b' is not defined.
+"""),
+    ('scanner-then-break', """void main(void) {
+    int a;
+    a = 2 $ 3;
+    break;
+}
+""", """3. $
+3. Syntax Error! Unexpected #NUM
+4. No 'while' or 'switch' found for 'break'.
+"""),
+    ('syntax-in-while', """void main(void) {
+    int i;
+    while (i < ) {
+        j = i;
+        i = i + 1;
+    }
+}
+""", """3. Syntax Error! Missing #Additive_expression
+4. 'j' is not defined.
+"""),
+    ('skipped-declaration', """void main(void) {
+    int a;
+    a = 1
+    void b;
+}
+""", """4. Syntax Error! Unexpected #void Syntax Error! Unexpected #ID
+"""),
+    ('unexpected-end', """int f(int x) {
+    return x
+}
+""", """3. Syntax Error! Unexpected #}
+4. Syntax Error! Unexpected EndOfFile
+"""),
+    ('arguments', """int f(int x) { return x; }
+void main(void) {
+    int a;
+    a = f(1, 2);
+    b = 1;
+}
+""", """4. Mismatch in numbers of arguments of 'f'.
+"""),
+]
+
+
+class CountingDiagram(Diagram):
+    def __init__(self, parse_table):
+        super(CountingDiagram, self).__init__(parse_table)
+        self.steps = 0
+
+    def move_forward(self, terminal, token):
+        self.steps += 1
+        return super(CountingDiagram, self).move_forward(terminal, token)
+
+
+@pytest.fixture(scope='module')
+def compiler():
+    return Compiler()
+
+
+@pytest.fixture(scope='module')
+def parallel(compiler):
+    with ParallelCompiler(compiler.parse_table, workers=2,
+                          min_size=0) as parallel:
+        yield parallel
+
+
+def program(seed):
+    return ProgramGenerator(seed, functions=3, globals=3, statements=2,
+                            dense_switches=0.5).generate()
+
+
+def run(result):
+    assert result.is_ok, result.errors()
+    vm = VirtualMachine(result.program_block, max_steps=MAX_STEPS)
+    vm.run()
+    return vm.output()
+
+
+@pytest.mark.parametrize('name, source', FUZZ,
+                         ids=[name for name, _ in FUZZ])
+def test_errors_do_not_crash(compiler, name, source):
+    expected = compiler.compile(source)
+    compiler.compile(source, PASSES)
+    Compiler(parse_table=compiler.parse_table, max_errors=5).compile(source)
+
+    incremental = IncrementalCompiler(compiler)
+    incremental.compile(source)
+    edited = mutate(source, random.Random(name), 3)
+    assert incremental.compile(edited).errors() == \
+        compiler.compile(edited).errors()
+    assert incremental.compile(source).errors() == expected.errors()
+
+
+@pytest.mark.parametrize('name', sorted(PATHOLOGICAL))
+@pytest.mark.parametrize('size', [100, 2000])
+def test_recovery_is_linear(compiler, name, size):
+    source = PATHOLOGICAL[name](size)
+    diagram = CountingDiagram(compiler.parse_table)
+    parser = Parser(diagram)
+    tokens = TokenStream(source)
+    parser.feed(tokens)
+    parser.end(tokens.line)
+    count = sum(1 for token in TokenStream(source)
+                if token[1] not in ('W', 'COMMENT'))
+    assert diagram.steps <= STEPS_PER_TOKEN * (count + 1)
+
+
+@pytest.mark.parametrize('name, source, expected', ERRORS,
+                         ids=[name for name, _, _ in ERRORS])
+def test_errors(compiler, name, source, expected):
+    assert compiler.compile(source).errors() == expected
+    assert IncrementalCompiler(compiler).compile(source).errors() == expected
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_optimized_output(compiler, seed):
+    source = program(seed)
+    assert run(compiler.compile(source, PASSES)) == \
+        run(compiler.compile(source))
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_incremental_output(compiler, seed):
+    source = program(seed)
+    incremental = IncrementalCompiler(compiler)
+    incremental.compile(program(seed + len(SEEDS)))
+    assert run(incremental.compile(source)) == run(compiler.compile(source))
+    assert run(incremental.compile(source, PASSES)) == \
+        run(compiler.compile(source))
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_parallel_output(compiler, parallel, seed):
+    source = program(seed)
+    assert run(parallel.compile(source, PASSES)) == \
+        run(compiler.compile(source))
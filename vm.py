@@ -0,0 +1,239 @@
+from program_block import OPCODES, EMPTY, NONE, DIRECT, INDIRECT, IMMEDIATE, \
+    RAW, LABEL, ADDRESS, load_program_block
+
+
+class VMException(Exception):
+    def __init__(self, message):
+        self.message = message
+        super(VMException, self).__init__(message)
+
+
+PRINT_FORMAT = 'PRINT %d\n'
+DEFAULT_MEMORY_SIZE = 1 << 16
+MAX_MEMORY_SIZE = 1 << 24
+
+BINARY_OPERATORS = {'ADD': '%s + %s', 'SUB': '%s - %s', 'MULT': '%s * %s',
+                    'LT': '1 if %s < %s else 0', 'EQ': '1 if %s == %s else 0'}
+# words are 32-bit two's complement integers, as in the reference tester
+ARITHMETIC = ('ADD', 'SUB', 'MULT')
+ARITY = {'ADD': 3, 'SUB': 3, 'MULT': 3, 'LT': 3, 'EQ': 3, 'ASSIGN': 2,
+         'JP': 1, 'JPF': 2, 'PRINT': 1}
+JUMP_TARGETS = {'JP': 0, 'JPF': 1}
+INVALID = -1
+
+
+def read_source(mode, name, lines):
+    if mode == IMMEDIATE:
+        return name
+    if mode == DIRECT:
+        return 'm[%s]' % name
+    lines.append('p%s = m[%s]' % (name, name))
+    lines.append('if p%s < 0: bad(p%s)' % (name, name))
+    return 'm[p%s]' % name
+
+
+def target_source(mode, name, lines):
+    if mode == DIRECT:
+        return name
+    lines.append('t = m[%s]' % name)
+    lines.append('if not 0 <= t <= end: jump_out(t)')
+    return 't'
+
+
+def instruction_body(opcode, modes):
+    """Source lines executing one instruction and returning the next pc."""
+    if opcode == EMPTY:
+        return ['fail("Empty instruction at %d." % index)']
+    if INVALID in modes:
+        return ['fail("Invalid operand at %d." % index)']
+
+    name = OPCODES[opcode]
+    if NONE in modes[:ARITY[name]]:
+        return ['fail("Missing operand at %d." % index)']
+    lines = []
+    if name in BINARY_OPERATORS:
+        if modes[2] not in (DIRECT, INDIRECT):
+            return ['fail("Invalid destination at %d." % index)']
+        x = read_source(modes[0], 'a', lines)
+        y = read_source(modes[1], 'b', lines)
+        lines.append('v = ' + BINARY_OPERATORS[name] % (x, y))
+        if name in ARITHMETIC:
+            lines.append('if not -0x80000000 <= v <= 0x7FFFFFFF: v = wrap(v)')
+        lines.append('%s = v' % read_source(modes[2], 'c', lines))
+    elif name == 'ASSIGN':
+        if modes[1] not in (DIRECT, INDIRECT):
+            return ['fail("Invalid destination at %d." % index)']
+        x = read_source(modes[0], 'a', lines)
+        lines.append('%s = %s' % (read_source(modes[1], 'b', lines), x))
+    elif name == 'JP':
+        if modes[0] not in (DIRECT, INDIRECT):
+            return ['fail("Invalid jump target at %d." % index)']
+        target = target_source(modes[0], 'a', lines)
+        lines.append('return %s' % target)
+        return lines
+    elif name == 'JPF':
+        if modes[1] not in (DIRECT, INDIRECT):
+            return ['fail("Invalid jump target at %d." % index)']
+        lines.append('if %s == 0:' % read_source(modes[0], 'a', lines))
+        jump = []
+        target = target_source(modes[1], 'b', jump)
+        lines.extend('    ' + line for line in jump)
+        lines.append('    return %s' % target)
+    elif name == 'PRINT':
+        lines.append('out(%s)' % read_source(modes[0], 'a', lines))
+    lines.append('return following')
+    return lines
+
+
+FACTORIES = {}
+
+
+def instruction_factory(opcode, modes):
+    """Compiles (once per opcode and modes) a maker of instruction closures."""
+    key = (opcode, modes)
+    factory = FACTORIES.get(key)
+    if factory is None:
+        source = ['def make(m, a, b, c, index, following, end, out, fail, '
+                  'bad, jump_out, wrap):',
+                  '    def run():']
+        source.extend('        ' + line
+                      for line in instruction_body(opcode, modes))
+        source.append('    return run')
+        namespace = {}
+        exec('\n'.join(source), namespace)
+        factory = FACTORIES[key] = namespace['make']
+    return factory
+
+
+def to_word(value):
+    return (value + 0x80000000 & 0xFFFFFFFF) - 0x80000000
+
+
+def resolve_raw(operand):
+    if type(operand) is int:
+        return DIRECT, operand
+    if isinstance(operand, str) and operand[:1] in ('#', '@'):
+        try:
+            value = int(operand[1:])
+        except ValueError:
+            return INVALID, 0
+        return (IMMEDIATE if operand[0] == '#' else INDIRECT), value
+    return INVALID, 0
+
+
+class VirtualMachine(object):
+    """Executes a ProgramBlock.
+
+    Every instruction is decoded once into a closure specialized for its
+    opcode and addressing modes that updates the flat memory and returns
+    the next pc, so running is a single loop of closure calls. Execution
+    stops when control falls off the end of the program.
+    """
+
+    def __init__(self, program_block, memory_size=None, max_steps=None,
+                 max_instructions=None):
+        if max_instructions is not None and \
+                len(program_block) > max_instructions:
+            raise VMException('Program has %d instructions, the limit is %d.'
+                              % (len(program_block), max_instructions))
+        self.program_block = program_block
+        self.max_steps = max_steps
+        self.memory_size = memory_size or max(DEFAULT_MEMORY_SIZE,
+                                              self.highest_address() + 1)
+        if self.memory_size > MAX_MEMORY_SIZE:
+            raise VMException('Program needs %d words of memory, the limit '
+                              'is %d.' % (self.memory_size, MAX_MEMORY_SIZE))
+        self.memory = [0] * self.memory_size
+        self.printed = []
+        self.steps = 0
+        self.code = self.decode()
+
+    def highest_address(self):
+        highest = 0
+        for mode, value in zip(self.program_block.modes,
+                               self.program_block.values):
+            if mode in (DIRECT, INDIRECT) and value > highest:
+                highest = value
+        return highest
+
+    def decode(self):
+        program_block = self.program_block
+        memory = self.memory
+        end = len(program_block)
+        out = self.printed.append
+
+        def fail(message):
+            raise VMException(message)
+
+        def bad(address):
+            raise VMException('Invalid memory address %d.' % address)
+
+        def jump_out(target):
+            raise VMException('Jump to %d is outside the program.' % target)
+
+        code = []
+        for index in range(end):
+            opcode = program_block.opcodes[index]
+            base = index * 3
+            modes = []
+            values = []
+            target = JUMP_TARGETS.get(OPCODES[opcode])
+            for i in range(3):
+                mode = program_block.modes[base + i]
+                value = program_block.values[base + i]
+                if mode == RAW:
+                    mode, value = resolve_raw(program_block.raw[value])
+                if mode == LABEL or mode == ADDRESS:
+                    mode = IMMEDIATE
+                if mode == IMMEDIATE:
+                    value = to_word(value)
+                elif i == target and mode == DIRECT:
+                    # a direct jump target is a code address
+                    if not 0 <= value <= end:
+                        mode = INVALID
+                elif mode in (DIRECT, INDIRECT) and \
+                        not 0 <= value < self.memory_size:
+                    mode = INVALID
+                modes.append(mode)
+                values.append(value)
+            code.append(instruction_factory(opcode, tuple(modes))(
+                memory, values[0], values[1], values[2], index, index + 1,
+                end, out, fail, bad, jump_out, to_word))
+        return code
+
+    def run(self):
+        """Runs the program, returns the values it printed."""
+        code = self.code
+        end = len(code)
+        pc = 0
+        steps = 0
+        max_steps = self.max_steps
+        try:
+            if max_steps is None:
+                while pc != end:
+                    pc = code[pc]()
+                    steps += 1
+            else:
+                while pc != end:
+                    if steps == max_steps:
+                        raise VMException('Step limit of %d exceeded.' %
+                                          max_steps)
+                    pc = code[pc]()
+                    steps += 1
+        except IndexError:
+            raise VMException('Memory access out of range at %d.' % pc)
+        finally:
+            self.steps = steps
+        return self.printed
+
+    def output(self):
+        return ''.join(PRINT_FORMAT % value for value in self.printed)
+
+
+def run_file(path, max_steps=None, max_instructions=None):
+    """Runs the program in path (text or packed), returns the printed output.
+    """
+    vm = VirtualMachine(load_program_block(path), max_steps=max_steps,
+                        max_instructions=max_instructions)
+    vm.run()
+    return vm.output()